@@ -1,14 +1,15 @@
 import yaml
-import cv2
 from loss.metrics import *
-from torchvision.utils import save_image
 import pytorch_lightning as pl
 from init import weights_init
 import os
+import copy
+import time
 import numpy as np
 from tensorboardX import SummaryWriter
 from generate import generate
 from check_arch import check_arch
+from data.canny import batch_edges
 
 with open("config.yaml", "r") as ymlfile:
     cfg = yaml.safe_load(ymlfile)
@@ -106,6 +107,27 @@ class CustomTrainClass(pl.LightningModule):
 
         self.iter_check = 0
 
+        # loss scalars are reduced on the device and written every log_window steps
+        from scalar_buffer import ScalarBuffer
+
+        self.scalar_buffer = ScalarBuffer.from_config(cfg, writer)
+
+        # validation outputs are encoded and written in the background
+        from image_writer import ImageWriter
+
+        self.image_writer = ImageWriter.from_config(cfg)
+
+        # checkpoints are snapshotted to cpu and written in the background
+        from checkpoint_writer import CheckpointWriter
+
+        if (
+            cfg["datasets"]["train"]["keep_best_checkpoints"] > 0
+            and cfg["datasets"]["train"]["best_checkpoint_metric"]
+            not in cfg["train"]["metrics"]
+        ):
+            raise ValueError("best_checkpoint_metric has to be one of the metrics.")
+        self.checkpoint_writer = CheckpointWriter.from_config(cfg)
+
         if (
             cfg["train"]["KID_weight"] > 0
             or cfg["train"]["IS_weight"] > 0
@@ -124,6 +146,74 @@ class CustomTrainClass(pl.LightningModule):
 
             self.RealESRGANDatasetApply = RealESRGANDatasetApply(self.device)
 
+        if cfg["datasets"]["train"]["batch_edges"] is True:
+            arch, edge, _, _ = check_arch(cfg)
+            if arch != "inpainting" or not edge:
+                raise ValueError(
+                    "batch_edges is only used by EdgeConnect, PRVS, CTSDG and misf."
+                )
+
+        if cfg["datasets"]["train"]["batch_masks"] is True:
+            if cfg["datasets"]["train"]["mode"] not in ("DS_inpaint", "DS_inpaint_TF"):
+                raise ValueError("batch_masks is only used by DS_inpaint.")
+            from data.stroke_mask import StrokeMasks
+
+            # the datasets return a seed instead of the generated stroke masks
+            self.StrokeMasks = StrokeMasks(
+                cfg["datasets"]["train"]["HR_size"], cfg["datasets"]["train"]["HR_size"]
+            )
+
+        if cfg["datasets"]["train"]["patch_curriculum"]:
+            if cfg["datasets"]["train"]["mode"] not in (
+                "DS_lrhr",
+                "DS_lrhr_shard",
+                "DS_inpaint",
+                "DS_realesrgan",
+            ):
+                raise ValueError(
+                    "patch_curriculum is only used by DS_lrhr, DS_inpaint and DS_realesrgan."
+                )
+
+        if (
+            cfg["datasets"]["val"]["batch_size"] > 1
+            and cfg["network_G"]["netG"] == "DFDNet"
+        ):
+            # landmarks and the output normalization are per image
+            raise ValueError("DFDNet is validated with batch_size 1.")
+
+        if cfg["datasets"]["train"]["batch_degradation"] is True:
+            if cfg["datasets"]["train"]["mode"] not in ("DS_lrhr", "DS_lrhr_shard"):
+                raise ValueError("batch_degradation is only used by DS_lrhr.")
+            if cfg["network_G"]["netG"] == "DFDNet":
+                raise ValueError("batch_degradation expects images in range [0,1].")
+            from data.augmentation.batched import BatchDegradation
+
+            with open("aug_config.yaml", "r") as ymlfile:
+                augcfg = yaml.safe_load(ymlfile)
+            # noise, blur, jpeg and OTF downscaling are left out of the dataloader
+            # and applied to the whole batch in training_step
+            self.BatchDegradation = BatchDegradation.from_config(
+                cfg["datasets"]["train"], augcfg, cfg["scale"]
+            )
+
+    def setup(self, stage=None):
+        # trainer.save_checkpoint writes through the CheckpointWriter as well
+        strategy = self.trainer.strategy
+        if strategy.checkpoint_io is not self.checkpoint_writer:
+            self.checkpoint_writer.checkpoint_io = strategy.checkpoint_io
+            strategy.checkpoint_io = self.checkpoint_writer
+
+    def on_load_checkpoint(self, checkpoint):
+        # only the losses with a weight are built, so checkpoints can hold
+        # weights of losses which are disabled now or lack enabled ones
+        state_dict = self.state_dict()
+        for key in list(checkpoint["state_dict"]):
+            if key.startswith("loss.") and key not in state_dict:
+                del checkpoint["state_dict"][key]
+        for key, value in state_dict.items():
+            if key.startswith("loss.") and key not in checkpoint["state_dict"]:
+                checkpoint["state_dict"][key] = value
+
     def forward(self, image, masks):
         return self.netG(image, masks)
 
@@ -144,17 +234,42 @@ class CustomTrainClass(pl.LightningModule):
         arch, edge, grayscale, landmarks = check_arch(cfg)
 
         # inpainting
-        if arch == "inpainting" and edge:
-            other["edge"] = train_batch[3]
-        if arch == "inpainting" and grayscale:
-            other["grayscale"] = train_batch[4]
+        if (
+            arch == "inpainting"
+            and edge
+            and cfg["datasets"]["train"]["batch_edges"] is True
+        ):
+            # the datasets leave out edges and grayscale, computed for the batch
+            edges, gray = batch_edges(
+                train_batch[2],
+                cfg["datasets"]["train"]["canny_min"],
+                cfg["datasets"]["train"]["canny_max"],
+            )
+            other["edge"] = edges
+            if grayscale:
+                other["grayscale"] = gray
+        else:
+            if arch == "inpainting" and edge:
+                other["edge"] = train_batch[3]
+            if arch == "inpainting" and grayscale:
+                other["grayscale"] = train_batch[4]
         if arch == "inpainting":
             lr_image = train_batch[0]
             hr_image = train_batch[2]
             other["mask"] = train_batch[1]
+            if cfg["datasets"]["train"]["batch_masks"] is True:
+                other["mask"] = self.StrokeMasks.fill(
+                    other["mask"],
+                    train_batch[-1],
+                    cfg["datasets"]["train"]["mask_invert_ratio"],
+                )
+                lr_image = hr_image * other["mask"]
 
         # interpolation
         elif arch == "interpolation":
+            if cfg["datasets"]["train"]["mode"] == "DS_video_store":
+                # uint8 frames from the triplet store, converted on the device
+                train_batch = [frames.float() / 255 for frames in train_batch[:3]]
             other["hr_image1"] = train_batch[0]
             other["hr_image3"] = train_batch[1]
             hr_image = train_batch[2]
@@ -173,9 +288,11 @@ class CustomTrainClass(pl.LightningModule):
                 lr_image = lr_image.unsqueeze(0)
                 hr_image = hr_image.unsqueeze(0)
                 other["gt"] = other["gt"].unsqueeze(0)
-        else:
+        elif arch != "inpainting":
             lr_image = train_batch[1]
             hr_image = train_batch[2]
+            if cfg["datasets"]["train"]["batch_degradation"] is True:
+                lr_image = self.BatchDegradation(lr_image, hr_image)
         if arch == "sr" and landmarks:
             other["landmarks"] = train_batch[3]
 
@@ -199,7 +316,7 @@ class CustomTrainClass(pl.LightningModule):
         total_loss += self.loss(
             out=out,
             hr_image=hr_image,
-            writer=writer,
+            writer=self.scalar_buffer,
             global_step=self.trainer.global_step,
             optimizer_idx=optimizer_idx,
             netD=self.netD,
@@ -221,7 +338,7 @@ class CustomTrainClass(pl.LightningModule):
             total_loss += self.loss(
                 out=out,
                 hr_image=out_teacher,
-                writer=writer,
+                writer=self.scalar_buffer,
                 global_step=self.trainer.global_step,
                 optimizer_idx=optimizer_idx,
                 netD=self.netD,
@@ -290,131 +407,130 @@ class CustomTrainClass(pl.LightningModule):
         )
 
         # Validation metrics work, but they need an origial source image.
-        if "PSNR" in cfg["train"]["metrics"]:
-            self.val_psnr.append(self.psnr_metric(hr_image, out).item())
-        if "SSIM" in cfg["train"]["metrics"]:
-            self.val_ssim.append(self.ssim_metric(hr_image, out).item())
-        if "MSE" in cfg["train"]["metrics"]:
-            self.val_mse.append(self.mse_metric(hr_image, out).item())
-        if "LPIPS" in cfg["train"]["metrics"]:
-            self.val_lpips.append(self.PerceptualLoss(out, hr_image).item())
-
-        validation_output = cfg["path"]["validation_output_path"]
-
-        # path can contain multiple files, depending on the batch_size
-        for f in path:
-            # data is processed as a batch, to save indididual files, a counter is used
-            counter = 0
-            if not os.path.exists(
-                os.path.join(
-                    validation_output, os.path.splitext(os.path.basename(f))[0]
+        # computed per image, so the mean does not depend on the batching
+        for i in range(out.shape[0]):
+            if "PSNR" in cfg["train"]["metrics"]:
+                self.val_psnr.append(
+                    self.psnr_metric(hr_image[i : i + 1], out[i : i + 1]).item()
                 )
-            ):
-                os.makedirs(
-                    os.path.join(
-                        validation_output, os.path.splitext(os.path.basename(f))[0]
-                    )
+            if "SSIM" in cfg["train"]["metrics"]:
+                self.val_ssim.append(
+                    self.ssim_metric(hr_image[i : i + 1], out[i : i + 1]).item()
                 )
-
-            filename_with_extention = os.path.basename(f)
-            filename = os.path.splitext(filename_with_extention)[0]
-
-            # currently only supports batch_size 1
-            if arch == "interpolation":
-                out = out.data.mul(255).mul(255 / 255).clamp(0, 255).round()
-                out = out.squeeze(0).permute(1, 2, 0).cpu().numpy()  # *255
-                out = out.astype(np.uint8)
-                out = cv2.cvtColor(out, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(
-                    os.path.join(
-                        validation_output,
-                        filename,
-                        str(self.trainer.global_step) + ".png",
-                    ),
-                    out,
+            if "MSE" in cfg["train"]["metrics"]:
+                self.val_mse.append(
+                    self.mse_metric(hr_image[i : i + 1], out[i : i + 1]).item()
                 )
-            else:
-                save_image(
-                    out[counter],
-                    os.path.join(
-                        validation_output,
-                        filename,
-                        str(self.trainer.global_step) + ".png",
-                    ),
+            if "LPIPS" in cfg["train"]["metrics"]:
+                self.val_lpips.append(
+                    self.PerceptualLoss(out[i : i + 1], hr_image[i : i + 1]).item()
                 )
 
-            counter += 1
+        validation_output = cfg["path"]["validation_output_path"]
+
+        # one file per image of the batch, written in the background
+        self.image_writer.write(
+            out,
+            [
+                os.path.join(
+                    validation_output,
+                    os.path.splitext(os.path.basename(f))[0],
+                    f"{self.trainer.global_step}.{self.image_writer.extension}",
+                )
+                for f in path
+            ],
+        )
 
     def on_validation_epoch_end(self):
-        self.save_checkpoint()
+        start = time.perf_counter()
 
+        metrics = dict()
         if "PSNR" in cfg["train"]["metrics"]:
             val_psnr = np.mean(self.val_psnr)
             writer.add_scalar("metrics/PSNR", val_psnr, self.trainer.global_step)
+            metrics["PSNR"] = val_psnr
             self.val_psnr = []
         if "SSIM" in cfg["train"]["metrics"]:
             val_ssim = np.mean(self.val_ssim)
             writer.add_scalar("metrics/SSIM", val_ssim, self.trainer.global_step)
+            metrics["SSIM"] = val_ssim
             self.val_ssim = []
         if "MSE" in cfg["train"]["metrics"]:
             val_mse = np.mean(self.val_mse)
             writer.add_scalar("metrics/MSE", val_mse, self.trainer.global_step)
+            metrics["MSE"] = val_mse
             self.val_mse = []
         if "LPIPS" in cfg["train"]["metrics"]:
             val_lpips = np.mean(self.val_lpips)
             writer.add_scalar("metrics/LPIPS", val_lpips, self.trainer.global_step)
+            metrics["LPIPS"] = val_lpips
             self.val_lpips = []
 
-    def save_checkpoint(self):
+        self.save_checkpoint(
+            metrics.get(cfg["datasets"]["train"]["best_checkpoint_metric"])
+        )
+
+        # the images were encoded while the checkpoint got snapshotted
+        self.image_writer.flush()
+
+        # time training waits for, the checkpoint files are still being written
+        elapsed = time.perf_counter() - start
+        print(f"Validation end took {elapsed:.2f}s.")
+        if writer is not None:
+            writer.add_scalar(
+                "timing/validation_epoch_end", elapsed, self.trainer.global_step
+            )
+
+    def on_train_end(self):
+        self.scalar_buffer.flush()
+
+    def save_checkpoint(self, metric=None):
         # todo: read from config
         self.prefix = "Checkpoint"
 
         epoch = self.trainer.current_epoch
         global_step = self.trainer.global_step
-        ckpt_path = os.path.join(
-            cfg["path"]["checkpoint_save_path"],
-            f"{self.prefix}_{epoch}_{global_step}.ckpt",
-        )
-        self.trainer.save_checkpoint(ckpt_path)
-        print("Checkpoint " + f"{self.prefix}_{epoch}_{global_step}.ckpt" + " saved.")
-
-        torch.save(
-            self.trainer.model.netG.state_dict(),
-            os.path.join(
-                cfg["path"]["checkpoint_save_path"],
-                f"{self.prefix}_{epoch}_{global_step}_G.pth",
-            ),
-        )
+        name = f"{self.prefix}_{epoch}_{global_step}"
+        base_path = os.path.join(cfg["path"]["checkpoint_save_path"], name)
+        files = [base_path + ".ckpt", base_path + "_G.pth"]
+
+        # written by the CheckpointWriter on global rank 0
+        self.trainer.save_checkpoint(files[0])
+        if not self.trainer.is_global_zero:
+            return
+
+        from checkpoint_writer import atomic_save, to_cpu
+
+        # one cpu snapshot for the weights and the CAIN trace
+        state_dict = to_cpu(self.netG.state_dict())
+        self.checkpoint_writer.submit(atomic_save, state_dict, files[1])
         if cfg["network_D"]["netD"] != None:
-            torch.save(
-                self.trainer.model.netD.state_dict(),
-                os.path.join(
-                    cfg["path"]["checkpoint_save_path"],
-                    f"{self.prefix}_{epoch}_{global_step}_D.pth",
-                ),
-            )
-            print(
-                "Checkpoint "
-                + f"{self.prefix}_{epoch}_{global_step}_G.pth"
-                + " and "
-                + f"{self.prefix}_{epoch}_{global_step}_D.pth"
-                + " saved"
-            )
-        else:
-            print("Checkpoint " + f"{self.prefix}_{epoch}_{global_step}_G.pth saved")
+            files.append(base_path + "_D.pth")
+            self.checkpoint_writer.save(self.netD.state_dict(), files[-1])
 
         if cfg["network_G"]["netG"] == "CAIN":
-            traced_model = torch.jit.trace(
-                self.trainer.model.netG,
-                (
-                    torch.randn(1, 3, 256, 256).cuda(),
-                    torch.randn(1, 3, 256, 256).cuda(),
-                ),
-            )
-            torch.jit.save(
-                traced_model,
-                os.path.join(
-                    cfg["path"]["checkpoint_save_path"],
-                    f"{self.prefix}_{epoch}_{global_step}_G.pt",
-                ),
-            )
+            # built on the cpu and traced in the writer thread, move it with .to()
+            files.append(base_path + "_G.pt")
+            self.checkpoint_writer.submit(trace_cain, state_dict, files[-1])
+
+        # the files of older checkpoints get deleted once these are written
+        self.checkpoint_writer.commit(
+            global_step, files, None if metric is None else float(metric)
+        )
+        print(
+            "Checkpoint "
+            + ", ".join(os.path.basename(f) for f in files)
+            + " is being saved."
+        )
+
+
+def trace_cain(state_dict, path):
+    from checkpoint_writer import atomic_save
+    from generator import CreateGenerator
+
+    netG = CreateGenerator(cfg["network_G"], cfg["scale"])
+    netG.load_state_dict(state_dict)
+    traced_model = torch.jit.trace(
+        netG, (torch.randn(1, 3, 256, 256), torch.randn(1, 3, 256, 256))
+    )
+    atomic_save(traced_model, path)
@@ -996,13 +996,20 @@ class ResNetPL(nn.Module):
             w.requires_grad_(False)
 
         self.weight = weight
+        self.feature_cache = None
 
-    def forward(self, pred, target):
-        pred = (pred - IMAGENET_MEAN.to(pred)) / IMAGENET_STD.to(pred)
-        target = (target - IMAGENET_MEAN.to(target)) / IMAGENET_STD.to(target)
+    def features(self, images, target=False):
+        def fn(images):
+            images = (images - IMAGENET_MEAN.to(images)) / IMAGENET_STD.to(images)
+            return self.impl(images, return_feature_maps=True)
+
+        if self.feature_cache is None:
+            return fn(images)
+        return self.feature_cache(self.impl, fn, images, target)
 
-        pred_feats = self.impl(pred, return_feature_maps=True)
-        target_feats = self.impl(target, return_feature_maps=True)
+    def forward(self, pred, target):
+        pred_feats = self.features(pred)
+        target_feats = self.features(target, target=True)
 
         result = (
             torch.stack(
@@ -143,14 +143,21 @@ class PNetLin(nn.Module):
                 self.lin6 = NetLinLayer(self.chns[6], use_dropout=use_dropout)
                 self.lins += [self.lin5, self.lin6]
 
+        self.feature_cache = None
+
+    def features(self, images, target=False):
+        def fn(images):
+            # v0.0 - original release had a bug, where input was not scaled
+            if self.version == "0.1":
+                images = self.scaling_layer(images)
+            return self.net.forward(images)
+
+        if self.feature_cache is None:
+            return fn(images)
+        return self.feature_cache(self.net, fn, images, target)
+
     def forward(self, in0, in1, retPerLayer=False):
-        # v0.0 - original release had a bug, where input was not scaled
-        in0_input, in1_input = (
-            (self.scaling_layer(in0), self.scaling_layer(in1))
-            if self.version == "0.1"
-            else (in0, in1)
-        )
-        outs0, outs1 = self.net.forward(in0_input), self.net.forward(in1_input)
+        outs0, outs1 = self.features(in0), self.features(in1, target=True)
         feats0, feats1, diffs = {}, {}, {}
 
         for kk in range(self.L):
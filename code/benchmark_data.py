@@ -0,0 +1,368 @@
+"""
+Measures how fast the configured training dataset can feed the model.
+
+Builds the DataModule like train.py and iterates train_dataloader() without a
+model (no gpu needed) for every num_workers / batch_size combination, then
+profiles single samples in the main process to show where the time goes.
+Results are printed and written as JSON, so runs on different commits can be
+compared. Run from the code folder:
+
+    python benchmark_data.py --num_workers 0 2 4 --batch_size 4 16
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+
+import cv2
+import numpy as np
+import torch
+import yaml
+from torch.utils.data import IterableDataset
+from torch.utils.data.dataloader import default_collate
+
+from data.dataloader import DataModule
+
+with open("config.yaml", "r") as ymlfile:
+    cfg = yaml.safe_load(ymlfile)
+
+
+class StageProfiler:
+    """Times calls of patched functions, grouped by stage name.
+
+    Only the outermost patched call is timed, e.g. a cv2.resize inside an
+    augmentation counts for the augmentation.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.active = False
+        self.patches = []
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def wrap(self, name, fn):
+        def wrapper(*args, **kwargs):
+            if self.active:
+                return fn(*args, **kwargs)
+            self.active = True
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+                self.active = False
+
+        return wrapper
+
+    def patch(self, owner, attr, name, fn=None):
+        original = getattr(owner, attr)
+        self.patches.append((owner, attr, original))
+        setattr(owner, attr, fn or self.wrap(name, original))
+
+    def imread(self, imread, imdecode):
+        # cv2.imread split into reading the file and decoding it
+        def wrapper(path, flags=cv2.IMREAD_COLOR):
+            if self.active:
+                return imread(path, flags)
+            self.active = True
+            try:
+                start = time.perf_counter()
+                buf = np.fromfile(path, dtype=np.uint8)
+                self.add("read", time.perf_counter() - start)
+                start = time.perf_counter()
+                img = imdecode(buf, flags)
+                self.add("decode", time.perf_counter() - start)
+            finally:
+                self.active = False
+            return img
+
+        return wrapper
+
+    def __enter__(self):
+        from data import data
+        from data.augmentation import transforms
+        from data.augmentation.kernel_bank import KernelBank
+        from data.augmentation.pipeline import AugmentationPipeline
+
+        self.patch(cv2, "imread", "read", self.imread(cv2.imread, cv2.imdecode))
+        self.patch(cv2, "imdecode", "decode")
+        self.patch(cv2, "cvtColor", "color conversion")
+        self.patch(cv2, "resize", "resize")
+        self.patch(KernelBank, "__call__", "otf downscale")
+        self.patch(transforms.ApplyDownscale, "__call__", "otf downscale")
+        self.patch(AugmentationPipeline, "__call__", "augment")
+        self.patch(data, "random_mask", "random mask")
+        return self
+
+    def __exit__(self, *exc):
+        for owner, attr, original in reversed(self.patches):
+            setattr(owner, attr, original)
+        self.patches = []
+
+
+def count_samples(batch):
+    """Batch size of a collated batch (tensor, list, tuple or dict)."""
+    if isinstance(batch, torch.Tensor):
+        return len(batch)
+    if isinstance(batch, dict):
+        batch = list(batch.values())
+    for item in batch:
+        n = count_samples(item)
+        if n:
+            return n
+    return 0
+
+
+def sample_iterator(dataset):
+    """Endless iterator over random samples of the dataset."""
+    if isinstance(dataset, IterableDataset):
+        while True:
+            yield from dataset
+    while True:
+        yield dataset[random.randrange(len(dataset))]
+
+
+def throughput(dm, num_workers, batch_size, batches, warmup):
+    """Samples/s of train_dataloader() after warmup batches."""
+    dm.num_workers = num_workers
+    dm.batch_size = batch_size
+    loader = dm.train_dataloader()
+
+    iterator = iter(loader)
+    restarts = 0
+
+    def next_batch():
+        nonlocal iterator, restarts
+        try:
+            return next(iterator)
+        except StopIteration:
+            # small dataset, the restart (and worker startup) is measured too
+            restarts += 1
+            iterator = iter(loader)
+            return next(iterator)
+
+    start = time.perf_counter()
+    for _ in range(warmup):
+        next_batch()
+    first_batches = time.perf_counter() - start
+
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(batches):
+        samples += count_samples(next_batch())
+    seconds = time.perf_counter() - start
+    del iterator
+
+    return {
+        "num_workers": num_workers,
+        "batch_size": batch_size,
+        "warmup_batches": warmup,
+        "warmup_seconds": first_batches,
+        "batches": batches,
+        "samples": samples,
+        "seconds": seconds,
+        "samples_per_s": samples / seconds,
+        "batches_per_s": batches / seconds,
+        "epoch_restarts": restarts,
+    }
+
+
+def profile(dataset, samples, batch_size):
+    """Time per stage of single samples in the main process."""
+    iterator = sample_iterator(dataset)
+    augment = getattr(dataset, "augment", None)
+    if augment is not None and hasattr(augment, "reset_stats"):
+        augment.reset_stats()
+
+    outputs = []
+    total = 0.0
+    with StageProfiler() as profiler:
+        for _ in range(samples):
+            start = time.perf_counter()
+            outputs.append(next(iterator))
+            total += time.perf_counter() - start
+
+    collate = 0.0
+    batches = [
+        outputs[i : i + batch_size]
+        for i in range(0, len(outputs) - batch_size + 1, batch_size)
+    ]
+    for batch in batches:
+        start = time.perf_counter()
+        default_collate(batch)
+        collate += time.perf_counter() - start
+
+    stages = {
+        name: {"calls": profiler.calls[name], "time": seconds}
+        for name, seconds in profiler.times.items()
+    }
+    # crop, tensor conversion and everything else inline in __getitem__
+    stages["other"] = {"calls": samples, "time": total - sum(profiler.times.values())}
+    if batches:
+        stages["collate"] = {
+            "calls": len(batches),
+            "time": collate * len(outputs) / (len(batches) * batch_size),
+        }
+    for stage in stages.values():
+        stage["ms_per_sample"] = 1000 * stage["time"] / samples
+
+    result = {
+        "samples": samples,
+        "ms_per_sample": 1000
+        * (total + stages.get("collate", {"time": 0})["time"])
+        / samples,
+        "stages": stages,
+    }
+    if augment is not None and hasattr(augment, "stats"):
+        result["augmentations"] = {
+            name: dict(stat, ms_per_sample=1000 * stat["time"] / samples)
+            for name, stat in augment.stats().items()
+        }
+    return result
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    train_cfg = cfg["datasets"]["train"]
+    parser = argparse.ArgumentParser(
+        description="Dataloader throughput of the dataset in config.yaml."
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        nargs="+",
+        default=[0, train_cfg["n_workers"]],
+        help="Worker counts to sweep.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        nargs="+",
+        default=[train_cfg["batch_size"]],
+        help="Batch sizes to sweep.",
+    )
+    parser.add_argument(
+        "--batches", type=int, default=50, help="Measured batches per run."
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=None,
+        help="Batches skipped before measuring, default: num_workers + 1.",
+    )
+    parser.add_argument(
+        "--profile_samples",
+        type=int,
+        default=100,
+        help="Samples for the per stage profile, 0 to skip it.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", type=str, default="benchmark_data.json", help="JSON result file."
+    )
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    dm = DataModule(
+        batch_size=train_cfg["batch_size"],
+        val_lr=cfg["datasets"]["val"]["dataroot_LR"],
+        val_hr=cfg["datasets"]["val"]["dataroot_HR"],
+        dir_lr=train_cfg["dataroot_LR"],
+        dir_hr=train_cfg["dataroot_HR"],
+        num_workers=train_cfg["n_workers"],
+        HR_size=train_cfg["HR_size"],
+        scale=cfg["scale"],
+        mask_dir=train_cfg["masks"],
+        canny_min=train_cfg["canny_min"],
+        canny_max=train_cfg["canny_max"],
+    )
+    dm.prepare_data()
+    dm.setup("fit")
+    dataset = dm.dataset_train
+    print(f"{train_cfg['mode']}: {type(dataset).__name__}", end="")
+    if not isinstance(dataset, IterableDataset):
+        print(f", {len(dataset)} samples", end="")
+    print()
+
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "config": {
+            "mode": train_cfg["mode"],
+            "HR_size": train_cfg["HR_size"],
+            "scale": cfg["scale"],
+            "apply_otf_downscale": train_cfg.get("apply_otf_downscale"),
+            "batch_degradation": train_cfg.get("batch_degradation"),
+            "augmentations": list(
+                getattr(dataset, "augment", None) and dataset.augment.names or []
+            ),
+        },
+        "throughput": [],
+    }
+
+    for num_workers in args.num_workers:
+        for batch_size in args.batch_size:
+            warmup = num_workers + 1 if args.warmup is None else args.warmup
+            run = throughput(dm, num_workers, batch_size, args.batches, warmup)
+            results["throughput"].append(run)
+            print(
+                f"num_workers {num_workers:>3}  batch_size {batch_size:>4}  "
+                f"{run['samples_per_s']:9.1f} samples/s  "
+                f"{run['batches_per_s']:8.2f} batches/s"
+            )
+
+    if args.profile_samples > 0:
+        result = profile(dataset, args.profile_samples, max(args.batch_size))
+        results["profile"] = result
+        print(
+            f"Per sample in the main process ({result['samples']} samples, "
+            f"{result['ms_per_sample']:.2f} ms/sample):"
+        )
+        stages = sorted(result["stages"].items(), key=lambda item: -item[1]["time"])
+        for name, stage in stages:
+            print(f"  {name:<24} {stage['ms_per_sample']:9.3f} ms")
+            if name == "augment":
+                for aug, stat in sorted(
+                    result.get("augmentations", {}).items(),
+                    key=lambda item: -item[1]["time"],
+                ):
+                    print(f"    {aug:<22} {stat['ms_per_sample']:9.3f} ms")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Background checkpoint writer with a retention policy.
+
+save_checkpoint used to block training while the Lightning checkpoint and the
+separate generator / discriminator weights got serialized and written.
+CheckpointWriter copies the state to cpu memory on the training process and
+serializes, fsyncs and renames the files in a background thread, one file
+after another. It is a Lightning CheckpointIO, so trainer.save_checkpoint
+goes through it as well (only on global rank 0); loading is passed on to the
+wrapped CheckpointIO.
+
+commit() groups the files of one validation. The groups are recorded in
+checkpoints.json in the checkpoint folder, so the retention also covers the
+checkpoints of earlier runs: the last keep_last groups and the keep_best
+groups with the best metric are kept, the files of the others get deleted.
+Files which were not committed are never deleted.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from pytorch_lightning.plugins.io import CheckpointIO, TorchCheckpointIO
+
+
+def to_cpu(obj):
+    """Copy of a nested checkpoint with every tensor copied to cpu memory."""
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == "cpu":
+            return obj.detach().clone()
+        return obj.detach().to("cpu")
+    if isinstance(obj, dict):
+        copy = obj.copy()
+        for key, value in obj.items():
+            copy[key] = to_cpu(value)
+        return copy
+    if isinstance(obj, list):
+        return [to_cpu(value) for value in obj]
+    if isinstance(obj, tuple) and not hasattr(obj, "_fields"):
+        return tuple(to_cpu(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """Writes to a temporary file, fsyncs it and renames it to path."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        if isinstance(obj, torch.jit.ScriptModule):
+            torch.jit.save(obj, f)
+        else:
+            torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # the rename itself is only durable once the folder is synced
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+class CheckpointWriter(CheckpointIO):
+    """Writes checkpoints in a background thread.
+
+    Args:
+        directory (str): checkpoint folder, holds checkpoints.json.
+        keep_last (int): groups of the last n commits which are kept, 0 keeps
+            every checkpoint.
+        keep_best (int): groups with the best metric which are kept as well,
+            only used with keep_last.
+        mode (str): "max" if a higher metric is better, "min" otherwise.
+        checkpoint_io: CheckpointIO used for loading, TorchCheckpointIO by
+            default.
+    """
+
+    def __init__(
+        self, directory, keep_last=0, keep_best=0, mode="max", checkpoint_io=None
+    ):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.checkpoint_io = checkpoint_io or TorchCheckpointIO()
+        self.record_path = os.path.join(directory, "checkpoints.json")
+
+        self._pool = None
+        self._pending = []
+
+    @classmethod
+    def from_config(cls, cfg):
+        train_cfg = cfg["datasets"]["train"]
+        return cls(
+            cfg["path"]["checkpoint_save_path"],
+            keep_last=train_cfg["keep_checkpoints"],
+            keep_best=train_cfg["keep_best_checkpoints"],
+            # lower is better for the error metrics
+            mode="min"
+            if train_cfg["best_checkpoint_metric"] in ("MSE", "LPIPS")
+            else "max",
+        )
+
+    def submit(self, fn, *args):
+        """Runs fn in the writer thread, after everything submitted before."""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(1)
+        self._pending.append(self._pool.submit(fn, *args))
+        # surface errors of finished writes early
+        while self._pending and self._pending[0].done():
+            self._pending.pop(0).result()
+
+    def save(self, obj, path):
+        """Snapshots obj to cpu memory and writes it in the background."""
+        self.submit(atomic_save, to_cpu(obj), path)
+
+    def save_checkpoint(self, checkpoint, path, storage_options=None):
+        self.save(checkpoint, path)
+
+    def load_checkpoint(self, *args, **kwargs):
+        self.flush()
+        return self.checkpoint_io.load_checkpoint(*args, **kwargs)
+
+    def remove_checkpoint(self, path):
+        self.flush()
+        self.checkpoint_io.remove_checkpoint(path)
+
+    def commit(self, step, files, metric=None):
+        """Records the files of one checkpoint once they are written and
+        deletes the checkpoints which fall out of the retention policy."""
+        self.submit(self._retain, step, list(files), metric)
+
+    def _retain(self, step, files, metric):
+        records = []
+        if os.path.isfile(self.record_path):
+            with open(self.record_path, "r") as f:
+                records = json.load(f)
+        records = [r for r in records if r["step"] != step]
+        records.append({"step": step, "files": files, "metric": metric})
+
+        if self.keep_last > 0:
+            keep = records[-self.keep_last :]
+            scored = [r for r in records if r["metric"] is not None]
+            scored.sort(key=lambda r: r["metric"], reverse=self.mode == "max")
+            keep = keep + scored[: self.keep_best]
+            for record in records:
+                if not any(record is k for k in keep):
+                    for path in record["files"]:
+                        if os.path.isfile(path):
+                            os.remove(path)
+            records = [r for r in records if any(r is k for k in keep)]
+
+        tmp_path = self.record_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(records, f, indent=1)
+        os.replace(tmp_path, self.record_path)
+
+    def flush(self):
+        """Waits for all pending writes, raises the first error."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def teardown(self):
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
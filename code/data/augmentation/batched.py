@@ -0,0 +1,418 @@
+"""
+Batched degradations for the lrhr dataloaders.
+
+Noise, camera noise, blur, JPEG and the OTF downscale are the most expensive
+augmentations of the worker pipeline. With batch_degradation enabled, DS_lrhr
+leaves them out and training_step applies them to the whole batch with torch
+ops on the device of the model, like RealESRGANDatasetApply does for
+DS_realesrgan. The random parameters are drawn per sample with get_params() of
+the matching transforms, so they follow the same distributions as in the worker
+pipeline, and images are rounded to 8 bit after every step like the uint8
+images of the workers. Unlike in the worker pipeline, they are only shuffled
+among each other and always follow the augmentations left in the workers.
+"""
+import random
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from basicsr.utils import DiffJPEG
+from basicsr.utils.img_process_util import filter2D
+
+from . import transforms
+from . import extra_functional as EF
+from . import spadd as SCIP
+from . import camera_torch
+from .kernel_bank import KernelBank
+from .pipeline import build_transforms
+
+# augmentations from config.yaml which get applied per batch
+BATCHED_TRANSFORMS = (
+    "RandomGaussianNoise",
+    "RandomPoissonNoise",
+    "RandomSpeckleNoise",
+    "RandomCompression",
+    "RandomCameraNoise",
+    "RandomAverageBlur",
+    "RandomBilateralBlur",  # built as RandomAverageBlur
+    "RandomBoxBlur",
+    "RandomGaussianBlur",
+    "RandomAnIsoBlur",
+    "RandomSincBlur",
+)
+
+INTERP_MODES = {
+    "NEAREST": "nearest",
+    "BILINEAR": "bilinear",
+    "AREA": "area",
+    "BICUBIC": "bicubic",
+    "LANCZOS": "lanczos",
+}
+
+
+def apply_probability(transform):
+    """Probability the worker pipeline applies transform with."""
+    # ApplyKernel ignores p, the worker pipeline always applies these blurs
+    if isinstance(transform, (transforms.RandomAnIsoBlur, transforms.RandomSincBlur)):
+        return 1.0
+    return transform.p
+
+
+def quantize(img):
+    # the worker pipeline returns uint8 images after every augmentation
+    return img.mul(255.0).round_().clamp_(0, 255).div_(255.0)
+
+
+def stack_kernels(kernels):
+    """Zero pads odd sized 1d or square 2d kernels to the largest one and
+    stacks them."""
+    size = max(kernel.shape[0] for kernel in kernels)
+    out = np.zeros((len(kernels),) + (size,) * kernels[0].ndim, dtype=np.float32)
+    for i, kernel in enumerate(kernels):
+        offset = (size - kernel.shape[0]) // 2
+        out[(i,) + (slice(offset, offset + kernel.shape[0]),) * kernel.ndim] = kernel
+    return torch.from_numpy(out)
+
+
+def separable_filter2D(img, kernel_x, kernel_y):
+    """filter2D() for separable kernels, two 1d convolutions instead of one 2d.
+
+    Args:
+        img (Tensor): (b, c, h, w)
+        kernel_x (Tensor): (b, kx) horizontal kernels
+        kernel_y (Tensor): (b, ky) vertical kernels
+    """
+    b, c, h, w = img.shape
+    pad_x, pad_y = kernel_x.size(-1) // 2, kernel_y.size(-1) // 2
+    img = F.pad(img, (pad_x, pad_x, pad_y, pad_y), mode="reflect")
+    img = img.view(1, b * c, h + 2 * pad_y, w + 2 * pad_x)
+    kernel_x = kernel_x.repeat_interleave(c, 0).view(b * c, 1, 1, -1)
+    kernel_y = kernel_y.repeat_interleave(c, 0).view(b * c, 1, -1, 1)
+    img = F.conv2d(img, kernel_x, groups=b * c)
+    return F.conv2d(img, kernel_y, groups=b * c).view(b, c, h, w)
+
+
+def sample_poisson(rate, threshold=30):
+    """torch.poisson, but rates above threshold are drawn from the normal
+    approximation, which is a lot faster and the same after 8 bit rounding."""
+    out = (rate + rate.sqrt() * torch.randn_like(rate)).round_().clamp_(min=0)
+    small = rate < threshold
+    if small.any():
+        out[small] = torch.poisson(rate[small])
+    return out
+
+
+def lanczos_taps(scale, a=4):
+    """8 taps of cv2.INTER_LANCZOS4 for an integer downscaling factor."""
+    # every output pixel has the same sub-pixel offset to its source pixels
+    frac = ((scale - 1) / 2) % 1
+    x = frac - np.arange(-3, 5)
+    taps = np.where(np.abs(x) < a, np.sinc(x) * np.sinc(x / a), 0)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+class BatchDegradation:
+    """Applies noise, camera noise, blur, JPEG and OTF downscaling to a batch
+    of images.
+
+    Args:
+        named_transforms (list): (name, transform) pairs from build_transforms(),
+            only used to draw parameters.
+        scale (int): OTF downscaling scale.
+        otf_filter_types (list): filters for OTF downscaling, None if the lr
+            images are loaded from disk.
+        otf_filter_probs (list): cumulative weights for otf_filter_types.
+        kernel_bank (KernelBank): kernels for the KERNEL filter.
+    """
+
+    def __init__(
+        self,
+        named_transforms,
+        scale=4,
+        otf_filter_types=None,
+        otf_filter_probs=None,
+        kernel_bank=None,
+    ):
+        self.transforms = named_transforms
+        self.scale = scale
+        self.otf_filter_types = (
+            [filter_type.upper() for filter_type in otf_filter_types]
+            if otf_filter_types
+            else None
+        )
+        self.otf_filter_probs = otf_filter_probs
+        self.kernel_bank = kernel_bank
+
+        for filter_type in self.otf_filter_types or []:
+            if filter_type != "KERNEL" and filter_type not in INTERP_MODES:
+                raise ValueError(
+                    f"{filter_type} is not a valid filter for OTF downscaling."
+                )
+        for name, transform in self.transforms:
+            if isinstance(
+                transform, transforms.RandomCompression
+            ) and transform.compression_type not in (".jpg", ".jpeg"):
+                raise ValueError(
+                    f"{name}: only jpeg compression can be applied per batch."
+                )
+            if isinstance(transform, transforms.RandomAnIsoBlur) and (
+                transform.scale > 1
+            ):
+                raise ValueError(f"{name}: scale > 1 can not be applied per batch.")
+
+        self.jpeger = DiffJPEG(differentiable=False)
+        self._device_kernels = None
+        self._lanczos = lanczos_taps(scale)
+
+    @classmethod
+    def from_config(cls, train_cfg, augcfg, scale):
+        """Creates the batched part of the augmentations enabled in config.yaml."""
+        named_transforms = [
+            (name, transform)
+            for name, transform in build_transforms(train_cfg, augcfg)
+            if name in BATCHED_TRANSFORMS
+        ]
+        kernel_bank = None
+        otf_filter_types = None
+        if train_cfg["apply_otf_downscale"] is True:
+            otf_filter_types = train_cfg["otf_filter_types"]
+            if "KERNEL" in [filter_type.upper() for filter_type in otf_filter_types]:
+                kernel_bank = KernelBank(
+                    train_cfg["kernel_path"], scale=scale, size=13, pattern="kernelgan"
+                )
+        return cls(
+            named_transforms,
+            scale=scale,
+            otf_filter_types=otf_filter_types,
+            otf_filter_probs=train_cfg["otf_filter_probs"],
+            kernel_bank=kernel_bank,
+        )
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def __call__(self, lr_image, hr_image=None):
+        """
+        Args:
+            lr_image (Tensor): (b, c, h, w) lr batch in range [0, 1], ignored
+                if OTF downscaling is used.
+            hr_image (Tensor): (b, c, h, w) hr batch in range [0, 1].
+
+        Returns:
+            Tensor: degraded lr batch on the same device.
+        """
+        with torch.no_grad():
+            if self.otf_filter_types:
+                out = self.downscale(hr_image)
+            else:
+                out = lr_image.float().clone()
+
+            # random order among each other, the augmentations which stay in the
+            # workers are applied before all of them
+            order = list(range(len(self.transforms)))
+            random.shuffle(order)
+            for i in order:
+                transform = self.transforms[i][1]
+                p = apply_probability(transform)
+                idx = [b for b in range(out.size(0)) if random.random() < p]
+                if len(idx) == out.size(0):
+                    out = quantize(self.apply(transform, out))
+                elif idx:
+                    idx = torch.tensor(idx, device=out.device)
+                    out[idx] = quantize(self.apply(transform, out[idx]))
+        return out.contiguous()
+
+    def apply(self, transform, img):
+        """Applies transform to every image of img with own random parameters."""
+        if isinstance(transform, transforms.RandomGaussianNoise):
+            return self.gaussian_noise(img, [transform.get_params() for _ in img])
+        if isinstance(transform, transforms.RandomPoissonNoise):
+            return self.poisson_noise(img, [transform.get_params() for _ in img])
+        if isinstance(transform, transforms.RandomCompression):
+            return self.compression(
+                img, [transform.get_params()["quality"] for _ in img]
+            )
+        if isinstance(transform, transforms.RandomCameraNoise):
+            return self.camera_noise(img, [transform.get_params() for _ in img])
+
+        h, w = img.shape[-2:]
+        if isinstance(transform, transforms.BlurBase):
+            kernels_y, kernels_x = zip(
+                *[self.blur_kernel(transform, h, w) for _ in img]
+            )
+            return separable_filter2D(
+                img,
+                stack_kernels(kernels_x).to(img.device, img.dtype),
+                stack_kernels(kernels_y).to(img.device, img.dtype),
+            )
+        if isinstance(transform, transforms.RandomAnIsoBlur):
+            kernels = [EF.get_gaussian_kernel(**transform.get_params()) for _ in img]
+        elif isinstance(transform, transforms.RandomSincBlur):
+            kernels = [SCIP.get_sinc_kernel(**transform.get_params()) for _ in img]
+        else:
+            raise TypeError(f"{transform} can not be applied per batch.")
+        # anisotropic and sinc kernels are not separable
+        return filter2D(img, stack_kernels(kernels).to(img.device, img.dtype))
+
+    def compression(self, img, quality):
+        if img.device.type == "cpu":
+            # without a gpu, libjpeg is a lot faster than DiffJPEG
+            images = img.mul(255).round_().byte().permute(0, 2, 3, 1).numpy()
+            out = np.stack(
+                [
+                    EF.compression(image, quality=q, compression_type=".jpg")
+                    for image, q in zip(images, quality)
+                ]
+            )
+            return torch.from_numpy(out).permute(0, 3, 1, 2).to(img.dtype) / 255.0
+        self.jpeger = self.jpeger.to(img.device)
+        return self.jpeger(
+            img, quality=torch.tensor(quality, dtype=img.dtype, device=img.device)
+        )
+
+    def camera_noise(self, img, params):
+        # one call per demosaicing method, the camera is random per image
+        out = torch.empty_like(img)
+        for dmscfn in set(p["dmscfn"] for p in params):
+            idx = [b for b, p in enumerate(params) if p["dmscfn"] == dmscfn]
+            out[idx] = camera_torch.camera_noise(
+                img[idx],
+                xyz_arr=[params[b]["xyz_arr"] for b in idx],
+                dmscfn=dmscfn,
+                rg_range=params[idx[0]]["rg_range"],
+                bg_range=params[idx[0]]["bg_range"],
+            )
+        return out
+
+    def blur_kernel(self, transform, h, w):
+        """Returns the vertical and horizontal 1d kernels of a random blur."""
+        params = transform.get_params(min(h, w))
+        kernel_size = EF.valid_kernel(h, w, params["kernel_size"])
+        if transform.kind != "gaussian":
+            # average and box blur
+            kernel = np.full(kernel_size, 1 / kernel_size)
+            return kernel, kernel
+
+        sigma_x = params["sigmaX"]
+        sigma_y = params.get("sigmaY") or sigma_x
+        size_x = size_y = kernel_size
+        if kernel_size == 0:
+            # same as cv2.GaussianBlur for uint8 images
+            size_x = max(int(round(sigma_x * 6 + 1)) | 1, 1)
+            size_y = max(int(round(sigma_y * 6 + 1)) | 1, 1)
+        return (
+            cv2.getGaussianKernel(size_y, sigma_y)[:, 0],
+            cv2.getGaussianKernel(size_x, sigma_x)[:, 0],
+        )
+
+    def gaussian_noise(self, img, params):
+        n, c, h, w = img.shape
+
+        def channel_std(std):
+            # a list is one sigma per channel (MC-AWGN)
+            if isinstance(std, list):
+                if len(std) == c:
+                    return std
+                std = std[0]
+            return [std] * c
+
+        std = torch.tensor(
+            [channel_std(p["std"]) for p in params], dtype=img.dtype, device=img.device
+        )[:, :, None, None]
+        mean = torch.tensor(
+            [p["mean"] for p in params], dtype=img.dtype, device=img.device
+        )[:, None, None, None]
+        gray = torch.tensor(
+            [p["gtype"] in ("bw", "gray") for p in params], device=img.device
+        )[:, None, None, None]
+
+        noise = torch.randn((n, c, h, w), dtype=img.dtype, device=img.device)
+        if gray.any():
+            # grayscale noise is the same for every channel
+            noise = torch.where(gray, noise[:, :1].expand_as(noise), noise)
+        noise = noise * std + mean
+        if params[0]["mode"] == "speckle":
+            return (1 + noise) * img
+        # std is in the [0, 255] range
+        return img + noise / 255.0
+
+    def poisson_noise(self, img, params):
+        n, c = img.shape[:2]
+        # number of distinct values, rounded up to the next power of 2
+        values = torch.zeros((n, 256), dtype=img.dtype, device=img.device)
+        values.scatter_(1, (img * 255).round().long().reshape(n, -1), 1)
+        vals = 2 ** torch.ceil(torch.log2(values.sum(1)))[:, None, None, None]
+
+        noise = torch.clamp(sample_poisson(img * vals) / vals, 0, 1) - img
+        gray = torch.tensor(
+            [p["gtype"] in ("bw", "gray") for p in params], device=img.device
+        )[:, None, None, None]
+        if c == 3:
+            # cv2.COLOR_BGR2GRAY weights, like EF.noise_poisson
+            weights = torch.tensor(
+                [0.114, 0.587, 0.299], dtype=img.dtype, device=img.device
+            )
+            gray_noise = (noise * weights[None, :, None, None]).sum(1, keepdim=True)
+            noise = torch.where(gray, gray_noise.expand_as(noise), noise)
+        scale = torch.tensor(
+            [p["scale"] for p in params], dtype=img.dtype, device=img.device
+        )[:, None, None, None]
+        return img + noise * scale
+
+    def downscale(self, hr_image):
+        """OTF downscaling with a random filter per image."""
+        n, c, h, w = hr_image.shape
+        if h % self.scale != 0 or w % self.scale != 0:
+            raise ValueError(
+                f"Image dimensions {(h, w)} are not evenly divisible by scale {self.scale}."
+            )
+        hr_image = hr_image.float()
+        out = hr_image.new_empty((n, c, h // self.scale, w // self.scale))
+        filter_types = random.choices(
+            self.otf_filter_types, cum_weights=self.otf_filter_probs, k=n
+        )
+        for filter_type in set(filter_types):
+            idx = torch.tensor(
+                [b for b in range(n) if filter_types[b] == filter_type],
+                device=hr_image.device,
+            )
+            out[idx] = quantize(self.resize(hr_image[idx], filter_type))
+        return out
+
+    def resize(self, img, filter_type):
+        if filter_type == "KERNEL":
+            if self._device_kernels is None or (
+                self._device_kernels.device != img.device
+            ):
+                self._device_kernels = self.kernel_bank.kernels.to(img.device)
+            kernels = self._device_kernels[
+                torch.randint(len(self.kernel_bank), (img.size(0),))
+            ]
+            # same as KernelBank, correlation and nearest neighbor subsampling
+            return filter2D(img, kernels.to(img.dtype))[
+                ..., :: self.scale, :: self.scale
+            ]
+
+        mode = INTERP_MODES[filter_type]
+        if mode == "lanczos":
+            # no lanczos in torch, separable 8 tap filter with stride scale
+            c = img.size(1)
+            taps = torch.from_numpy(self._lanczos).to(img.device, img.dtype)
+            kernel = (taps[:, None] * taps[None, :]).expand(c, 1, 8, 8)
+            start = (self.scale - 1) // 2
+            padded = F.pad(img, (3, 4, 3, 4), mode="replicate")[..., start:, start:]
+            out = F.conv2d(padded, kernel, stride=self.scale, groups=c)
+            return out[..., : img.size(2) // self.scale, : img.size(3) // self.scale]
+        if mode in ("bilinear", "bicubic"):
+            return F.interpolate(
+                img, scale_factor=1 / self.scale, mode=mode, align_corners=False
+            )
+        return F.interpolate(img, scale_factor=1 / self.scale, mode=mode)
+
+    def __repr__(self):
+        format_string = self.__class__.__name__ + "("
+        for name, _ in self.transforms:
+            format_string += "\n    {0}".format(name)
+        format_string += "\n)"
+        return format_string
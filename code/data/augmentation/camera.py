@@ -723,7 +723,8 @@ def demosaic_pixelshuffle(
         https://www.timothybrooks.com/tech/unprocessing/
     """
     shape = bayer_images.shape
-    shape = (shape[1] * 2, shape[2] * 2)
+    # cv2 dsize is (w, h)
+    shape = (shape[2] * 2, shape[1] * 2)
 
     # TODO:
     # need to test if cv2 performs similarly enough to tf align_corners=False
@@ -734,15 +735,15 @@ def demosaic_pixelshuffle(
     red = resize_bimg(red, shape)
 
     green_red = bayer_images[..., 1:2]
-    green_red = np.fliplr(green_red)  # flip left-right
+    green_red = green_red[:, :, ::-1]  # flip left-right
     green_red = resize_bimg(green_red, shape)
-    green_red = np.fliplr(green_red)  # flip left-right
+    green_red = green_red[:, :, ::-1]  # flip left-right
     green_red = space_to_depth(green_red, 2, shape=tshape, mode=psmode)
 
     green_blue = bayer_images[..., 2:3]
-    green_blue = np.flipud(green_blue)  # flip up-down
+    green_blue = green_blue[:, ::-1]  # flip up-down
     green_blue = resize_bimg(green_blue, shape)
-    green_blue = np.flipud(green_blue)  # flip up-down
+    green_blue = green_blue[:, ::-1]  # flip up-down
     green_blue = space_to_depth(green_blue, 2, shape=tshape, mode=psmode)
 
     green_at_red = (green_red[..., 0] + green_blue[..., 0]) / 2
@@ -759,9 +760,9 @@ def demosaic_pixelshuffle(
     green = depth_to_space(merge_channels(green_planes), 2, shape=tshape, mode=psmode)
 
     blue = bayer_images[..., 3:4]
-    blue = np.flipud(np.fliplr(blue))
+    blue = blue[:, ::-1, ::-1]
     blue = resize_bimg(blue, shape)
-    blue = np.flipud(np.fliplr(blue))
+    blue = blue[:, ::-1, ::-1]
 
     rgb_images = merge_channels([red, green, blue])
     return rgb_images
@@ -929,7 +930,7 @@ def unprocess(
     # randomly creates image metadata
     rgb2cam = random_ccm(xyz_arr=xyz_arr)
     cam2rgb = np.linalg.inv(rgb2cam)
-    rgb_gain, red_gain, blue_gain = random_gains()
+    rgb_gain, red_gain, blue_gain = random_gains(rg_range, bg_range)
 
     # approximately inverts global tone mapping
     image = inverse_smoothstep(image)
@@ -0,0 +1,568 @@
+"""
+Torch version of the camera.py unprocess/process pipeline.
+
+Works on (b, c, h, w) RGB batches in range [0, 1] on any device, with separate
+random camera parameters for every image. The demosaicing methods are written
+as convolutions with the kernels and border modes of the NumPy versions, so
+both give the same results up to float precision.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from . import camera
+
+
+######################
+# Convolutions
+######################
+
+
+def pad_symmetric(x, pad):
+    """Pads the last two dims like scipy.ndimage mode 'reflect', where the
+    edge pixel is repeated. pad is (left, right, top, bottom)."""
+    left, right, top, bottom = pad
+    w = x.size(-1)
+    x = torch.cat([x[..., :left].flip(-1), x, x[..., w - right :].flip(-1)], -1)
+    h = x.size(-2)
+    return torch.cat(
+        [x[..., :top, :].flip(-2), x, x[..., h - bottom :, :].flip(-2)], -2
+    )
+
+
+def convolve(x, kernels, mode="reflect"):
+    """scipy.ndimage.convolve of every channel of x with one or more 2d kernels.
+
+    Args:
+        x (Tensor): (b, c, h, w)
+        kernels (array): (kh, kw) kernel or (n, kh, kw) kernels with odd sizes.
+        mode (str): border mode, scipy 'reflect', 'mirror' or 'constant'.
+
+    Returns:
+        Tensor: (b, c * n, h, w), the n results of each channel in a row.
+    """
+    kernels = torch.as_tensor(np.asarray(kernels), dtype=x.dtype, device=x.device)
+    if kernels.dim() == 2:
+        kernels = kernels[None]
+    # convolution, not correlation
+    kernels = kernels.flip(-2, -1)[:, None]
+    b, c, h, w = x.shape
+    kh, kw = kernels.shape[-2:]
+    pad = (kw // 2, kw // 2, kh // 2, kh // 2)
+    x = x.reshape(b * c, 1, h, w)
+    if mode == "reflect":
+        x = pad_symmetric(x, pad)
+    elif mode == "mirror":
+        x = F.pad(x, pad, mode="reflect")
+    else:
+        x = F.pad(x, pad)
+    return F.conv2d(x, kernels).view(b, -1, h, w)
+
+
+def convolve1d(x, weights, dim=-1):
+    """scipy.ndimage.convolve1d with mode 'mirror' along dim (-1 or -2).
+
+    The Menon filters are short and sparse, a sum of shifted slices is
+    cheaper than conv2d for them.
+    """
+    # convolution, not correlation
+    weights = np.asarray(weights)[::-1]
+    r = len(weights) // 2
+    size = x.size(dim)
+    x = F.pad(x, (r, r, 0, 0) if dim == -1 else (0, 0, r, r), mode="reflect")
+    out = None
+    for i, weight in enumerate(weights):
+        if weight == 0:
+            continue
+        term = x.narrow(dim, i, size) * float(weight)
+        out = term if out is None else out + term
+    return out
+
+
+def _cnv_h(x, y):
+    """Helper function for horizontal convolution."""
+    return convolve1d(x, y, dim=-1)
+
+
+def _cnv_v(x, y):
+    """Helper function for vertical convolution."""
+    return convolve1d(x, y, dim=-2)
+
+
+######################
+# Mosaic and Demosaic
+######################
+
+
+def masks_CFA_Bayer(shape, pattern: str = "RGGB", device=None) -> tuple:
+    """camera.masks_CFA_Bayer() as (h, w) bool tensors."""
+    return tuple(
+        torch.from_numpy(mask).to(device)
+        for mask in camera.masks_CFA_Bayer(shape, pattern)
+    )
+
+
+def _rows_cols(mask):
+    """Rows and columns that contain mask pixels, as (h, 1) and (1, w)."""
+    return mask.any(1, keepdim=True), mask.any(0, keepdim=True)
+
+
+def make_img_even(img):
+    """Extend images in order to make them even sized (BORDER_REFLECT101)."""
+    h, w = img.shape[-2:]
+    if h % 2 or w % 2:
+        return F.pad(img, (0, w % 2, 0, h % 2), mode="reflect")
+    return img
+
+
+def mosaic(RGB):
+    """Extracts the RGGB *Bayer* planes of (b, 3, h, w) images with even h
+    and w as (b, 4, h / 2, w / 2) images."""
+    return torch.stack(
+        [
+            RGB[:, 0, 0::2, 0::2],
+            RGB[:, 1, 0::2, 1::2],
+            RGB[:, 1, 1::2, 0::2],
+            RGB[:, 2, 1::2, 1::2],
+        ],
+        1,
+    )
+
+
+def demosaic(bayer_images, dmscfn="malvar"):
+    """Demosaic method selector for (b, 4, h, w) RGGB images."""
+    if dmscfn == "pixelshuffle":
+        return demosaic_pixelshuffle(bayer_images)
+
+    fn_dict = {
+        "bilinear": demosaic_CFA_bilinear,
+        "malvar": demosaic_CFA_malvar,
+        "menon": demosaic_CFA_menon,
+    }
+    # the RGGB channels to a (b, 1, 2h, 2w) CFA, like camera.cfa_demosaic()
+    return fn_dict[dmscfn](F.pixel_shuffle(bayer_images, 2), "RGGB")
+
+
+def demosaic_CFA_bilinear(CFA, pattern: str = "RGGB"):
+    """camera.demosaic_CFA_bilinear() for (b, 1, h, w) CFA batches."""
+    R_m, G_m, B_m = masks_CFA_Bayer(CFA.shape[-2:], pattern, CFA.device)
+
+    H_G = np.asarray([[0, 1, 0], [1, 4, 1], [0, 1, 0]]) / 4
+
+    H_RB = np.asarray([[1, 2, 1], [2, 4, 2], [1, 2, 1]]) / 4
+
+    R = convolve(CFA * R_m, H_RB)
+    G = convolve(CFA * G_m, H_G)
+    B = convolve(CFA * B_m, H_RB)
+
+    return torch.cat([R, G, B], 1)
+
+
+MALVAR_KERNELS = (
+    np.asarray(
+        [
+            # GR_GB
+            [
+                [0, 0, -1, 0, 0],
+                [0, 0, 2, 0, 0],
+                [-1, 2, 4, 2, -1],
+                [0, 0, 2, 0, 0],
+                [0, 0, -1, 0, 0],
+            ],
+            # Rg_RB_Bg_BR
+            [
+                [0, 0, 0.5, 0, 0],
+                [0, -1, 0, -1, 0],
+                [-1, 4, 5, 4, -1],
+                [0, -1, 0, -1, 0],
+                [0, 0, 0.5, 0, 0],
+            ],
+            # Rg_BR_Bg_RB
+            [
+                [0, 0, -1, 0, 0],
+                [0, -1, 4, -1, 0],
+                [0.5, 0, 5, 0, 0.5],
+                [0, -1, 4, -1, 0],
+                [0, 0, -1, 0, 0],
+            ],
+            # Rb_BB_Br_RR
+            [
+                [0, 0, -1.5, 0, 0],
+                [0, 2, 0, 2, 0],
+                [-1.5, 0, 6, 0, -1.5],
+                [0, 2, 0, 2, 0],
+                [0, 0, -1.5, 0, 0],
+            ],
+        ]
+    )
+    / 8
+)
+
+
+def demosaic_CFA_malvar(CFA, pattern: str = "RGGB"):
+    """camera.demosaic_CFA_malvar() for (b, 1, h, w) CFA batches, the four
+    Malvar filters are a single convolution."""
+    R_m, G_m, B_m = masks_CFA_Bayer(CFA.shape[-2:], pattern, CFA.device)
+
+    G_RB, RBg_RBBR, RBg_BRRB, RBgr_BBRR = convolve(CFA, MALVAR_KERNELS).split(1, 1)
+
+    R = CFA * R_m
+    G = torch.where(R_m | B_m, G_RB, CFA * G_m)
+    B = CFA * B_m
+
+    R_r, R_c = _rows_cols(R_m)
+    B_r, B_c = _rows_cols(B_m)
+
+    R = torch.where(R_r & B_c, RBg_RBBR, R)
+    R = torch.where(B_r & R_c, RBg_BRRB, R)
+
+    B = torch.where(B_r & R_c, RBg_RBBR, B)
+    B = torch.where(R_r & B_c, RBg_BRRB, B)
+
+    R = torch.where(B_r & B_c, RBgr_BBRR, R)
+    B = torch.where(R_r & R_c, RBgr_BBRR, B)
+
+    return torch.cat([R, G, B], 1)
+
+
+def demosaic_CFA_menon(CFA, pattern: str = "RGGB", refining_step: bool = True):
+    """camera.demosaic_CFA_menon() (DDFAPD) for (b, 1, h, w) CFA batches."""
+    R_m, G_m, B_m = masks_CFA_Bayer(CFA.shape[-2:], pattern, CFA.device)
+
+    h_0 = np.array([0, 0.5, 0, 0.5, 0])
+    h_1 = np.array([-0.25, 0, 0.5, 0, -0.25])
+
+    R = CFA * R_m
+    G = CFA * G_m
+    B = CFA * B_m
+
+    # convolution is linear, h_0 and h_1 can be applied at once
+    G_H = torch.where(G_m, G, _cnv_h(CFA, h_0 + h_1))
+    G_V = torch.where(G_m, G, _cnv_v(CFA, h_0 + h_1))
+
+    C_H = (R - G_H) * R_m + (B - G_H) * B_m
+    C_V = (R - G_V) * R_m + (B - G_V) * B_m
+
+    D_H = (C_H - F.pad(C_H, (0, 2, 0, 0), mode="reflect")[..., 2:]).abs()
+    D_V = (C_V - F.pad(C_V, (0, 0, 0, 2), mode="reflect")[..., 2:, :]).abs()
+
+    k = np.array(
+        [
+            [0, 0, 1, 0, 1],
+            [0, 0, 0, 1, 0],
+            [0, 0, 3, 0, 3],
+            [0, 0, 0, 1, 0],
+            [0, 0, 1, 0, 1],
+        ]
+    )
+
+    d_H = convolve(D_H, k, mode="constant")
+    d_V = convolve(D_V, np.transpose(k), mode="constant")
+
+    M = d_V >= d_H
+    G = torch.where(M, G_H, G_V)
+
+    R_r, _ = _rows_cols(R_m)
+    B_r, _ = _rows_cols(B_m)
+
+    k_b = np.array([0.5, 0, 0.5])
+
+    R = torch.where(G_m & R_r, G + _cnv_h(R - G, k_b), R)
+    R = torch.where(G_m & B_r, G + _cnv_v(R - G, k_b), R)
+
+    B = torch.where(G_m & B_r, G + _cnv_h(B - G, k_b), B)
+    B = torch.where(G_m & R_r, G + _cnv_v(B - G, k_b), B)
+
+    R = torch.where(
+        B_r & B_m,
+        B + torch.where(M, _cnv_h(R - B, k_b), _cnv_v(R - B, k_b)),
+        R,
+    )
+    B = torch.where(
+        R_r & R_m,
+        R + torch.where(M, _cnv_h(B - R, k_b), _cnv_v(B - R, k_b)),
+        B,
+    )
+
+    RGB = torch.cat([R, G, B], 1)
+
+    if refining_step:
+        RGB = refining_step_menon(RGB, (R_m, G_m, B_m), M)
+
+    return RGB
+
+
+def refining_step_menon(RGB, RGB_m, M):
+    """camera.refining_step_menon() for (b, 3, h, w) batches.
+    Args
+        RGB: *RGB* colorspace batch.
+        RGB_m: *Bayer* CFA red, green and blue (h, w) masks.
+        M: (b, 1, h, w) estimation for the best directional reconstruction.
+    Returns
+        Tensor: Refined *RGB* colorspace batch.
+    """
+    R, G, B = RGB.split(1, 1)
+    R_m, G_m, B_m = RGB_m
+
+    def _cnv_hv(x, y):
+        # horizontal or vertical, the direction selected by M
+        return torch.where(M, _cnv_h(x, y), _cnv_v(x, y))
+
+    # updating of the green component
+    FIR = np.ones(3) / 3
+
+    B_G_m = _cnv_hv(B - G, FIR) * B_m
+    R_G_m = _cnv_hv(R - G, FIR) * R_m
+
+    G = torch.where(R_m, R - R_G_m, G)
+    G = torch.where(B_m, B - B_G_m, G)
+
+    # updating of the red and blue components in the green locations
+    R_r, R_c = _rows_cols(R_m)
+    B_r, B_c = _rows_cols(B_m)
+
+    R_G = R - G
+    B_G = B - G
+
+    k_b = np.array([0.5, 0, 0.5])
+
+    R_G_m = torch.where(G_m & B_r, _cnv_v(R_G, k_b), R_G_m)
+    R = torch.where(G_m & B_r, G + R_G_m, R)
+    R_G_m = torch.where(G_m & B_c, _cnv_h(R_G, k_b), R_G_m)
+    R = torch.where(G_m & B_c, G + R_G_m, R)
+
+    B_G_m = torch.where(G_m & R_r, _cnv_v(B_G, k_b), B_G_m)
+    B = torch.where(G_m & R_r, G + B_G_m, B)
+    B_G_m = torch.where(G_m & R_c, _cnv_h(B_G, k_b), B_G_m)
+    B = torch.where(G_m & R_c, G + B_G_m, B)
+
+    # updating of the red (blue) component in the blue (red) locations
+    R_B = R - B
+    R_B_m = _cnv_hv(R_B, FIR)
+    R = torch.where(B_m, B + R_B_m, R)
+    B = torch.where(R_m, R - R_B_m, B)
+
+    return torch.cat([R, G, B], 1)
+
+
+def demosaic_pixelshuffle(bayer_images):
+    """camera.demosaic_pixelshuffle() for (b, 4, h, w) RGGB batches,
+    bilinear upscaling like cv2.INTER_LINEAR and pixel (un)shuffle."""
+
+    def _resize(x):
+        return F.interpolate(x, scale_factor=2, mode="bilinear", align_corners=False)
+
+    red = _resize(bayer_images[:, 0:1])
+
+    green_red = _resize(bayer_images[:, 1:2].flip(-1)).flip(-1)
+    green_red = F.pixel_unshuffle(green_red, 2)
+
+    green_blue = _resize(bayer_images[:, 2:3].flip(-2)).flip(-2)
+    green_blue = F.pixel_unshuffle(green_blue, 2)
+
+    green_planes = [
+        (green_red[:, 0] + green_blue[:, 0]) / 2,
+        green_red[:, 1],
+        green_blue[:, 2],
+        (green_red[:, 3] + green_blue[:, 3]) / 2,
+    ]
+    green = F.pixel_shuffle(torch.stack(green_planes, 1), 2)
+
+    blue = _resize(bayer_images[:, 3:4].flip(-2, -1)).flip(-2, -1)
+
+    return torch.cat([red, green, blue], 1)
+
+
+######################
+# Unprocess
+######################
+
+
+def random_metadata(n, xyz_arr="D50", rg_range=(1.2, 2.4), bg_range=(1.2, 2.4)):
+    """Draws camera parameters and noise levels for n images with the
+    camera.py functions, in the same order as camera.unprocess().
+
+    Args:
+        xyz_arr (str or list): RGB to XYZ matrix, or one per image.
+
+    Returns:
+        dict of float64 numpy arrays, rgb2cam and cam2rgb are (n, 3, 3), the
+        gains and noise levels (n,).
+    """
+    if isinstance(xyz_arr, str):
+        xyz_arr = [xyz_arr] * n
+    metadata = {
+        key: []
+        for key in (
+            "rgb2cam",
+            "rgb_gain",
+            "red_gain",
+            "blue_gain",
+            "shot_noise",
+            "read_noise",
+        )
+    }
+    for i in range(n):
+        metadata["rgb2cam"].append(camera.random_ccm(xyz_arr=xyz_arr[i]))
+        gains = camera.random_gains(rg_range, bg_range)
+        for key, gain in zip(("rgb_gain", "red_gain", "blue_gain"), gains):
+            metadata[key].append(gain)
+    for i in range(n):
+        shot_noise, read_noise = camera.random_noise_levels()
+        metadata["shot_noise"].append(shot_noise)
+        metadata["read_noise"].append(read_noise)
+    metadata = {key: np.array(value) for key, value in metadata.items()}
+    metadata["cam2rgb"] = np.linalg.inv(metadata["rgb2cam"])
+    return metadata
+
+
+def _per_image(value, like):
+    """(b,) values as a (b, 1, 1, 1) tensor like the images."""
+    return torch.as_tensor(
+        np.asarray(value), dtype=like.dtype, device=like.device
+    ).view(-1, 1, 1, 1)
+
+
+def inverse_smoothstep(image):
+    """Approximately inverts a global tone mapping curve."""
+    image = image.clamp(0.0, 1.0)
+    return 0.5 - torch.sin(torch.asin(1.0 - 2.0 * image) / 3.0)
+
+
+def gamma_expansion(image):
+    """Converts from gamma to linear space."""
+    # clamps to prevent numerical instability of gradients near zero
+    return image.clamp(min=1e-8) ** 2.2
+
+
+def apply_ccms(images, ccms):
+    """Applies a color correction matrix to every image.
+    Args:
+        images (Tensor): (b, 3, h, w)
+        ccms (array): (b, 3, 3)
+    """
+    ccms = torch.as_tensor(np.asarray(ccms), dtype=images.dtype, device=images.device)
+    return torch.einsum("bchw,bdc->bdhw", images, ccms)
+
+
+def safe_invert_gains(image, rgb_gain, red_gain, blue_gain):
+    """Inverts gains while safely handling saturated pixels."""
+    ones = np.ones_like(red_gain)
+    gains = np.stack([1.0 / red_gain, ones, 1.0 / blue_gain], 1) / rgb_gain[:, None]
+    gains = torch.as_tensor(gains, dtype=image.dtype, device=image.device)[
+        ..., None, None
+    ]
+
+    # prevents dimming of saturated pixels by smoothly masking gains near white
+    gray = image.mean(1, keepdim=True)
+    inflection = 0.9
+    mask = ((gray - inflection).clamp(min=0.0) / (1.0 - inflection)) ** 2.0
+    safe_gains = torch.max(mask + (1.0 - mask) * gains, gains)
+    return image * safe_gains
+
+
+def unprocess(image, metadata):
+    """Unprocesses a batch from sRGB to realistic raw data.
+    Args:
+        image (Tensor): (b, 3, h, w) RGB images with even h and w.
+        metadata (dict): see random_metadata().
+    Returns:
+        Tensor: (b, 4, h / 2, w / 2) RGGB images.
+    """
+    # approximately inverts global tone mapping
+    image = inverse_smoothstep(image)
+    # inverts gamma compression
+    image = gamma_expansion(image)
+    # inverts color correction
+    image = apply_ccms(image, metadata["rgb2cam"])
+    # approximately inverts white balance and brightening
+    image = safe_invert_gains(
+        image, metadata["rgb_gain"], metadata["red_gain"], metadata["blue_gain"]
+    )
+    # clips saturated pixels
+    image = image.clamp(0.0, 1.0)
+    # applies a Bayer mosaic
+    return mosaic(image)
+
+
+def add_noise(image, shot_noise, read_noise):
+    """Adds random shot (proportional to image) and read
+    (independent) noise, with noise levels per image.
+    """
+    variance = image * _per_image(shot_noise, image) + _per_image(read_noise, image)
+    return image + torch.randn_like(image) * variance.sqrt()
+
+
+######################
+# Process
+######################
+
+
+def apply_gains(bayer_images, red_gains, blue_gains):
+    """Applies white balance gains to a batch of Bayer images."""
+    green_gains = np.ones_like(red_gains)
+    gains = np.stack([red_gains, green_gains, green_gains, blue_gains], 1)
+    gains = torch.as_tensor(gains, dtype=bayer_images.dtype, device=bayer_images.device)
+    return bayer_images * gains[..., None, None]
+
+
+def gamma_compression(images, gamma: float = 2.2):
+    """Converts from linear to gamma space."""
+    # clamps to prevent numerical instability of gradients near zero
+    return images.clamp(min=1e-8) ** (1.0 / gamma)
+
+
+def smoothstep(image):
+    """A global tone mapping curve."""
+    image = image.clamp(0.0, 1.0)
+    return 3.0 * image**2 - 2.0 * image**3
+
+
+def process(bayer_images, red_gains, blue_gains, cam2rgbs, dmscfn: str = "malvar"):
+    """Processes a batch of Bayer RGGB images into sRGB images."""
+    # white balance
+    bayer_images = apply_gains(bayer_images, red_gains, blue_gains)
+    # demosaic
+    bayer_images = bayer_images.clamp(0.0, 1.0)
+    images = demosaic(bayer_images, dmscfn)
+    # color correction
+    images = apply_ccms(images, cam2rgbs)
+    # gamma compression
+    images = images.clamp(0.0, 1.0)
+    images = gamma_compression(images)
+    return smoothstep(images)
+
+
+def camera_noise(
+    img,
+    xyz_arr="D50",
+    dmscfn: str = "malvar",
+    rg_range: tuple = (1.2, 2.4),
+    bg_range: tuple = (1.2, 2.4),
+):
+    """EF.camera_noise() for a batch, every image gets its own random camera.
+
+    Args:
+        img (Tensor): (b, 3, h, w) RGB images in range [0, 1].
+        xyz_arr (str or list): RGB to XYZ matrix, or one per image.
+
+    Returns:
+        Tensor: (b, 3, h, w) images in range [0, 1], not rounded to 8 bit.
+    """
+    h, w = img.shape[-2:]
+    img = make_img_even(img)
+    metadata = random_metadata(img.size(0), xyz_arr, rg_range, bg_range)
+
+    # unprocess images
+    deg_img = unprocess(img, metadata)
+    # add noise
+    deg_img = add_noise(deg_img, metadata["shot_noise"], metadata["read_noise"])
+    # process images
+    deg_img = process(
+        deg_img,
+        metadata["red_gain"],
+        metadata["blue_gain"],
+        metadata["cam2rgb"],
+        dmscfn=dmscfn,
+    )
+    return deg_img[..., :h, :w]
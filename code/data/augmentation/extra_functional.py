@@ -732,6 +732,52 @@ def noise_dither_bayer(img: np.ndarray) -> np.ndarray:
     return dithered
 
 
+def fs_error_diffusion(img: np.ndarray, sampling_f=1) -> np.ndarray:
+    r"""Floyd-Steinberg error diffusion of every channel of a (h, w, n) image.
+
+    Pixel (y, x) only depends on its left neighbor and the three pixels above,
+    so all pixels on the anti-diagonal t = x + 2y can be processed together.
+    The rows are skewed by 2y, which turns every anti-diagonal into a column
+    of the skewed image, and then processed column by column. The errors are
+    added neighbor by neighbor in the same order as the pixel by pixel loop and
+    truncated after every addition for integer images, so the result is
+    identical to the loop. Like the loop, the first and last column and the
+    last row are only used to diffuse errors into.
+    """
+    h, w = img.shape[:2]
+    out_dtype = img.dtype
+    truncate = np.issubdtype(out_dtype, np.integer)
+    rows = np.arange(h)[:, None]
+    cols = rows * 2 + np.arange(w)
+
+    skewed = np.zeros((h, w + 2 * h + 2) + img.shape[2:], dtype=np.float64)
+    skewed[rows, cols] = img
+
+    def diffuse(r0, r1, col, err, factor):
+        value = np.clip(skewed[r0:r1, col] + factor * err, 0, 255)
+        skewed[r0:r1, col] = np.floor(value) if truncate else value
+
+    for t in range(1, w + 2 * h):
+        # rows with a pixel in 1 <= x <= w - 2 on this anti-diagonal
+        lo = max(0, -(-(t - w + 2) // 2))
+        hi = min(h - 2, (t - 1) // 2)
+        if lo > hi:
+            continue
+        old = skewed[lo : hi + 1, t]
+        new = np.round(sampling_f * old / 255.0) * (255 / sampling_f)
+        err = old - new
+        skewed[lo : hi + 1, t] = np.floor(new) if truncate else new
+
+        # below left and right neighbors of a pixel meet on the next column,
+        # the loop adds the error from the row above first
+        diffuse(lo + 1, hi + 2, t + 1, err, 3 / 16.0)
+        diffuse(lo + 1, hi + 2, t + 2, err, 5 / 16.0)
+        diffuse(lo + 1, hi + 2, t + 3, err, 1 / 16.0)
+        diffuse(lo, hi + 1, t + 1, err, 7 / 16.0)
+
+    return skewed[rows, cols].astype(out_dtype)
+
+
 @preserve_type
 def noise_dither_fs(img: np.ndarray, sampling_f=1) -> np.ndarray:
     r"""Adds colored Floyd-Steinberg dithering noise to the image.
@@ -759,80 +805,24 @@ def noise_dither_fs(img: np.ndarray, sampling_f=1) -> np.ndarray:
               pixel[x+1][y+1] := pixel[x+1][y+1] + quant_error * 1/16
         find_closest_palette_color(oldpixel) = floor(oldpixel / 256)
 
+    The scan order is kept, but all pixels of an anti-diagonal are processed
+    at once, see fs_error_diffusion().
+
     Args:
-        img (numpy ndarray): Image to be dithered.
-        sampling_f: controls the amount of dithering
+        img (numpy ndarray): Image to be dithered, (h, w, c) or a batch of
+            images (b, h, w, c).
+        sampling_f: controls the amount of dithering (currently fixed to 1)
     Returns:
         numpy ndarray: version of the image with dithering applied.
     """
 
-    # for Floyd-Steinberg dithering noise
-    def minmax(v):
-        v = min(v, 255)
-        v = max(v, 0)
-        return v
-
-    size = img.shape
-
-    # Note: these are very slow for large images, must crop first before applying.
-    # Floyd-Steinberg
-    re_fs = img.copy()
-    sampling_f = 1
-
-    for i in range(0, size[0] - 1):
-        for j in range(1, size[1] - 1):
-            old_pixel_b = re_fs[i, j, 0]  # [y, x]
-            old_pixel_g = re_fs[i, j, 1]  # [y, x]
-            old_pixel_r = re_fs[i, j, 2]  # [y, x]
-
-            new_pixel_b = np.round(sampling_f * old_pixel_b / 255.0) * (
-                255 / sampling_f
-            )
-            new_pixel_g = np.round(sampling_f * old_pixel_g / 255.0) * (
-                255 / sampling_f
-            )
-            new_pixel_r = np.round(sampling_f * old_pixel_r / 255.0) * (
-                255 / sampling_f
-            )
-
-            re_fs[i, j, 0] = new_pixel_b
-            re_fs[i, j, 1] = new_pixel_g
-            re_fs[i, j, 2] = new_pixel_r
-
-            quant_error_b = old_pixel_b - new_pixel_b
-            quant_error_g = old_pixel_g - new_pixel_g
-            quant_error_r = old_pixel_r - new_pixel_r
-
-            re_fs[i, j + 1, 0] = minmax(re_fs[i, j + 1, 0] + (7 / 16.0) * quant_error_b)
-            re_fs[i, j + 1, 1] = minmax(re_fs[i, j + 1, 1] + (7 / 16.0) * quant_error_g)
-            re_fs[i, j + 1, 2] = minmax(re_fs[i, j + 1, 2] + (7 / 16.0) * quant_error_r)
-
-            re_fs[i + 1, j - 1, 0] = minmax(
-                re_fs[i + 1, j - 1, 0] + (3 / 16.0) * quant_error_b
-            )
-            re_fs[i + 1, j - 1, 1] = minmax(
-                re_fs[i + 1, j - 1, 1] + (3 / 16.0) * quant_error_g
-            )
-            re_fs[i + 1, j - 1, 2] = minmax(
-                re_fs[i + 1, j - 1, 2] + (3 / 16.0) * quant_error_r
-            )
-
-            re_fs[i + 1, j, 0] = minmax(re_fs[i + 1, j, 0] + (5 / 16.0) * quant_error_b)
-            re_fs[i + 1, j, 1] = minmax(re_fs[i + 1, j, 1] + (5 / 16.0) * quant_error_g)
-            re_fs[i + 1, j, 2] = minmax(re_fs[i + 1, j, 2] + (5 / 16.0) * quant_error_r)
-
-            re_fs[i + 1, j + 1, 0] = minmax(
-                re_fs[i + 1, j + 1, 0] + (1 / 16.0) * quant_error_b
-            )
-            re_fs[i + 1, j + 1, 1] = minmax(
-                re_fs[i + 1, j + 1, 1] + (1 / 16.0) * quant_error_g
-            )
-            re_fs[i + 1, j + 1, 2] = minmax(
-                re_fs[i + 1, j + 1, 2] + (1 / 16.0) * quant_error_r
-            )
-    dithered = re_fs
-
-    return dithered
+    if img.ndim == 4:
+        # batch, dither all images and channels together
+        b, h, w, c = img.shape
+        batch = img.transpose(1, 2, 0, 3).reshape(h, w, b * c)
+        dithered = fs_error_diffusion(batch)
+        return dithered.reshape(h, w, b, c).transpose(2, 0, 1, 3)
+    return fs_error_diffusion(img)
 
 
 def noise_dither_avg_bw(img: np.ndarray) -> np.ndarray:
@@ -892,34 +882,22 @@ def noise_dither_bin_bw(img: np.ndarray) -> np.ndarray:
 def noise_dither_fs_bw(img: np.ndarray, sampling_f=1) -> np.ndarray:
     """
     https://github.com/QunixZ/Image_Dithering_Implements/blob/master/HW1.py
+    Accepts (h, w), (h, w, c) or a batch of images (b, h, w, c).
     """
-
-    # for Floyd-Steinberg dithering noise
-    def minmax(v):
-        v = min(v, 255)
-        v = max(v, 0)
-        return v
+    if img.ndim == 4:
+        if img.shape[3] != 1:
+            b, h, w, c = img.shape
+            img = cv2.cvtColor(img.reshape(b * h, w, c), cv2.COLOR_RGB2GRAY)
+            img = img.reshape(b, h, w)
+        else:
+            img = img[..., 0]
+        return fs_error_diffusion(img.transpose(1, 2, 0), sampling_f).transpose(2, 0, 1)
 
     if len(img.shape) > 2 and img.shape[2] != 1:
         img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    size = img.shape
-
-    re_fs = img
-    for i in range(0, size[0] - 1):
-        for j in range(1, size[1] - 1):
-            old_pixel = re_fs[i, j]  # [y, x]
-            new_pixel = np.round(sampling_f * old_pixel / 255.0) * (255 / sampling_f)
-
-            re_fs[i, j] = new_pixel
-            quant_error = old_pixel - new_pixel
-
-            re_fs[i, j + 1] = minmax(re_fs[i, j + 1] + (7 / 16.0) * quant_error)
-            re_fs[i + 1, j - 1] = minmax(re_fs[i + 1, j - 1] + (3 / 16.0) * quant_error)
-            re_fs[i + 1, j] = minmax(re_fs[i + 1, j] + (5 / 16.0) * quant_error)
-            re_fs[i + 1, j + 1] = minmax(re_fs[i + 1, j + 1] + (1 / 16.0) * quant_error)
 
     # re_fs = cv2.cvtColor(re_fs,cv2.COLOR_GRAY2RGB)
-    return re_fs
+    return fs_error_diffusion(img, sampling_f)
 
 
 def noise_dither_random_bw(img: np.ndarray) -> np.ndarray:
@@ -1528,7 +1506,9 @@ def camera_noise(
     img = img.astype(np.float32) / 255.0
 
     # unprocess images
-    deg_img, metadata = unprocess(img, xyz_arr=xyz_arr)
+    deg_img, metadata = unprocess(
+        img, xyz_arr=xyz_arr, rg_range=rg_range, bg_range=bg_range
+    )
 
     # add noise
     shot_noise, read_noise = random_noise_levels()
@@ -0,0 +1,94 @@
+"""
+Kernel bank for OTF KERNEL downscaling.
+
+ApplyKernel globs kernel_path and loads, crops and normalizes a kernel file
+every time it is created. KernelBank does that once for every KernelGAN
+kernel and keeps the results stacked in a single shared memory tensor, so all
+dataloader workers read the same pages and picking a kernel is a random index
+instead of a file read.
+"""
+import numpy as np
+import torch
+
+from . import functional as F
+from .common import fetch_kernels, norm_kernel, pad_kernel, convolve, sample
+
+
+class KernelBank:
+    """Applies a random kernel from kernels_path and downsamples, the same as
+    ``ApplyKernel(kernels_path=..., pattern=pattern, size=size)``.
+
+    Args:
+        kernels_path (str): folder with the kernels.
+        scale (int): downsampling scale, also selects the kernel files.
+        size (int): kernels are center cropped (or padded) to size x size
+            and normalized to sum 1 again.
+        pattern (str): file structure, see fetch_kernels().
+        kformat (str): kernel file format, only npy is supported.
+        center (bool): sample the center pixel of every scale x scale patch.
+    """
+
+    def __init__(
+        self,
+        kernels_path,
+        scale=4,
+        size=13,
+        pattern="kernelgan",
+        kformat="npy",
+        center=False,
+    ):
+        if kformat != "npy":
+            raise TypeError(f"Unsupported kernel format: {kformat}")
+        paths = sorted(
+            fetch_kernels(
+                kernels_path=kernels_path, pattern=pattern, scale=scale, kformat=kformat
+            )
+        )
+        assert paths, "No kernels found for scale {} in path {}.".format(
+            scale, kernels_path
+        )
+
+        kernels = np.empty((len(paths), size, size), dtype=np.float32)
+        for i, path in enumerate(paths):
+            kernel = np.load(path)
+            if kernel.shape[0] < size:
+                kernel = pad_kernel(kernel, kernel.shape[0], size)
+            # making sure the kernel size (receptive field) is 13x13
+            # (https://arxiv.org/pdf/1909.06581.pdf)
+            kernel = F.center_crop(kernel, size)
+            # normalize to make cropped kernel sum 1 again
+            kernels[i] = norm_kernel(kernel)
+
+        # shared memory tensors are passed to spawned workers as a handle
+        # instead of being pickled and copied into every worker
+        self.kernels = torch.from_numpy(kernels).share_memory_()
+        self.paths = paths
+        self.scale = scale
+        self.center = center
+
+    def __len__(self):
+        return len(self.kernels)
+
+    def sample(self):
+        """Returns a random kernel as a read only numpy view into the bank."""
+        kernel = self.kernels[np.random.randint(0, len(self.kernels))].numpy()
+        kernel.flags.writeable = False
+        return kernel
+
+    def __call__(self, img):
+        # correlation with the kernel, same as ApplyKernel
+        out_im = convolve(img, self.sample())
+
+        if self.scale > 1:
+            # downsample according to scale
+            out_im = sample(out_im, scale=self.scale, center=self.center)
+
+        return out_im
+
+    def __repr__(self):
+        return "{}(kernels={}, scale={}, size={})".format(
+            self.__class__.__name__,
+            len(self.kernels),
+            self.scale,
+            self.kernels.shape[-1],
+        )
@@ -0,0 +1,516 @@
+"""
+Augmentation pipeline for the lrhr dataloaders.
+
+Building the transforms costs more than applying most of them, so the
+pipeline is created once per dataset instead of once per sample. Transforms
+which draw their random parameters in __init__ get them redrawn on every
+call, so every sample still gets different parameters, and the random order
+is kept by shuffling indices. Every transform keeps a call count and the
+cumulative time it took, see AugmentationPipeline.stats().
+"""
+import os
+import random
+import time
+
+import numpy as np
+
+from . import transforms
+from . import extra_functional as EF
+from . import spadd as SCIP
+
+
+def build_transforms(train_cfg, augcfg):
+    """Creates the augmentations enabled in config.yaml with the settings from
+    aug_config.yaml.
+
+    Args:
+        train_cfg (dict): ``datasets: train:`` section of config.yaml.
+        augcfg (dict): aug_config.yaml.
+
+    Returns:
+        list of (name, transform)
+    """
+    all_transforms = []
+    # ColorJitter
+    if train_cfg["ColorJitter"] is True:
+        all_transforms.append(
+            (
+                "ColorJitter",
+                transforms.ColorJitter(
+                    p=augcfg["ColorJitter"]["p"],
+                    brightness=augcfg["ColorJitter"]["brightness"],
+                    contrast=augcfg["ColorJitter"]["contrast"],
+                    saturation=augcfg["ColorJitter"]["saturation"],
+                    hue=augcfg["ColorJitter"]["hue"],
+                ),
+            )
+        )
+    # RandomGaussianNoise
+    if train_cfg["RandomGaussianNoise"] is True:
+        all_transforms.append(
+            (
+                "RandomGaussianNoise",
+                transforms.RandomGaussianNoise(
+                    p=augcfg["RandomGaussianNoise"]["p"],
+                    mean=augcfg["RandomGaussianNoise"]["mean"],
+                    var_limit=augcfg["RandomGaussianNoise"]["var_limit"],
+                    prob_color=augcfg["RandomGaussianNoise"]["prob_color"],
+                    multi=augcfg["RandomGaussianNoise"]["multi"],
+                    mode=augcfg["RandomGaussianNoise"]["mode"],
+                    sigma_calc=augcfg["RandomGaussianNoise"]["sigma_calc"],
+                ),
+            )
+        )
+    # RandomPoissonNoise
+    if train_cfg["RandomPoissonNoise"] is True:
+        all_transforms.append(
+            (
+                "RandomPoissonNoise",
+                transforms.RandomPoissonNoise(
+                    p=augcfg["RandomPoissonNoise"]["p"],
+                    prob_color=augcfg["RandomPoissonNoise"]["prob_color"],
+                    scale_range=augcfg["RandomPoissonNoise"]["scale_range"],
+                ),
+            )
+        )
+    # RandomSPNoise
+    if train_cfg["RandomSPNoise"] is True:
+        all_transforms.append(
+            (
+                "RandomSPNoise",
+                transforms.RandomSPNoise(
+                    p=augcfg["RandomSPNoise"]["p"], prob=augcfg["RandomSPNoise"]["prob"]
+                ),
+            )
+        )
+    # RandomSpeckleNoise
+    if train_cfg["RandomSpeckleNoise"] is True:
+        all_transforms.append(
+            (
+                "RandomSpeckleNoise",
+                transforms.RandomSpeckleNoise(
+                    p=augcfg["RandomSpeckleNoise"]["p"],
+                    mean=augcfg["RandomSpeckleNoise"]["mean"],
+                    var_limit=augcfg["RandomSpeckleNoise"]["var_limit"],
+                    prob_color=augcfg["RandomSpeckleNoise"]["prob_color"],
+                    sigma_calc=augcfg["RandomSpeckleNoise"]["sigma_calc"],
+                ),
+            )
+        )
+    # RandomCompression
+    if train_cfg["RandomCompression"] is True:
+        all_transforms.append(
+            (
+                "RandomCompression",
+                transforms.RandomCompression(
+                    p=augcfg["RandomCompression"]["p"],
+                    min_quality=augcfg["RandomCompression"]["min_quality"],
+                    max_quality=augcfg["RandomCompression"]["max_quality"],
+                    compression_type=augcfg["RandomCompression"]["compression_type"],
+                ),
+            )
+        )
+    # RandomAverageBlur
+    if train_cfg["RandomAverageBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomAverageBlur",
+                transforms.RandomAverageBlur(
+                    p=augcfg["RandomAverageBlur"]["p"],
+                    kernel_size=augcfg["RandomAverageBlur"]["kernel_size"],
+                ),
+            )
+        )
+    # RandomBilateralBlur
+    if train_cfg["RandomBilateralBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomBilateralBlur",
+                transforms.RandomAverageBlur(
+                    p=augcfg["RandomBilateralBlur"]["p"],
+                    kernel_size=augcfg["RandomBilateralBlur"]["kernel_size"],
+                    sigmaX=augcfg["RandomBilateralBlur"]["sigmaX"],
+                    sigmaY=augcfg["RandomBilateralBlur"]["sigmaY"],
+                ),
+            )
+        )
+    # RandomBoxBlur
+    if train_cfg["RandomBoxBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomBoxBlur",
+                transforms.RandomBoxBlur(
+                    p=augcfg["RandomBoxBlur"]["p"],
+                    kernel_size=augcfg["RandomBoxBlur"]["kernel_size"],
+                ),
+            )
+        )
+    # RandomGaussianBlur
+    if train_cfg["RandomGaussianBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomGaussianBlur",
+                transforms.RandomGaussianBlur(
+                    p=augcfg["RandomGaussianBlur"]["p"],
+                    kernel_size=augcfg["RandomGaussianBlur"]["kernel_size"],
+                    sigmaX=augcfg["RandomGaussianBlur"]["sigmaX"],
+                    sigmaY=augcfg["RandomGaussianBlur"]["sigmaY"],
+                ),
+            )
+        )
+    # RandomMedianBlur
+    if train_cfg["RandomMedianBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomMedianBlur",
+                transforms.RandomMedianBlur(
+                    p=augcfg["RandomMedianBlur"]["p"],
+                    kernel_size=augcfg["RandomMedianBlur"]["kernel_size"],
+                ),
+            )
+        )
+    # RandomMotionBlur
+    if train_cfg["RandomMotionBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomMotionBlur",
+                transforms.RandomMotionBlur(
+                    p=augcfg["RandomMotionBlur"]["p"],
+                    kernel_size=augcfg["RandomMotionBlur"]["kernel_size"],
+                    per_channel=augcfg["RandomMotionBlur"]["per_channel"],
+                ),
+            )
+        )
+    # RandomComplexMotionBlur
+    if train_cfg["RandomComplexMotionBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomComplexMotionBlur",
+                transforms.RandomComplexMotionBlur(
+                    p=augcfg["RandomComplexMotionBlur"]["p"],
+                    size=augcfg["RandomComplexMotionBlur"]["size"],
+                    complexity=augcfg["RandomComplexMotionBlur"]["complexity"],
+                    eps=augcfg["RandomComplexMotionBlur"]["eps"],
+                ),
+            )
+        )
+    # RandomAnIsoBlur
+    if train_cfg["RandomAnIsoBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomAnIsoBlur",
+                transforms.RandomAnIsoBlur(
+                    p=augcfg["RandomAnIsoBlur"]["p"],
+                    min_kernel_size=augcfg["RandomAnIsoBlur"]["min_kernel_size"],
+                    kernel_size=augcfg["RandomAnIsoBlur"]["kernel_size"],
+                    sigmaX=augcfg["RandomAnIsoBlur"]["sigmaX"],
+                    sigmaY=augcfg["RandomAnIsoBlur"]["sigmaY"],
+                    angle=augcfg["RandomAnIsoBlur"]["angle"],
+                    noise=augcfg["RandomAnIsoBlur"]["noise"],
+                    scale=augcfg["RandomAnIsoBlur"]["scale"],
+                ),
+            )
+        )
+    # RandomSincBlur
+    if train_cfg["RandomSincBlur"] is True:
+        all_transforms.append(
+            (
+                "RandomSincBlur",
+                transforms.RandomSincBlur(
+                    p=augcfg["RandomSincBlur"]["p"],
+                    min_kernel_size=augcfg["RandomSincBlur"]["min_kernel_size"],
+                    kernel_size=augcfg["RandomSincBlur"]["kernel_size"],
+                    min_cutoff=augcfg["RandomSincBlur"]["min_cutoff"],
+                ),
+            )
+        )
+    # BayerDitherNoise
+    if train_cfg["BayerDitherNoise"] is True:
+        all_transforms.append(
+            (
+                "BayerDitherNoise",
+                transforms.BayerDitherNoise(p=augcfg["BayerDitherNoise"]["p"]),
+            )
+        )
+    # FSDitherNoise
+    if train_cfg["FSDitherNoise"] is True:
+        all_transforms.append(
+            (
+                "FSDitherNoise",
+                transforms.FSDitherNoise(p=augcfg["FSDitherNoise"]["p"]),
+            )
+        )
+    # FilterMaxRGB
+    if train_cfg["FilterMaxRGB"] is True:
+        all_transforms.append(
+            (
+                "FilterMaxRGB",
+                transforms.FilterMaxRGB(p=augcfg["FilterMaxRGB"]["p"]),
+            )
+        )
+    # FilterColorBalance
+    if train_cfg["FilterColorBalance"] is True:
+        all_transforms.append(
+            (
+                "FilterColorBalance",
+                transforms.FilterColorBalance(
+                    p=augcfg["FilterColorBalance"]["p"],
+                    percent=augcfg["FilterColorBalance"]["percent"],
+                    random_params=augcfg["FilterColorBalance"]["random_params"],
+                ),
+            )
+        )
+    # FilterUnsharp
+    if train_cfg["FilterUnsharp"] is True:
+        all_transforms.append(
+            (
+                "FilterUnsharp",
+                transforms.FilterUnsharp(
+                    p=augcfg["FilterUnsharp"]["p"],
+                    blur_algo=augcfg["FilterUnsharp"]["blur_algo"],
+                    kernel_size=augcfg["FilterUnsharp"]["kernel_size"],
+                    strength=augcfg["FilterUnsharp"]["strength"],
+                    unsharp_algo=augcfg["FilterUnsharp"]["unsharp_algo"],
+                ),
+            )
+        )
+    # FilterCanny
+    if train_cfg["FilterCanny"] is True:
+        all_transforms.append(
+            (
+                "FilterCanny",
+                transforms.FilterCanny(
+                    p=augcfg["FilterCanny"]["p"],
+                    sigma=augcfg["FilterCanny"]["sigma"],
+                    bin_thresh=augcfg["FilterCanny"]["bin_thresh"],
+                    threshold=augcfg["FilterCanny"]["threshold"],
+                ),
+            )
+        )
+    # SimpleQuantize
+    if train_cfg["SimpleQuantize"] is True:
+        all_transforms.append(
+            (
+                "SimpleQuantize",
+                transforms.SimpleQuantize(
+                    p=augcfg["SimpleQuantize"]["p"],
+                    rgb_range=augcfg["SimpleQuantize"]["rgb_range"],
+                ),
+            )
+        )
+    # KMeansQuantize
+    if train_cfg["KMeansQuantize"] is True:
+        all_transforms.append(
+            (
+                "KMeansQuantize",
+                transforms.KMeansQuantize(
+                    p=augcfg["KMeansQuantize"]["p"],
+                    n_colors=augcfg["KMeansQuantize"]["n_colors"],
+                    sample_size=augcfg["KMeansQuantize"]["sample_size"],
+                    cache_size=augcfg["KMeansQuantize"]["cache_size"],
+                ),
+            )
+        )
+    # CLAHE
+    if train_cfg["CLAHE"] is True:
+        all_transforms.append(
+            (
+                "CLAHE",
+                transforms.CLAHE(
+                    p=augcfg["CLAHE"]["p"],
+                    clip_limit=augcfg["CLAHE"]["clip_limit"],
+                    tile_grid_size=augcfg["CLAHE"]["tile_grid_size"],
+                ),
+            )
+        )
+    # RandomGamma
+    if train_cfg["RandomGamma"] is True:
+        all_transforms.append(
+            (
+                "RandomGamma",
+                transforms.RandomGamma(
+                    p=augcfg["RandomGamma"]["p"],
+                    gamma_range=augcfg["RandomGamma"]["gamma_range"],
+                    gain=augcfg["RandomGamma"]["gain"],
+                ),
+            )
+        )
+    # Superpixels
+    if train_cfg["Superpixels"] is True:
+        all_transforms.append(
+            (
+                "Superpixels",
+                transforms.Superpixels(
+                    p=augcfg["Superpixels"]["p"],
+                    p_replace=augcfg["Superpixels"]["p_replace"],
+                    n_segments=augcfg["Superpixels"]["n_segments"],
+                    cs=augcfg["Superpixels"]["cs"],
+                    algo=augcfg["Superpixels"]["algo"],
+                    n_iters=augcfg["Superpixels"]["n_iters"],
+                    kind=augcfg["Superpixels"]["kind"],
+                    reduction=augcfg["Superpixels"]["reduction"],
+                    max_size=augcfg["Superpixels"]["max_size"],
+                    interpolation=augcfg["Superpixels"]["interpolation"],
+                ),
+            )
+        )
+    # RandomCameraNoise
+    if train_cfg["RandomCameraNoise"] is True:
+        all_transforms.append(
+            (
+                "RandomCameraNoise",
+                transforms.RandomCameraNoise(
+                    p=augcfg["RandomCameraNoise"]["p"],
+                    demosaic_fn=augcfg["RandomCameraNoise"]["demosaic_fn"],
+                    xyz_arr=augcfg["RandomCameraNoise"]["xyz_arr"],
+                    rg_range=augcfg["RandomCameraNoise"]["rg_range"],
+                    bg_range=augcfg["RandomCameraNoise"]["bg_range"],
+                    random_params=augcfg["RandomCameraNoise"]["random_params"],
+                ),
+            )
+        )
+
+    # BW augmentations
+    """
+    # [APPLY] BayerBWDitherNoise / 1ch output
+    all_transforms.append(transforms.BayerBWDitherNoise(p=0.5))
+    # [APPLY] BinBWDitherNoise / 1ch output
+    all_transforms.append(transforms.BinBWDitherNoise(p=0.5))
+    # FSBWDitherNoise / 1ch output
+    all_transforms.append(transforms.FSBWDitherNoise(p=0.5, samplingF = 1))
+    # [APPLY] RandomBWDitherNoise / 1ch output
+    all_transforms.append(transforms.RandomBWDitherNoise(p=0.5))
+    """
+    # [BROKEN] RandomChromaticAberration
+    # all_transforms.append(transforms.RandomChromaticAberration(p=0.5, radial_blur=True,
+    # strength=1.0, jitter=0, alpha=0.0,
+    # random_params=False))
+
+    return all_transforms
+
+
+def _redraw_params(t, img):
+    # these set self.params in __init__, draw new ones only if applied
+    if random.random() < t.p:
+        t.params = t.get_params()
+        return t.apply(img, **t.params)
+    return img
+
+
+def _redraw_complex_motion(t, img):
+    # kernel is drawn in __init__ and expensive, only draw it if applied
+    if random.random() < t.p:
+        return t.apply(img, **t.get_params())
+    return img
+
+
+def _redraw_aniso_kernel(t, img):
+    t.kernel = EF.get_gaussian_kernel(**t.get_params())
+    return t(img)
+
+
+def _redraw_sinc_kernel(t, img):
+    t.kernel = SCIP.get_sinc_kernel(**t.get_params())
+    return t(img)
+
+
+# transforms with random parameters drawn in __init__, calling them as they are
+# would apply the same parameters to every sample
+REDRAW = {
+    transforms.RandomGaussianNoise: _redraw_params,
+    transforms.RandomSpeckleNoise: _redraw_params,
+    transforms.RandomSPNoise: _redraw_params,
+    transforms.RandomCompression: _redraw_params,
+    transforms.RandomCameraNoise: _redraw_params,
+    transforms.RandomComplexMotionBlur: _redraw_complex_motion,
+    transforms.RandomAnIsoBlur: _redraw_aniso_kernel,
+    transforms.RandomSincBlur: _redraw_sinc_kernel,
+}
+
+
+class AugmentationPipeline:
+    """Applies a fixed list of transforms in random order.
+
+    Args:
+        named_transforms (list of (name, transform)): see build_transforms().
+        stats_every (int): print the timing table every n calls, 0 = never.
+            Every dataloader worker has its own pipeline and prints its own table.
+    """
+
+    def __init__(self, named_transforms, stats_every=0):
+        self.names = [name for name, _ in named_transforms]
+        self.transforms = [t for _, t in named_transforms]
+        self.apply_fns = [REDRAW.get(type(t)) for t in self.transforms]
+        self.order = list(range(len(self.transforms)))
+        self.stats_every = stats_every
+        self.reset_stats()
+
+    @classmethod
+    def from_config(cls, train_cfg, augcfg, exclude=()):
+        """Creates the pipeline from config.yaml, augmentations named in exclude
+        are left out (e.g. the ones applied per batch)."""
+        return cls(
+            [
+                (name, transform)
+                for name, transform in build_transforms(train_cfg, augcfg)
+                if name not in exclude
+            ],
+            stats_every=train_cfg["augmentation_stats_every"],
+        )
+
+    def reset_stats(self):
+        self.calls = np.zeros(len(self.transforms), dtype=np.int64)
+        self.times = np.zeros(len(self.transforms), dtype=np.float64)
+        self.samples = 0
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def __call__(self, img):
+        # randomly shuffle transforms
+        random.shuffle(self.order)
+        for i in self.order:
+            start = time.perf_counter()
+            if self.apply_fns[i] is not None:
+                img = self.apply_fns[i](self.transforms[i], img)
+            else:
+                img = self.transforms[i](img)
+            self.times[i] += time.perf_counter() - start
+            self.calls[i] += 1
+
+        self.samples += 1
+        if self.stats_every and self.samples % self.stats_every == 0:
+            print(self.format_stats())
+        return img
+
+    def stats(self):
+        """Call count, total and mean time in seconds for every transform."""
+        return {
+            name: {
+                "calls": int(calls),
+                "time": float(total),
+                "mean": float(total / calls) if calls else 0.0,
+            }
+            for name, calls, total in zip(self.names, self.calls, self.times)
+        }
+
+    def format_stats(self):
+        lines = [f"Augmentation stats (pid {os.getpid()}, {self.samples} samples):"]
+        total = self.times.sum()
+        for i in np.argsort(-self.times):
+            share = 100 * self.times[i] / total if total > 0 else 0.0
+            lines.append(
+                f"  {self.names[i]:<24} calls: {self.calls[i]:>8}  "
+                f"total: {self.times[i]:9.3f}s  "
+                f"mean: {1000 * self.times[i] / max(self.calls[i], 1):8.3f}ms  "
+                f"{share:5.1f}%"
+            )
+        return "\n".join(lines)
+
+    def __repr__(self):
+        format_string = self.__class__.__name__ + "("
+        for name in self.names:
+            format_string += "\n"
+            format_string += "    {0}".format(name)
+        format_string += "\n)"
+        return format_string
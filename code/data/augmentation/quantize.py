@@ -0,0 +1,242 @@
+"""
+Color quantization engine for KMeansQuantize, RandomQuantize and
+RandomQuantizeSOM.
+
+The reference functions (EF.kmeans_quantize, EF.km_quantize) fit the palette on
+every pixel of the image and MiniSom assigns the colors pixel by pixel. Here the
+palette is fit on a random subsample of the pixels, can be reused from a small
+cache for images with the same coarse color histogram,
+and every distinct color of the image is mapped to its nearest palette color at
+once with a KD-tree (or a precomputed lookup table).
+"""
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from sklearn import cluster
+
+from .common import MAX_VALUES_BY_DTYPE
+from .minisom import MiniSom
+
+try:
+    from scipy.spatial import cKDTree
+
+    scipy_available = True
+except ImportError:
+    scipy_available = False
+
+
+def sample_pixels(pixels: np.ndarray, sample_size=None) -> np.ndarray:
+    """Random subsample of a (n, c) pixel array, all pixels if sample_size is
+    None or larger than n."""
+    if not sample_size or sample_size >= len(pixels):
+        return pixels
+    return pixels[np.random.randint(0, len(pixels), sample_size)]
+
+
+def nearest_centroid(colors: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """Index of the nearest (euclidean) palette color for every color."""
+    colors = colors.astype(np.float32)
+    palette = palette.astype(np.float32)
+    if scipy_available:
+        return cKDTree(palette).query(colors)[1]
+
+    # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, |c|^2 does not change the argmin
+    labels = np.empty(len(colors), dtype=np.int64)
+    p2 = (palette**2).sum(1)
+    for start in range(0, len(colors), 65536):
+        chunk = colors[start : start + 65536]
+        labels[start : start + 65536] = np.argmin(p2 - 2 * chunk @ palette.T, 1)
+    return labels
+
+
+def quantize_colors(pixels: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """Labels of a (n, 3) uint8 pixel array, nearest palette color per pixel.
+
+    Natural images have far fewer distinct colors than pixels, so the lookup
+    is only done once per distinct color.
+    """
+    packed = (
+        pixels[:, 0].astype(np.int32) << 16
+        | pixels[:, 1].astype(np.int32) << 8
+        | pixels[:, 2].astype(np.int32)
+    )
+    unique, inverse = np.unique(packed, return_inverse=True)
+    colors = np.stack([unique >> 16, (unique >> 8) & 255, unique & 255], 1)
+    return nearest_centroid(colors, palette)[inverse.reshape(-1)]
+
+
+def build_lut(palette: np.ndarray, bits: int = 5) -> np.ndarray:
+    """Nearest palette color of every cell of a 2**bits per channel color grid.
+
+    Lookups with the table are O(1) per pixel, but colors inside a cell share
+    the label of the cell center, so it is not exact for small bits.
+    """
+    step = 256 >> bits
+    centers = np.arange(step // 2, 256, step)
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing="ij"), -1)
+    return nearest_centroid(grid.reshape(-1, 3), palette).astype(np.int32)
+
+
+def lut_colors(pixels: np.ndarray, lut: np.ndarray, bits: int = 5) -> np.ndarray:
+    shift = 8 - bits
+    cells = pixels.astype(np.int32) >> shift
+    return lut[(cells[:, 0] << (2 * bits)) | (cells[:, 1] << bits) | cells[:, 2]]
+
+
+class PaletteCache:
+    """LRU cache of fitted palettes.
+
+    Args:
+        maxsize (int): number of palettes to keep.
+        bins (int): histogram bins per channel for the color key.
+        precision (int): histogram shares are rounded to 1 / precision, images
+            with the same rounded histogram reuse the same palette.
+    """
+
+    def __init__(self, maxsize: int = 256, bins: int = 4, precision: int = 32):
+        self.maxsize = maxsize
+        self.bins = bins
+        self.precision = precision
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pixels: np.ndarray):
+        cells = pixels.astype(np.int32) * self.bins // 256
+        flat = (cells[:, 0] * self.bins + cells[:, 1]) * self.bins + cells[:, 2]
+        hist = np.bincount(flat, minlength=self.bins**3) / len(pixels)
+        return np.round(hist * self.precision).astype(np.uint8).tobytes()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ColorQuantizer:
+    """Quantizes RGB images to n_colors.
+
+    Args:
+        n_colors (int): number of palette colors.
+        method (str): how the palette is fit, ``kmeans`` (cv2.kmeans, like
+            EF.km_quantize), ``minibatch`` (sklearn MiniBatchKMeans, like
+            EF.kmeans_quantize) or ``som`` (MiniSom, like RandomQuantizeSOM).
+        color_space (str): ``rgb`` or ``lab``, colors are clustered and
+            assigned in this space.
+        sample_size (int): number of random pixels the palette is fit on,
+            None to fit on all pixels.
+        cache_size (int): number of palettes to reuse for images with the same
+            coarse color histogram, 0 to always fit a new palette.
+        lut_bits (int): assign labels with a 2**(3*lut_bits) lookup table
+            instead of the exact KD-tree lookup, only pays off with the cache.
+        attempts (int): cv2.kmeans attempts.
+        som_shape (tuple): (x, y) size of the SOM, x*y colors.
+        som_kwargs (dict): other MiniSom arguments.
+    """
+
+    def __init__(
+        self,
+        n_colors: int = 32,
+        method: str = "kmeans",
+        color_space: str = "rgb",
+        sample_size=4096,
+        cache_size: int = 0,
+        lut_bits=None,
+        attempts: int = 10,
+        som_shape=None,
+        som_kwargs=None,
+    ):
+        if method not in ("kmeans", "minibatch", "som"):
+            raise ValueError(f"Unknown quantization method: {method}")
+        if color_space not in ("rgb", "lab"):
+            raise ValueError(f"Unknown color space: {color_space}")
+        self.n_colors = n_colors
+        self.method = method
+        self.color_space = color_space
+        self.sample_size = sample_size
+        self.cache = PaletteCache(cache_size) if cache_size else None
+        self.lut_bits = lut_bits
+        self.attempts = attempts
+        self.som = None
+        if method == "som":
+            som_shape = som_shape or (2, max(1, n_colors // 2))
+            self.som = MiniSom(
+                x=som_shape[0], y=som_shape[1], input_len=3, **(som_kwargs or {})
+            )
+
+    def fit(self, pixels: np.ndarray) -> np.ndarray:
+        """Fits a palette on a random subsample of the (n, 3) pixels."""
+        sample = sample_pixels(pixels, self.sample_size).astype(np.float32)
+        k = min(self.n_colors, len(sample))
+        if self.method == "kmeans":
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+            _, _, centroids = cv2.kmeans(
+                sample, k, None, criteria, self.attempts, cv2.KMEANS_RANDOM_CENTERS
+            )
+            return centroids
+        if self.method == "minibatch":
+            clt = cluster.MiniBatchKMeans(n_clusters=k)
+            clt.fit(sample)
+            return clt.cluster_centers_.astype(np.float32)
+        # som, same training as RandomQuantizeSOM
+        self.som.random_weights_init(sample)
+        self.som.train_random(sample, 500, verbose=False)
+        return self.som.get_weights().reshape(-1, 3).astype(np.float32)
+
+    def palette(self, pixels: np.ndarray):
+        """Returns (palette, lut), fitted or from the cache."""
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(pixels)
+            entry = self.cache.get(key)
+            if entry is not None:
+                return entry
+        palette = self.fit(pixels)
+        lut = build_lut(palette, self.lut_bits) if self.lut_bits else None
+        if key is not None:
+            self.cache.put(key, (palette, lut))
+        return palette, lut
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            img (np.ndarray): RGB image, uint8 for the lab color space and
+                the lookup table.
+
+        Returns:
+            np.ndarray: quantized image.
+        """
+        h, w = img.shape[:2]
+        if self.color_space == "lab":
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
+        pixels = img.reshape(-1, 3)
+
+        palette, lut = self.palette(pixels)
+        if pixels.dtype != np.uint8:
+            labels = nearest_centroid(pixels, palette)
+        elif lut is not None:
+            labels = lut_colors(pixels, lut, self.lut_bits)
+        else:
+            labels = quantize_colors(pixels, palette)
+
+        if self.color_space == "lab":
+            # like EF.kmeans_quantize, lab colors are truncated to uint8
+            out = palette.astype(np.uint8)[labels].reshape(h, w, 3)
+            return cv2.cvtColor(out, cv2.COLOR_LAB2RGB)
+        img_max = MAX_VALUES_BY_DTYPE.get(img.dtype, 255)
+        out = np.clip(palette[labels], 0, img_max).reshape(h, w, 3)
+        return out.astype(img.dtype)
@@ -7,6 +7,8 @@ from os import environ as os_env
 
 os_env["FOR_DISABLE_CONSOLE_CTRL_HANDLER"] = "T"
 
+import heapq
+
 import numpy as np
 import cv2
 
@@ -365,6 +367,13 @@ def segmentation_reduction(
 # Selective Search
 #######################################
 
+# histograms use fixed value ranges, so the histograms of different regions
+# (and of merged regions) are comparable
+COLOR_BINS = 25
+TEXTURE_BINS = 10
+# local_binary_pattern(P=8) codes are in [0, 2**8)
+LBP_MAX = 2**8
+
 
 def selective_search(img, img_seg, seg_num=200, sim_strategy="CTSF", ada_regions=True):
     """Selective Search using single diversification strategy
@@ -407,50 +416,67 @@ class HierarchicalGrouping:
         sim_strategy: 'CTSF' means the similarity measure is aggregate of color
             similarity, texture similarity, size similarity, and fill similarity.
     Adapted from: https://github.com/ChenjieXu/selective_search
+
+    The statistics and the adjacency of all the initial regions are computed
+    in a single pass over the image (see region_stats() and
+    region_adjacency()) and merges only update the two merged regions and
+    their neighbors, the segmentation map is only rebuilt when img_seg is read.
     """
 
     def __init__(self, img, img_seg, sim_strategy):
         self.img = img
         self.sim_strategy = sim_strategy
-        self.img_seg = img_seg.copy()
-        self.labels = np.unique(self.img_seg).tolist()
         if not scipy_available:
             raise Exception("scipy package is not available for selective search.")
+        labels, index = np.unique(img_seg, return_inverse=True)
+        # index of every pixel into the initial labels
+        self.index = index.reshape(img_seg.shape)
+        # current label of every initial region
+        self.label_map = labels.astype(np.int64)
+        self.seg_dtype = img_seg.dtype
+        self.labels = labels.tolist()
+        self.members = {label: [k] for k, label in enumerate(self.labels)}
+
+    @property
+    def img_seg(self):
+        return self.label_map[self.index].astype(self.seg_dtype)
 
     def build_regions(self):
-        self.regions = {}
         lbp_img = generate_lbp_image(self.img)
-        for label in self.labels:
-            size = (self.img_seg == 1).sum()
-            region_slice = find_objects(self.img_seg == label)[0]
-            box = tuple(
-                [region_slice[i].start for i in (1, 0)]
-                + [region_slice[i].stop for i in (1, 0)]
-            )
-
-            mask = self.img_seg == label
-            color_hist = calculate_color_hist(mask, self.img)
-            texture_hist = calculate_texture_hist(mask, lbp_img)
-
+        sizes, boxes, color_hists, texture_hists = region_stats(
+            self.index, self.img, lbp_img
+        )
+        self.regions = {}
+        for k, label in enumerate(self.labels):
             self.regions[label] = {
-                "size": size,
-                "box": box,
-                "color_hist": color_hist,
-                "texture_hist": texture_hist,
+                "size": sizes[k],
+                "box": boxes[k],
+                "color_hist": color_hists[k],
+                "texture_hist": texture_hists[k],
             }
 
     def build_region_pairs(self):
+        self.neighbors = {label: set() for label in self.labels}
+        for a, b in zip(*region_adjacency(self.index)):
+            i, j = self.labels[a], self.labels[b]
+            self.neighbors[i].add(j)
+            self.neighbors[j].add(i)
+
         self.s = {}
+        # max-heap of (-similarity, i, j), pairs that were removed from
+        # self.s are skipped when they reach the top
+        self.heap = []
         for i in self.labels:
-            neighbors = self._find_neighbors(i)
-            for j in neighbors:
+            for j in self.neighbors[i]:
                 if i < j:
-                    self.s[(i, j)] = calculate_sim(
-                        self.regions[i],
-                        self.regions[j],
-                        self.img.size,
-                        self.sim_strategy,
-                    )
+                    self._add_pair(i, j)
+
+    def _add_pair(self, i, j):
+        sim = calculate_sim(
+            self.regions[i], self.regions[j], self.img.size, self.sim_strategy
+        )
+        self.s[(i, j)] = sim
+        heapq.heappush(self.heap, (-sim, i, j))
 
     def _find_neighbors(self, label):
         """
@@ -459,12 +485,12 @@ class HierarchicalGrouping:
         Returns:
             neighbors (list): list of labels of neighbors
         """
-        boundary = find_boundaries(self.img_seg == label, mode="outer")
-        neighbors = np.unique(self.img_seg[boundary]).tolist()
-        return neighbors
+        return sorted(self.neighbors[label])
 
     def get_highest_similarity(self):
-        return sorted(self.s.items(), key=lambda i: i[1])[-1][0]
+        while (self.heap[0][1], self.heap[0][2]) not in self.s:
+            heapq.heappop(self.heap)
+        return self.heap[0][1], self.heap[0][2]
 
     def merge_region(self, i, j):
         # generate a unique label and put in the label list
@@ -496,19 +522,25 @@ class HierarchicalGrouping:
 
         self.regions[new_label] = value
 
+        # the neighbors of the new region are the neighbors of both blobs,
+        # the old labels stay in self.neighbors for remove_similarities()
+        neighbors = (self.neighbors[i] | self.neighbors[j]) - {i, j}
+        self.neighbors[new_label] = neighbors
+        for n in neighbors:
+            self.neighbors[n] -= {i, j}
+            self.neighbors[n].add(new_label)
+
         # update segmentation mask
-        self.img_seg[self.img_seg == i] = new_label
-        self.img_seg[self.img_seg == j] = new_label
+        members = self.members.pop(i) + self.members.pop(j)
+        self.members[new_label] = members
+        self.label_map[members] = new_label
 
     def remove_similarities(self, i, j):
-        # mark keys for region pairs to be removed
-        key_to_delete = []
-        for key in self.s.keys():
-            if (i in key) or (j in key):
-                key_to_delete.append(key)
-
-        for key in key_to_delete:
-            del self.s[key]
+        # remove the region pairs of the merged blobs
+        for label in (i, j):
+            for n in self.neighbors.pop(label):
+                self.s.pop((min(label, n), max(label, n)), None)
+            del self.regions[label]
 
         # remove old labels in label list
         self.labels.remove(i)
@@ -516,13 +548,10 @@ class HierarchicalGrouping:
 
     def calculate_similarity_for_new_region(self):
         i = max(self.labels)
-        neighbors = self._find_neighbors(i)
 
-        for j in neighbors:
+        for j in self.neighbors[i]:
             # i is larger than j, so use (j,i) instead
-            self.s[(j, i)] = calculate_sim(
-                self.regions[i], self.regions[j], self.img.size, self.sim_strategy
-            )
+            self._add_pair(j, i)
 
     def is_empty(self):
         return True if not self.s.keys() else False
@@ -531,14 +560,71 @@ class HierarchicalGrouping:
         return len(self.s.keys())
 
 
+def region_stats(index, img, lbp_img):
+    """Size, bounding box, color and texture histogram of every region.
+    Args:
+        index: segmentation map with the regions numbered 0..n-1
+        img: image the color histograms are computed from
+        lbp_img: LBP image the texture histograms are computed from
+    Returns:
+        sizes (n,), boxes as (x0, y0, x1, y1) tuples, color histograms
+        (n, COLOR_BINS * channels) and texture histograms
+        (n, TEXTURE_BINS * channels).
+    """
+    n = int(index.max()) + 1
+    sizes = np.bincount(index.ravel(), minlength=n)
+    boxes = [
+        (region[1].start, region[0].start, region[1].stop, region[0].stop)
+        for region in find_objects(index + 1)
+    ]
+    color_hists = _region_hists(
+        index, img, COLOR_BINS, MAX_VALUES_BY_DTYPE.get(img.dtype, 255), n
+    )
+    texture_hists = _region_hists(index, lbp_img, TEXTURE_BINS, LBP_MAX, n)
+    return sizes, boxes, color_hists, texture_hists
+
+
+def region_adjacency(index):
+    """Pairs (a, b), a < b, of regions that are 4-connected neighbors
+    (the regions the outer boundary of a region falls in)."""
+    n = int(index.max()) + 1
+    keys = []
+    for a, b in ((index[:, :-1], index[:, 1:]), (index[:-1], index[1:])):
+        edge = a != b
+        a, b = a[edge].astype(np.int64), b[edge].astype(np.int64)
+        keys.append(np.minimum(a, b) * n + np.maximum(a, b))
+    keys = np.unique(np.concatenate(keys))
+    return keys // n, keys % n
+
+
+def _region_hists(index, img, bins, max_value, n):
+    """L1 normalized per channel histograms of all the regions with a
+    single bincount per channel."""
+    if len(img.shape) == 2:
+        img = img.reshape(img.shape[0], img.shape[1], 1)
+
+    hists = []
+    for channel in range(img.shape[2]):
+        idx = index * bins + _hist_bins(img[:, :, channel], bins, max_value)
+        hists.append(np.bincount(idx.ravel(), minlength=n * bins).reshape(n, bins))
+    hist = np.concatenate(hists, axis=1).astype(np.float64)
+    return hist / hist.sum(axis=1, keepdims=True)
+
+
+def _hist_bins(layer, bins, max_value):
+    """Bin of every value for a histogram with bins over [0, max_value]."""
+    idx = (layer.astype(np.float64) * (bins / max_value)).astype(np.int64)
+    return np.clip(idx, 0, bins - 1)
+
+
 def _calculate_color_sim(ri, rj):
     """Calculate color similarity using histogram intersection"""
-    return sum([min(a, b) for a, b in zip(ri["color_hist"], rj["color_hist"])])
+    return np.minimum(ri["color_hist"], rj["color_hist"]).sum()
 
 
 def _calculate_texture_sim(ri, rj):
     """Calculate texture similarity using histogram intersection"""
-    return sum([min(a, b) for a, b in zip(ri["texture_hist"], rj["texture_hist"])])
+    return np.minimum(ri["texture_hist"], rj["texture_hist"]).sum()
 
 
 def _calculate_size_sim(ri, rj, imsize):
@@ -566,16 +652,19 @@ def calculate_color_hist(mask, img):
     The number of channel is varied because of different
     colour spaces.
     """
-    BINS = 25
+    BINS = COLOR_BINS
     if len(img.shape) == 2:
         img = img.reshape(img.shape[0], img.shape[1], 1)
 
+    max_value = MAX_VALUES_BY_DTYPE.get(img.dtype, 255)
     channel_nums = img.shape[2]
     hist = np.array([])
 
     for channel in range(channel_nums):
         layer = img[:, :, channel][mask]
-        hist = np.concatenate([hist] + [np.histogram(layer, BINS)[0]])
+        hist = np.concatenate(
+            [hist] + [np.bincount(_hist_bins(layer, BINS, max_value), minlength=BINS)]
+        )
 
     # L1 normalize
     hist = hist / np.sum(hist)
@@ -598,13 +687,15 @@ def calculate_texture_hist(mask, lbp_img):
     """Uses LBP like AlpacaDB's implementation.
     Original paper uses to Gaussian derivatives.
     """
-    BINS = 10
+    BINS = TEXTURE_BINS
     channel_nums = lbp_img.shape[2]
     hist = np.array([])
 
     for channel in range(channel_nums):
         layer = lbp_img[:, :, channel][mask]
-        hist = np.concatenate([hist] + [np.histogram(layer, BINS)[0]])
+        hist = np.concatenate(
+            [hist] + [np.bincount(_hist_bins(layer, BINS, LBP_MAX), minlength=BINS)]
+        )
 
     # L1 normalize
     hist = hist / np.sum(hist)
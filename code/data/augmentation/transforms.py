@@ -24,7 +24,7 @@ from . import functional as F
 from . import extra_functional as EF
 from . import superpixels as SP
 from . import spadd as SCIP
-from .minisom import MiniSom
+from .quantize import ColorQuantizer
 from .common import (
     fetch_kernels,
     to_tuple,
@@ -32,7 +32,6 @@ from .common import (
     _cv2_str2interpolation,
     convolve,
     sample,
-    MAX_VALUES_BY_DTYPE,
 )
 
 
@@ -2003,19 +2002,35 @@ class RandomQuantize(RandomBase):
         img (numpy ndarray): Image to be quantized.
         num_colors: the target number of colors to quantize to
         p: probability of the image being noised. Default value is 0.5
+        sample_size: number of random pixels the palette is fit on,
+            None to fit on all pixels like EF.km_quantize
+        cache_size: number of palettes to reuse for images with a
+            similar color histogram, 0 to fit every image
     Returns:
         numpy ndarray: quantized version of the image.
     """
 
-    def __init__(self, num_colors: int = 32, p: float = 0.5):
+    def __init__(
+        self,
+        num_colors: int = 32,
+        p: float = 0.5,
+        sample_size: int = 4096,
+        cache_size: int = 0,
+    ):
         super(RandomQuantize, self).__init__(p=p)
         assert (
             isinstance(num_colors, int) and num_colors >= 0
         ), "num_colors should be a positive integrer value"
         self.num_colors = num_colors
+        self.quantizer = ColorQuantizer(
+            n_colors=num_colors,
+            method="kmeans",
+            sample_size=sample_size,
+            cache_size=cache_size,
+        )
 
     def apply(self, image, **params):
-        return EF.km_quantize(image, self.num_colors)
+        return self.quantizer(image)
 
     def __repr__(self):
         return self.__class__.__name__ + "(p={})".format(self.p)
@@ -2043,6 +2058,8 @@ class RandomQuantizeSOM(RandomBase):
         sigma: float = 1.0,
         learning_rate: float = 0.2,
         neighborhood_function: str = "bubble",
+        sample_size: int = 4096,
+        cache_size: int = 0,
     ):
         super(RandomQuantizeSOM, self).__init__(p=p)
 
@@ -2055,14 +2072,21 @@ class RandomQuantizeSOM(RandomBase):
         # x and y are the "palette" matrix shape. x=2, y=N means 2xN final colors, but
         # could reshape to something like x=3, y=3 too
         # try sigma = 0.1 , 0.2, 1.0, etc
-        self.som = MiniSom(
-            x=2,
-            y=N,
-            input_len=3,
-            sigma=sigma,
-            learning_rate=0.2,
-            neighborhood_function=neighborhood_function,
+        # the SOM weights are the palette, each pixel is assigned to the
+        # nearest weight vector (the winning neuron)
+        self.quantizer = ColorQuantizer(
+            n_colors=2 * N,
+            method="som",
+            sample_size=sample_size,
+            cache_size=cache_size,
+            som_shape=(2, N),
+            som_kwargs=dict(
+                sigma=sigma,
+                learning_rate=0.2,
+                neighborhood_function=neighborhood_function,
+            ),
         )
+        self.som = self.quantizer.som
 
     def apply(self, img, **params):
         """
@@ -2072,26 +2096,7 @@ class RandomQuantizeSOM(RandomBase):
         Returns:
             np.ndarray: Quantized image.
         """
-        img_type = img.dtype
-        img_max = MAX_VALUES_BY_DTYPE.get(img_type, 255)
-
-        # reshape image as a 2D array
-        pixels = np.reshape(img, (img.shape[0] * img.shape[1], 3))
-
-        # initialize som
-        self.som.random_weights_init(pixels)
-        # save the starting weights (the image’s initial colors)
-        starting_weights = self.som.get_weights().copy()
-        self.som.train_random(pixels, 500, verbose=False)
-        # som.train_random(pixels, 100)
-
-        # vector quantization: quantize each pixel of the image
-        # to reduce the number of colors
-        qnt = self.som.quantization(pixels)
-        clustered = np.zeros(img.shape)
-        for i, q in enumerate(qnt):
-            clustered[np.unravel_index(i, dims=(img.shape[0], img.shape[1]))] = q
-        return np.clip(clustered, 0, img_max).astype(img_type)
+        return self.quantizer(img)
 
     def __repr__(self):
         return self.__class__.__name__ + "(p={})".format(self.p)
@@ -2735,19 +2740,36 @@ class KMeansQuantize(RandomBase):
         img (numpy ndarray): Image to be quantized.
         n_colors (int): target number of colors in quantized image (1-255)
         p (float): probability of the image being noised. Default value is 0.5
+        sample_size (int): number of random pixels the palette is fit on,
+            None to fit on all pixels like EF.kmeans_quantize
+        cache_size (int): number of palettes to reuse for images with a
+            similar color histogram, 0 to fit every image
     Returns:
         numpy ndarray: quantized version of the image.
     """
 
-    def __init__(self, n_colors: int = 255, p: float = 0.5):
+    def __init__(
+        self,
+        n_colors: int = 255,
+        p: float = 0.5,
+        sample_size: int = 4096,
+        cache_size: int = 0,
+    ):
         super(KMeansQuantize, self).__init__(p=p)
         assert (
             isinstance(n_colors, int) and n_colors >= 1
         ), "n_colors should be integer >=1"
         self.n_colors = n_colors
+        self.quantizer = ColorQuantizer(
+            n_colors=n_colors,
+            method="minibatch",
+            color_space="lab",
+            sample_size=sample_size,
+            cache_size=cache_size,
+        )
 
     def apply(self, image, **params):
-        return EF.kmeans_quantize(image, self.n_colors)
+        return self.quantizer(image)
 
 
 class ApplyKernel:
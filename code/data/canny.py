@@ -0,0 +1,145 @@
+"""
+Batched Canny edges for the edge guided inpainting generators.
+
+EdgeConnect, PRVS, CTSDG and misf get a grayscale image and its Canny edges
+next to the masked image. With batch_edges enabled, the inpainting datasets
+leave them out and training_step computes them for the whole batch with the
+functions here. They follow cv2.cvtColor(RGB2GRAY) and cv2.Canny (3x3 Sobel
+with replicated borders, L1 magnitude, OpenCV's non-maximum suppression and
+8-connected hysteresis) on uint8 images, so the edges are the same as the ones
+of the datasets. An optional Gaussian blur can be applied before the Sobel
+filter, cv2.Canny does not blur.
+"""
+import torch
+import torch.nn.functional as F
+
+# tan(22.5 deg) << 15, like cv2.Canny
+TG22 = 13573
+CANNY_SHIFT = 15
+
+
+def rgb_to_grayscale(img):
+    """cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) for uint8 images.
+
+    Args:
+        img (Tensor): (b, 3, h, w) RGB in range [0, 1], 8 bit values.
+
+    Returns:
+        Tensor: (b, 1, h, w) int32 in range [0, 255].
+    """
+    rgb = img.mul(255).round_().to(torch.int32)
+    # fixed point coefficients of OpenCV, 0.299, 0.587 and 0.114 << 15
+    gray = rgb[:, 0:1] * 9798 + rgb[:, 1:2] * 19235 + rgb[:, 2:3] * 3735
+    return (gray + (1 << 14)) >> 15
+
+
+def gaussian_blur(img, sigma):
+    """Separable Gaussian blur with replicated borders, like cv2.GaussianBlur
+    with ksize (0, 0)."""
+    radius = max(1, int(round(sigma * 3)))
+    x = torch.arange(-radius, radius + 1, dtype=torch.float32, device=img.device)
+    kernel = torch.exp(-(x**2) / (2 * sigma**2))
+    kernel = kernel / kernel.sum()
+    img = F.pad(img, (radius, radius, radius, radius), mode="replicate")
+    img = F.conv2d(img, kernel.view(1, 1, 1, -1))
+    return F.conv2d(img, kernel.view(1, 1, -1, 1))
+
+
+def sobel(gray):
+    """3x3 Sobel derivatives with replicated borders, int32 (b, 1, h, w)."""
+    padded = F.pad(gray.float(), (1, 1, 1, 1), mode="replicate")
+    # [1, 2, 1] smoothing and [-1, 0, 1] derivative
+    smooth_y = padded[:, :, :-2] + 2 * padded[:, :, 1:-1] + padded[:, :, 2:]
+    dx = smooth_y[..., 2:] - smooth_y[..., :-2]
+    smooth_x = padded[..., :-2] + 2 * padded[..., 1:-1] + padded[..., 2:]
+    dy = smooth_x[:, :, 2:] - smooth_x[:, :, :-2]
+    return dx.to(torch.int32), dy.to(torch.int32)
+
+
+def _neighbor(mag, dy, dx):
+    """mag shifted so that out[y, x] = mag[y + dy, x + dx], zero outside."""
+    h, w = mag.shape[-2:]
+    padded = F.pad(mag, (1, 1, 1, 1))
+    return padded[..., 1 + dy : 1 + dy + h, 1 + dx : 1 + dx + w]
+
+
+def _dilate(mask):
+    """3x3 binary dilation of a bool (b, 1, h, w) tensor."""
+    padded = F.pad(mask, (1, 1, 1, 1))
+    rows = padded[..., :-2] | padded[..., 1:-1] | padded[..., 2:]
+    return rows[:, :, :-2] | rows[:, :, 1:-1] | rows[:, :, 2:]
+
+
+def canny(gray, low_threshold=100, high_threshold=150, sigma=None, max_iterations=None):
+    """cv2.Canny(gray, low_threshold, high_threshold) for a batch.
+
+    Args:
+        gray (Tensor): (b, 1, h, w) grayscale images in range [0, 255].
+        low_threshold, high_threshold (float): hysteresis thresholds.
+        sigma (float): optional Gaussian blur before the Sobel filter.
+        max_iterations (int): limit of the hysteresis propagation steps, None
+            propagates along the whole edge like cv2.Canny.
+
+    Returns:
+        Tensor: (b, 1, h, w) bool edges.
+    """
+    if sigma:
+        gray = gaussian_blur(gray.float(), sigma).round()
+    dx, dy = sobel(gray)
+    mag = dx.abs() + dy.abs()
+
+    low, high = int(low_threshold), int(high_threshold)
+    if low > high:
+        low, high = high, low
+
+    # gradient direction like cv2.Canny: horizontal, vertical or diagonal
+    ax = dx.abs()
+    ay = dy.abs() << CANNY_SHIFT
+    tg22x = ax * TG22
+    tg67x = tg22x + (ax << (CANNY_SHIFT + 1))
+    horizontal = ay < tg22x
+    vertical = ~horizontal & (ay > tg67x)
+    diagonal = ~horizontal & ~vertical
+    # up right / down left if the signs differ, up left / down right otherwise
+    anti = (dx ^ dy) < 0
+
+    # the magnitude has to be larger than the first neighbor and at least as
+    # large as the second one (strictly larger for diagonals)
+    is_max = horizontal & (mag > _neighbor(mag, 0, -1)) & (mag >= _neighbor(mag, 0, 1))
+    is_max |= vertical & (mag > _neighbor(mag, -1, 0)) & (mag >= _neighbor(mag, 1, 0))
+    is_max |= (
+        diagonal & anti & (mag > _neighbor(mag, -1, 1)) & (mag > _neighbor(mag, 1, -1))
+    )
+    is_max |= (
+        diagonal & ~anti & (mag > _neighbor(mag, -1, -1)) & (mag > _neighbor(mag, 1, 1))
+    )
+    candidates = is_max & (mag > low)
+    edges = candidates & (mag > high)
+
+    # hysteresis, grow the strong edges into 8-connected weak ones, the
+    # strong edges are weak ones too
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        previous = edges
+        # only sync for the convergence check every few steps
+        for _ in range(8):
+            edges = _dilate(edges) & candidates
+        iteration += 8
+        if torch.equal(previous, edges):
+            break
+    return edges
+
+
+def batch_edges(img, low_threshold=100, high_threshold=150, sigma=None):
+    """Grayscale and edge inputs of the inpainting datasets for a batch.
+
+    Args:
+        img (Tensor): (b, 3, h, w) RGB in range [0, 1].
+
+    Returns:
+        (edges, grayscale): (b, 1, h, w) float tensors, edges 0 or 255 and
+        grayscale in range [0, 1], like DS_inpaint.
+    """
+    gray = rgb_to_grayscale(img)
+    edges = canny(gray, low_threshold, high_threshold, sigma)
+    return edges.to(img.dtype) * 255, gray.to(img.dtype) / 255
@@ -0,0 +1,132 @@
+"""
+Progressive patch size curriculum.
+
+Training starts on small crops with large batches and moves to larger crops
+with smaller batches, so early steps see more samples per second while the
+pixels per batch (and about the memory) stay the same. CurriculumBatchSampler
+picks the patch and batch size of every batch from the current global_step
+and passes the patch size to the dataloader workers with the sample indices,
+``(index, patch_size)``, so a batch which was prefetched before a stage change
+is still cropped consistently. The datasets read it with patch_index().
+"""
+import math
+
+from torch.utils.data import BatchSampler
+
+
+def patch_index(index, patch_size):
+    """(index, patch size) of a dataset index, the patch size is the default
+    unless CurriculumBatchSampler passed one."""
+    if isinstance(index, (tuple, list)):
+        return int(index[0]), int(index[1])
+    return index, patch_size
+
+
+class PatchCurriculum:
+    """Patch and batch size for every training step.
+
+    Args:
+        stages (list): ``[step, patch_size]`` or ``[step, patch_size,
+            batch_size]`` entries, a stage is used from its step on.
+        hr_size (int): HR_size, the largest patch size.
+        batch_size (int): batch size at hr_size, stages without a batch size
+            use ``batch_size * (hr_size / patch_size) ** 2``.
+        multiple (int): patch sizes have to be a multiple of this, e.g. the
+            scale for lr crops.
+    """
+
+    def __init__(self, stages, hr_size, batch_size, multiple=1):
+        self.stages = []
+        for stage in sorted(stages, key=lambda s: s[0]):
+            step, patch_size = int(stage[0]), int(stage[1])
+            if patch_size > hr_size or patch_size % multiple != 0:
+                raise ValueError(
+                    f"Curriculum patch size {patch_size} has to be at most HR_size "
+                    f"and a multiple of {multiple}."
+                )
+            if len(stage) > 2:
+                stage_batch = int(stage[2])
+            else:
+                # same pixels per batch as batch_size at HR_size
+                stage_batch = max(
+                    1, math.floor(batch_size * (hr_size / patch_size) ** 2)
+                )
+            self.stages.append((step, patch_size, stage_batch))
+        if not self.stages or self.stages[0][0] > 0:
+            self.stages.insert(0, (0, hr_size, batch_size))
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Curriculum of config.yaml, None if patch_curriculum is empty."""
+        train_cfg = cfg["datasets"]["train"]
+        if not train_cfg["patch_curriculum"]:
+            return None
+        return cls(
+            train_cfg["patch_curriculum"],
+            train_cfg["HR_size"],
+            train_cfg["batch_size"],
+            multiple=cfg["scale"],
+        )
+
+    def __call__(self, step):
+        """(patch size, batch size) at a global step."""
+        current = self.stages[0]
+        for stage in self.stages:
+            if stage[0] > step:
+                break
+            current = stage
+        return current[1], current[2]
+
+
+class CurriculumBatchSampler(BatchSampler):
+    """Batches with the batch size of the current curriculum stage.
+
+    Yields lists of ``(index, patch_size)``. Lightning swaps the sampler for a
+    DistributedSampler with DDP, every rank sees the same global_step and
+    builds the same batch sizes.
+
+    Args:
+        sampler: index sampler, e.g. SequentialSampler.
+        curriculum (PatchCurriculum): stages.
+        step_fn: returns the current global_step.
+        drop_last (bool): drop the last incomplete batch.
+    """
+
+    def __init__(self, sampler, curriculum, step_fn, drop_last=False):
+        self.sampler = sampler
+        self.curriculum = curriculum
+        self.step_fn = step_fn
+        self.drop_last = drop_last
+        self.stage = None
+
+    @property
+    def batch_size(self):
+        return self.curriculum(self.step_fn())[1]
+
+    def __iter__(self):
+        batch, patch_size, batch_size = [], None, None
+        for index in self.sampler:
+            if not batch:
+                stage = self.curriculum(self.step_fn())
+                if stage != self.stage:
+                    print(f"Curriculum: patch size {stage[0]}, batch size {stage[1]}")
+                    self.stage = stage
+                patch_size, batch_size = stage
+            batch.append((index, patch_size))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        # batches of an epoch starting now, one step per batch
+        remaining, step, count = len(self.sampler), self.step_fn(), 0
+        while remaining > 0:
+            batch_size = self.curriculum(step)[1]
+            if remaining < batch_size and self.drop_last:
+                break
+            remaining -= batch_size
+            step += 1
+            count += 1
+        return count
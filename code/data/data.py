@@ -4,9 +4,16 @@ import cv2
 import numpy as np
 from PIL import Image
 import torch
-from torch.utils.data import Dataset
-import glob
+from torch.utils.data import Dataset, IterableDataset
 from .augmentation import transforms
+from .augmentation.pipeline import AugmentationPipeline
+from .augmentation.kernel_bank import KernelBank
+from .manifest import load_manifest, IMG_EXTENSIONS, MASK_EXTENSIONS
+from .mask_bank import load_mask_bank
+from .shards import ShardReader
+from .tfrecord_stream import TFRecordStream
+from .render_cache import load_render_cache, render_svg
+from .curriculum import patch_index
 import random
 
 INTERP_MAP = {
@@ -22,21 +29,82 @@ with open("config.yaml", "r") as ymlfile:
 with open("aug_config.yaml", "r") as ymlfile:
     augcfg = yaml.safe_load(ymlfile)
 
-if (
-    cfg["datasets"]["train"]["mode"] == "DS_inpaint_TF"
-    or cfg["datasets"]["train"]["mode"] == "DS_svg_TF"
-):
-    from tfrecord.torch.dataset import TFRecordDataset
+if cfg["datasets"]["train"]["mode"] == "DS_inpaint_TF":
     import io
 
-if cfg["datasets"]["train"]["mode"] == "DS_svg_TF":
-    from cairosvg import svg2png
-    from io import BytesIO
+if cfg["datasets"]["train"]["batch_degradation"] is True:
+    from .augmentation.batched import BATCHED_TRANSFORMS
 
 if cfg["datasets"]["train"]["loading_backend"] == "PIL":
     import pillow_avif
 
 
+def get_manifest(root, lr_root=None, extensions=IMG_EXTENSIONS):
+    # indexed once and stored in manifest_dir, later runs only rescan changed folders
+    return load_manifest(
+        root,
+        lr_root=lr_root,
+        extensions=extensions,
+        manifest_dir=cfg["path"]["manifest_dir"],
+    )
+
+
+def get_mask_bank(root, size, extensions=MASK_EXTENSIONS):
+    # decoded, resized and bit-packed once, memory mapped by every worker
+    return load_mask_bank(
+        root, size, extensions=extensions, manifest_dir=cfg["path"]["manifest_dir"]
+    )
+
+
+def get_tfrecord_stream(path, return_index=False):
+    # record indices are built once and stored in manifest_dir
+    return TFRecordStream(
+        path,
+        index_dir=cfg["path"]["manifest_dir"],
+        shuffle_buffer=cfg["datasets"]["train"]["shuffle_buffer"],
+        return_index=return_index,
+    )
+
+
+def get_render_cache(stream):
+    # rendered svgs of every record, memory mapped by every worker
+    return load_render_cache(stream, manifest_dir=cfg["path"]["manifest_dir"])
+
+
+def get_augmentation():
+    # built once, parameters and order are still random for every sample
+    train_cfg = cfg["datasets"]["train"]
+    if train_cfg["batch_degradation"] is not True:
+        return AugmentationPipeline.from_config(train_cfg, augcfg)
+
+    # noise, blur, jpeg and OTF downscaling are applied per batch in training_step
+    augment = AugmentationPipeline.from_config(
+        train_cfg, augcfg, exclude=BATCHED_TRANSFORMS
+    )
+    if train_cfg["apply_otf_downscale"] is True and len(augment) > 0:
+        raise ValueError(
+            "batch_degradation with apply_otf_downscale only creates the lr image in "
+            f"training_step, these augmentations can not be used: {augment.names}"
+        )
+    return augment
+
+
+def get_kernel_bank():
+    # kernels are loaded once and shared with the workers, None if KERNEL is unused
+    train_cfg = cfg["datasets"]["train"]
+    if (
+        train_cfg["apply_otf_downscale"] is not True
+        # batch_degradation downscales in training_step with its own bank
+        or train_cfg["batch_degradation"] is True
+        or "KERNEL"
+        not in [filter_type.upper() for filter_type in train_cfg["otf_filter_types"]]
+    ):
+        return None
+    return KernelBank(
+        train_cfg["kernel_path"], scale=cfg["scale"], size=13, pattern="kernelgan"
+    )
+
+
 def random_mask(
     height=256,
     width=256,
@@ -83,53 +151,70 @@ def random_mask(
 
 class DS_inpaint(Dataset):
     def __init__(self, root, mask_dir, hr_size=256):
-        self.samples = []
-        for root, _, fnames in sorted(os.walk(root)):
-            for fname in sorted(fnames):
-                path = os.path.join(root, fname)
-                if ".png" in path or ".jpg" in path or ".webp" in path:
-                    self.samples.append(path)
+        self.samples = get_manifest(root)
         if len(self.samples) == 0:
             raise RuntimeError("Found 0 files in subfolders of: " + root)
 
         self.mask_dir = mask_dir
-        self.files = glob.glob(self.mask_dir + "/**/*.png", recursive=True)
-        files_jpg = glob.glob(self.mask_dir + "/**/*.jpg", recursive=True)
-        self.files.extend(files_jpg)
-
         self.HR_size = hr_size
+        self.masks = get_mask_bank(self.mask_dir, self.HR_size)
 
     def __len__(self):
         return len(self.samples)
 
     def __getitem__(self, index):
+        # the patch size curriculum passes a smaller size with the index
+        index, hr_size = patch_index(index, self.HR_size)
         sample_path = self.samples[index]
         sample = cv2.imread(sample_path)
         sample = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
 
-        # if edges are required
-        if cfg["network_G"]["netG"] in ("EdgeConnect", "PRVS", "CTSDG", "misf"):
+        # checking for hr_size limitation
+        if sample.shape[0] > hr_size or sample.shape[1] > hr_size:
+            # image too big, random crop
+            random_pos1 = random.randint(0, sample.shape[0] - hr_size)
+            random_pos2 = random.randint(0, sample.shape[1] - hr_size)
+            sample = sample[
+                random_pos1 : random_pos1 + hr_size,
+                random_pos2 : random_pos2 + hr_size,
+            ]
+
+        # if edges are required, batch_edges computes them in training_step
+        if (
+            cfg["network_G"]["netG"] in ("EdgeConnect", "PRVS", "CTSDG", "misf")
+            and cfg["datasets"]["train"]["batch_edges"] is not True
+        ):
             grayscale = cv2.cvtColor(np.array(sample), cv2.COLOR_RGB2GRAY)
-            edges = cv2.Canny(grayscale, 100, 150)
+            edges = cv2.Canny(
+                grayscale,
+                cfg["datasets"]["train"]["canny_min"],
+                cfg["datasets"]["train"]["canny_max"],
+            )
             grayscale = torch.from_numpy(grayscale).unsqueeze(0) / 255
             edges = torch.from_numpy(edges).unsqueeze(0).type(torch.float)
 
+        mask_seed = -1
         if random.uniform(0, 1) < 0.5:
             # generating mask automatically with 50% chance
-            mask = random_mask(height=self.HR_size, width=self.HR_size)
-            mask = torch.from_numpy(mask)
+            if cfg["datasets"]["train"]["batch_masks"] is True:
+                # drawn from the seed for the whole batch in training_step
+                mask_seed = random.getrandbits(63)
+                mask = torch.ones(1, hr_size, hr_size)
+            else:
+                mask = random_mask(height=hr_size, width=hr_size)
+                mask = torch.from_numpy(mask)
 
         else:
-            # load random mask from folder
-            mask = cv2.imread(
-                random.choice([x for x in self.files]), cv2.IMREAD_UNCHANGED
-            )
-            mask = cv2.resize(
-                mask, (self.HR_size, self.HR_size), interpolation=cv2.INTER_NEAREST
-            )
-
-            # since white = masked area, invert mask
-            mask = 255 - mask
+            # random mask from the mask bank, already inverted (1 = keep)
+            mask = self.masks[random.randrange(len(self.masks))]
+            if hr_size < self.HR_size:
+                # random crop of the mask for the curriculum patch size
+                random_pos1 = random.randint(0, self.HR_size - hr_size)
+                random_pos2 = random.randint(0, self.HR_size - hr_size)
+                mask = mask[
+                    random_pos1 : random_pos1 + hr_size,
+                    random_pos2 : random_pos2 + hr_size,
+                ]
 
             # flip mask randomly
             if 0.3 < random.uniform(0, 1) <= 0.66:
@@ -137,43 +222,54 @@ class DS_inpaint(Dataset):
             elif 0.66 < random.uniform(0, 1) <= 1:
                 mask = np.flip(mask, axis=1)
 
-            mask = torch.from_numpy(mask.astype(np.float32)).unsqueeze(0) / 255
+            mask = torch.from_numpy(mask.astype(np.float32)).unsqueeze(0)
 
         sample = torch.from_numpy(sample).permute(2, 0, 1) / 255
 
-        # chance of the mask being inverted
-        if random.uniform(0, 1) < cfg["datasets"]["train"]["mask_invert_ratio"]:
+        # chance of the mask being inverted, batch masks get inverted in training_step
+        if (
+            mask_seed < 0
+            and random.uniform(0, 1) < cfg["datasets"]["train"]["mask_invert_ratio"]
+        ):
             mask = 1 - mask
 
         # apply mask
         masked = sample * mask
 
+        # edges and grayscale are computed in training_step
+        if cfg["datasets"]["train"]["batch_edges"] is True:
+            out = masked, mask, sample
+
         # EdgeConnect
-        if cfg["network_G"]["netG"] in ("EdgeConnect", "misf"):
-            return masked, mask, sample, edges, grayscale
+        elif cfg["network_G"]["netG"] in ("EdgeConnect", "misf"):
+            out = masked, mask, sample, edges, grayscale
 
         # PRVS
         elif cfg["network_G"]["netG"] == "PRVS" or cfg["network_G"]["netG"] == "CTSDG":
-            return masked, mask, sample, edges
+            out = masked, mask, sample, edges
 
         else:
-            return masked, mask, sample
+            out = masked, mask, sample
+
+        # seed of the generated mask, -1 for masks from the mask bank
+        if cfg["datasets"]["train"]["batch_masks"] is True:
+            out = out + (mask_seed,)
+        return out
 
 
 class DS_inpaint_val(Dataset):
     def __init__(self, root):
-        self.samples = []
-        for root, _, fnames in sorted(os.walk(root)):
-            for fname in sorted(fnames):
-                path = os.path.join(root, fname)
-                if ".png" in path or ".jpg" in path or ".webp" in path:
-                    self.samples.append(path)
+        self.samples = get_manifest(root)
         if len(self.samples) == 0:
             raise RuntimeError("Found 0 files in subfolders of: " + root)
 
     def __len__(self):
         return len(self.samples)
 
+    def image_sizes(self):
+        # for SizeBucketBatchSampler, from the manifest
+        return self.samples.dims
+
     def __getitem__(self, index):
         sample_path = self.samples[index]
         # sample = Image.open(sample_path).convert('RGB')
@@ -183,7 +279,11 @@ class DS_inpaint_val(Dataset):
         # if edges are required
         if cfg["network_G"]["netG"] in ("EdgeConnect", "PRVS", "CTSDG", "misf"):
             grayscale = cv2.cvtColor(sample, cv2.COLOR_RGB2GRAY)
-            edges = cv2.Canny(grayscale, 100, 150)
+            edges = cv2.Canny(
+                grayscale,
+                cfg["datasets"]["train"]["canny_min"],
+                cfg["datasets"]["train"]["canny_max"],
+            )
             grayscale = torch.from_numpy(grayscale).unsqueeze(0)
             edges = torch.from_numpy(edges).unsqueeze(0).type(torch.float)
 
@@ -248,22 +348,28 @@ def get_part_location(landmark_path, imgname, downscale=1):
 
 class DS_lrhr(Dataset):
     def __init__(self, lr_path, hr_path, hr_size=256, scale=4, transform=None):
-        self.samples = []
-        for hr_path, _, fnames in sorted(os.walk(hr_path)):
-            for fname in sorted(fnames):
-                path = os.path.join(hr_path, fname)
-                if ".png" in path or ".jpg" in path or ".webp" in path:
-                    self.samples.append(path)
+        self.samples = get_manifest(hr_path, lr_root=lr_path)
         if len(self.samples) == 0:
             raise RuntimeError("Found 0 files in subfolders of: " + hr_path)
+
+        # skip hr images without lr counterpart instead of crashing mid-epoch
+        if cfg["datasets"]["train"]["apply_otf_downscale"] is False:
+            missing = len(self.samples) - int(self.samples.lr.sum())
+            if missing > 0:
+                print(f"Skipping {missing} hr images without lr image in {lr_path}.")
+                self.samples = self.samples.subset(self.samples.lr)
+
         self.hr_size = hr_size
         self.scale = scale
         self.lr_path = lr_path
 
+        self.augment = get_augmentation()
+        self.kernel_bank = get_kernel_bank()
+
     def __len__(self):
         return len(self.samples)
 
-    def __getitem__(self, index):
+    def load_images(self, index):
         # getting hr image
         hr_path = self.samples[index]
         hr_image = cv2.imread(hr_path)
@@ -271,48 +377,50 @@ class DS_lrhr(Dataset):
 
         # getting lr image
         # only get image if kernels are not used
+        lr_image = None
         if cfg["datasets"]["train"]["apply_otf_downscale"] is False:
             lr_path = os.path.join(self.lr_path, os.path.basename(hr_path))
             lr_image = cv2.imread(lr_path)
             lr_image = cv2.cvtColor(lr_image, cv2.COLOR_BGR2RGB)
 
+        return hr_image, lr_image, hr_path
+
+    def __getitem__(self, index):
+        # the patch size curriculum passes a smaller size with the index
+        index, hr_size = patch_index(index, self.hr_size)
+        hr_image, lr_image, hr_path = self.load_images(index)
+
         # checking for hr_size limitation
-        if hr_image.shape[0] > self.hr_size or hr_image.shape[1] > self.hr_size:
+        if hr_image.shape[0] > hr_size or hr_image.shape[1] > hr_size:
             # image too big, random crop
-            random_pos1 = random.randint(0, hr_image.shape[0] - self.hr_size)
-            random_pos2 = random.randint(0, hr_image.shape[1] - self.hr_size)
+            random_pos1 = random.randint(0, hr_image.shape[0] - hr_size)
+            random_pos2 = random.randint(0, hr_image.shape[1] - hr_size)
 
             hr_image = hr_image[
-                random_pos1 : random_pos1 + self.hr_size,
-                random_pos2 : random_pos2 + self.hr_size,
+                random_pos1 : random_pos1 + hr_size,
+                random_pos2 : random_pos2 + hr_size,
             ]
             if cfg["datasets"]["train"]["apply_otf_downscale"] is False:
                 lr_image = lr_image[
                     int(random_pos1 / self.scale) : int(
-                        (random_pos1 / self.scale) + self.hr_size / self.scale
+                        (random_pos1 / self.scale) + hr_size / self.scale
                     ),
                     int(random_pos2 / self.scale) : int(
-                        (random_pos2 / self.scale) + self.hr_size / self.scale
+                        (random_pos2 / self.scale) + hr_size / self.scale
                     ),
                 ]
 
-        # OTFDownscale
-        if cfg["datasets"]["train"]["apply_otf_downscale"] is True:
+        # OTFDownscale, done in training_step with batch_degradation
+        if (
+            cfg["datasets"]["train"]["apply_otf_downscale"] is True
+            and cfg["datasets"]["train"]["batch_degradation"] is False
+        ):
             filter_type = random.choices(
                 cfg["datasets"]["train"]["otf_filter_types"],
                 cum_weights=cfg["datasets"]["train"]["otf_filter_probs"],
             )[0].upper()
             if filter_type == "KERNEL":
-                downscale_apply = transforms.ApplyKernel(
-                    scale=cfg["scale"],
-                    kernels_path=cfg["datasets"]["train"]["kernel_path"],
-                    kernel=None,
-                    pattern="kernelgan",
-                    kformat="npy",
-                    size=13,
-                    permute=True,
-                    center=False,
-                )
+                downscale_apply = self.kernel_bank
             elif filter_type in ("NEAREST", "BILINEAR", "AREA", "BICUBIC", "LANCZOS"):
                 downscale_apply = transforms.ApplyDownscale(
                     scale=cfg["scale"], filter_type=INTERP_MAP[filter_type]
@@ -323,289 +431,15 @@ class DS_lrhr(Dataset):
                 )
             lr_image = downscale_apply(hr_image)
 
-        # performing augmentation
-        all_transforms = []
-        # ColorJitter
-        if cfg["datasets"]["train"]["ColorJitter"] is True:
-            all_transforms.append(
-                transforms.ColorJitter(
-                    p=augcfg["ColorJitter"]["p"],
-                    brightness=augcfg["ColorJitter"]["brightness"],
-                    contrast=augcfg["ColorJitter"]["contrast"],
-                    saturation=augcfg["ColorJitter"]["saturation"],
-                    hue=augcfg["ColorJitter"]["hue"],
-                )
-            )
-        # RandomGaussianNoise
-        if cfg["datasets"]["train"]["RandomGaussianNoise"] is True:
-            all_transforms.append(
-                transforms.RandomGaussianNoise(
-                    p=augcfg["RandomGaussianNoise"]["p"],
-                    mean=augcfg["RandomGaussianNoise"]["mean"],
-                    var_limit=augcfg["RandomGaussianNoise"]["var_limit"],
-                    prob_color=augcfg["RandomGaussianNoise"]["prob_color"],
-                    multi=augcfg["RandomGaussianNoise"]["multi"],
-                    mode=augcfg["RandomGaussianNoise"]["mode"],
-                    sigma_calc=augcfg["RandomGaussianNoise"]["sigma_calc"],
-                )
-            )
-        # RandomPoissonNoise
-        if cfg["datasets"]["train"]["RandomPoissonNoise"] is True:
-            all_transforms.append(
-                transforms.RandomPoissonNoise(
-                    p=augcfg["RandomPoissonNoise"]["p"],
-                    prob_color=augcfg["RandomPoissonNoise"]["prob_color"],
-                    scale_range=augcfg["RandomPoissonNoise"]["scale_range"],
-                )
-            )
-        # RandomSPNoise
-        if cfg["datasets"]["train"]["RandomSPNoise"] is True:
-            all_transforms.append(
-                transforms.RandomSPNoise(
-                    p=augcfg["RandomSPNoise"]["p"], prob=augcfg["RandomSPNoise"]["prob"]
-                )
-            )
-        # RandomSpeckleNoise
-        if cfg["datasets"]["train"]["RandomSpeckleNoise"] is True:
-            all_transforms.append(
-                transforms.RandomSpeckleNoise(
-                    p=augcfg["RandomSpeckleNoise"]["p"],
-                    mean=augcfg["RandomSpeckleNoise"]["mean"],
-                    var_limit=augcfg["RandomSpeckleNoise"]["var_limit"],
-                    prob_color=augcfg["RandomSpeckleNoise"]["prob_color"],
-                    sigma_calc=augcfg["RandomSpeckleNoise"]["sigma_calc"],
-                )
-            )
-        # RandomCompression
-        if cfg["datasets"]["train"]["RandomCompression"] is True:
-            all_transforms.append(
-                transforms.RandomCompression(
-                    p=augcfg["RandomCompression"]["p"],
-                    min_quality=augcfg["RandomCompression"]["min_quality"],
-                    max_quality=augcfg["RandomCompression"]["max_quality"],
-                    compression_type=augcfg["RandomCompression"]["compression_type"],
-                )
-            )
-        # RandomAverageBlur
-        if cfg["datasets"]["train"]["RandomAverageBlur"] is True:
-            all_transforms.append(
-                transforms.RandomAverageBlur(
-                    p=augcfg["RandomAverageBlur"]["p"],
-                    kernel_size=augcfg["RandomAverageBlur"]["kernel_size"],
-                )
-            )
-        # RandomBilateralBlur
-        if cfg["datasets"]["train"]["RandomBilateralBlur"] is True:
-            all_transforms.append(
-                transforms.RandomAverageBlur(
-                    p=augcfg["RandomBilateralBlur"]["p"],
-                    kernel_size=augcfg["RandomBilateralBlur"]["kernel_size"],
-                    sigmaX=augcfg["RandomBilateralBlur"]["sigmaX"],
-                    sigmaY=augcfg["RandomBilateralBlur"]["sigmaY"],
-                )
-            )
-        # RandomBoxBlur
-        if cfg["datasets"]["train"]["RandomBoxBlur"] is True:
-            all_transforms.append(
-                transforms.RandomBoxBlur(
-                    p=augcfg["RandomBoxBlur"]["p"],
-                    kernel_size=augcfg["RandomBoxBlur"]["kernel_size"],
-                )
-            )
-        # RandomGaussianBlur
-        if cfg["datasets"]["train"]["RandomGaussianBlur"] is True:
-            all_transforms.append(
-                transforms.RandomGaussianBlur(
-                    p=augcfg["RandomGaussianBlur"]["p"],
-                    kernel_size=augcfg["RandomGaussianBlur"]["kernel_size"],
-                    sigmaX=augcfg["RandomGaussianBlur"]["sigmaX"],
-                    sigmaY=augcfg["RandomGaussianBlur"]["sigmaY"],
-                )
-            )
-        # RandomMedianBlur
-        if cfg["datasets"]["train"]["RandomMedianBlur"] is True:
-            all_transforms.append(
-                transforms.RandomMedianBlur(
-                    p=augcfg["RandomMedianBlur"]["p"],
-                    kernel_size=augcfg["RandomMedianBlur"]["kernel_size"],
-                )
-            )
-        # RandomMotionBlur
-        if cfg["datasets"]["train"]["RandomMotionBlur"] is True:
-            all_transforms.append(
-                transforms.RandomMotionBlur(
-                    p=augcfg["RandomMotionBlur"]["p"],
-                    kernel_size=augcfg["RandomMotionBlur"]["kernel_size"],
-                    per_channel=augcfg["RandomMotionBlur"]["per_channel"],
-                )
-            )
-        # RandomComplexMotionBlur
-        if cfg["datasets"]["train"]["RandomComplexMotionBlur"] is True:
-            all_transforms.append(
-                transforms.RandomComplexMotionBlur(
-                    p=augcfg["RandomComplexMotionBlur"]["p"],
-                    size=augcfg["RandomComplexMotionBlur"]["size"],
-                    complexity=augcfg["RandomComplexMotionBlur"]["complexity"],
-                    eps=augcfg["RandomComplexMotionBlur"]["eps"],
-                )
-            )
-        # RandomAnIsoBlur
-        if cfg["datasets"]["train"]["RandomAnIsoBlur"] is True:
-            all_transforms.append(
-                transforms.RandomAnIsoBlur(
-                    p=augcfg["RandomAnIsoBlur"]["p"],
-                    min_kernel_size=augcfg["RandomAnIsoBlur"]["min_kernel_size"],
-                    kernel_size=augcfg["RandomAnIsoBlur"]["kernel_size"],
-                    sigmaX=augcfg["RandomAnIsoBlur"]["sigmaX"],
-                    sigmaY=augcfg["RandomAnIsoBlur"]["sigmaY"],
-                    angle=augcfg["RandomAnIsoBlur"]["angle"],
-                    noise=augcfg["RandomAnIsoBlur"]["noise"],
-                    scale=augcfg["RandomAnIsoBlur"]["scale"],
-                )
-            )
-        # RandomSincBlur
-        if cfg["datasets"]["train"]["RandomSincBlur"] is True:
-            all_transforms.append(
-                transforms.RandomSincBlur(
-                    p=augcfg["RandomSincBlur"]["p"],
-                    min_kernel_size=augcfg["RandomSincBlur"]["min_kernel_size"],
-                    kernel_size=augcfg["RandomSincBlur"]["kernel_size"],
-                    min_cutoff=augcfg["RandomSincBlur"]["min_cutoff"],
-                )
-            )
-        # BayerDitherNoise
-        if cfg["datasets"]["train"]["BayerDitherNoise"] is True:
-            all_transforms.append(
-                transforms.BayerDitherNoise(p=augcfg["BayerDitherNoise"]["p"])
-            )
-        # FSDitherNoise
-        if cfg["datasets"]["train"]["FSDitherNoise"] is True:
-            all_transforms.append(
-                transforms.FSDitherNoise(p=augcfg["FSDitherNoise"]["p"])
-            )
-        # FilterMaxRGB
-        if cfg["datasets"]["train"]["FilterMaxRGB"] is True:
-            all_transforms.append(
-                transforms.FilterMaxRGB(p=augcfg["FilterMaxRGB"]["p"])
-            )
-        # FilterColorBalance
-        if cfg["datasets"]["train"]["FilterColorBalance"] is True:
-            all_transforms.append(
-                transforms.FilterColorBalance(
-                    p=augcfg["FilterColorBalance"]["p"],
-                    percent=augcfg["FilterColorBalance"]["percent"],
-                    random_params=augcfg["FilterColorBalance"]["random_params"],
-                )
-            )
-        # FilterUnsharp
-        if cfg["datasets"]["train"]["FilterUnsharp"] is True:
-            all_transforms.append(
-                transforms.FilterUnsharp(
-                    p=augcfg["FilterUnsharp"]["p"],
-                    blur_algo=augcfg["FilterUnsharp"]["blur_algo"],
-                    kernel_size=augcfg["FilterUnsharp"]["kernel_size"],
-                    strength=augcfg["FilterUnsharp"]["strength"],
-                    unsharp_algo=augcfg["FilterUnsharp"]["unsharp_algo"],
-                )
-            )
-        # FilterCanny
-        if cfg["datasets"]["train"]["FilterCanny"] is True:
-            all_transforms.append(
-                transforms.FilterCanny(
-                    p=augcfg["FilterCanny"]["p"],
-                    sigma=augcfg["FilterCanny"]["sigma"],
-                    bin_thresh=augcfg["FilterCanny"]["bin_thresh"],
-                    threshold=augcfg["FilterCanny"]["threshold"],
-                )
-            )
-        # SimpleQuantize
-        if cfg["datasets"]["train"]["SimpleQuantize"] is True:
-            all_transforms.append(
-                transforms.SimpleQuantize(
-                    p=augcfg["SimpleQuantize"]["p"],
-                    rgb_range=augcfg["SimpleQuantize"]["rgb_range"],
-                )
-            )
-        # KMeansQuantize
-        if cfg["datasets"]["train"]["KMeansQuantize"] is True:
-            all_transforms.append(
-                transforms.KMeansQuantize(
-                    p=augcfg["KMeansQuantize"]["p"],
-                    n_colors=augcfg["KMeansQuantize"]["n_colors"],
-                )
-            )
-        # CLAHE
-        if cfg["datasets"]["train"]["CLAHE"] is True:
-            all_transforms.append(
-                transforms.CLAHE(
-                    p=augcfg["CLAHE"]["p"],
-                    clip_limit=augcfg["CLAHE"]["clip_limit"],
-                    tile_grid_size=augcfg["CLAHE"]["tile_grid_size"],
-                )
-            )
-        # RandomGamma
-        if cfg["datasets"]["train"]["RandomGamma"] is True:
-            all_transforms.append(
-                transforms.RandomGamma(
-                    p=augcfg["RandomGamma"]["p"],
-                    gamma_range=augcfg["RandomGamma"]["gamma_range"],
-                    gain=augcfg["RandomGamma"]["gain"],
-                )
-            )
-        # Superpixels
-        if cfg["datasets"]["train"]["Superpixels"] is True:
-            all_transforms.append(
-                transforms.Superpixels(
-                    p=augcfg["Superpixels"]["p"],
-                    p_replace=augcfg["Superpixels"]["p_replace"],
-                    n_segments=augcfg["Superpixels"]["n_segments"],
-                    cs=augcfg["Superpixels"]["cs"],
-                    algo=augcfg["Superpixels"]["algo"],
-                    n_iters=augcfg["Superpixels"]["n_iters"],
-                    kind=augcfg["Superpixels"]["kind"],
-                    reduction=augcfg["Superpixels"]["reduction"],
-                    max_size=augcfg["Superpixels"]["max_size"],
-                    interpolation=augcfg["Superpixels"]["interpolation"],
-                )
-            )
-        # RandomCameraNoise
-        if cfg["datasets"]["train"]["RandomCameraNoise"] is True:
-            all_transforms.append(
-                transforms.RandomCameraNoise(
-                    p=augcfg["RandomCameraNoise"]["p"],
-                    demosaic_fn=augcfg["RandomCameraNoise"]["demosaic_fn"],
-                    xyz_arr=augcfg["RandomCameraNoise"]["xyz_arr"],
-                    rg_range=augcfg["RandomCameraNoise"]["rg_range"],
-                    bg_range=augcfg["RandomCameraNoise"]["bg_range"],
-                    random_params=augcfg["RandomCameraNoise"]["random_params"],
-                )
-            )
-
-        # BW augmentations
-        """
-        # [APPLY] BayerBWDitherNoise / 1ch output
-        all_transforms.append(transforms.BayerBWDitherNoise(p=0.5))
-        # [APPLY] BinBWDitherNoise / 1ch output
-        all_transforms.append(transforms.BinBWDitherNoise(p=0.5))
-        # FSBWDitherNoise / 1ch output
-        all_transforms.append(transforms.FSBWDitherNoise(p=0.5, samplingF = 1))
-        # [APPLY] RandomBWDitherNoise / 1ch output
-        all_transforms.append(transforms.RandomBWDitherNoise(p=0.5))
-        """
-        # [BROKEN] RandomChromaticAberration
-        # all_transforms.append(transforms.RandomChromaticAberration(p=0.5, radial_blur=True,
-        # strength=1.0, jitter=0, alpha=0.0,
-        # random_params=False))
-
-        # randomly shuffle transforms
-        random.shuffle(all_transforms)
-        # apply transforms
-        transform = transforms.Compose(all_transforms)
-        lr_image = transform(lr_image)
-
         # to tensor
         hr_image = torch.from_numpy(hr_image).permute(2, 0, 1) / 255
-        lr_image = torch.from_numpy(lr_image).permute(2, 0, 1) / 255
+        if lr_image is None:
+            # batch_degradation downscales hr_image in training_step
+            lr_image = torch.zeros(0)
+        else:
+            # performing augmentation in random order
+            lr_image = self.augment(lr_image)
+            lr_image = torch.from_numpy(lr_image).permute(2, 0, 1) / 255
 
         # if generator is DFDNet, change image range to [-1,1] and also pass landmarks
         if cfg["network_G"]["netG"] == "DFDNet":
@@ -622,14 +456,40 @@ class DS_lrhr(Dataset):
             return 0, lr_image, hr_image
 
 
+class DS_lrhr_shard(DS_lrhr):
+    """DS_lrhr reading packed pairs from shards written by scripts/create_shards.py.
+
+    Raw shards are read as views into memory mapped shard files instead of
+    opening and decoding two image files per sample.
+    """
+
+    def __init__(self, shard_path, hr_size=256, scale=4):
+        self.samples = ShardReader(shard_path)
+        if len(self.samples) == 0:
+            raise RuntimeError("Found 0 pairs in shards of: " + shard_path)
+
+        self.hr_size = hr_size
+        self.scale = scale
+        self.lr_path = None
+
+        self.augment = get_augmentation()
+        self.kernel_bank = get_kernel_bank()
+
+    def load_images(self, index):
+        hr_image, lr_image = self.samples[index]
+        if (
+            lr_image is None
+            and cfg["datasets"]["train"]["apply_otf_downscale"] is False
+        ):
+            raise RuntimeError(
+                "Shards were written without lr images, enable apply_otf_downscale."
+            )
+        return hr_image, lr_image, self.samples.name(index)
+
+
 class DS_lrhr_val(Dataset):
     def __init__(self, lr_path, hr_path):
-        self.samples = []
-        for hr_path, _, fnames in sorted(os.walk(hr_path)):
-            for fname in sorted(fnames):
-                path = os.path.join(hr_path, fname)
-                if ".png" in path or ".jpg" in path or ".webp" in path:
-                    self.samples.append(path)
+        self.samples = get_manifest(hr_path, lr_root=lr_path)
         if len(self.samples) == 0:
             raise RuntimeError("Found 0 files in subfolders of: " + hr_path)
 
@@ -638,6 +498,10 @@ class DS_lrhr_val(Dataset):
     def __len__(self):
         return len(self.samples)
 
+    def image_sizes(self):
+        # for SizeBucketBatchSampler, lr images of equally sized hr images match
+        return self.samples.dims
+
     def __getitem__(self, index):
         # getting hr image
         hr_path = self.samples[index]
@@ -668,30 +532,30 @@ class DS_lrhr_val(Dataset):
             return lr_image, hr_image, lr_path
 
 
-class DS_inpaint_TF(Dataset):
+class DS_inpaint_TF(IterableDataset):
     def __init__(self):
         tfrecord_path = cfg["datasets"]["train"]["tfrecord_path"]
         self.mask_dir = cfg["datasets"]["train"]["masks"]
-        self.mask_files = glob.glob(self.mask_dir + "/**/*.png", recursive=True)
-
         self.HR_size = cfg["datasets"]["train"]["HR_size"]
+        self.masks = get_mask_bank(self.mask_dir, self.HR_size, extensions=(".png",))
         # self.batch_size = cfg['datasets']['train']['batch_size']
 
-        self.dataset = TFRecordDataset(tfrecord_path, None)
-        self.loader = iter(torch.utils.data.DataLoader(self.dataset, batch_size=1))
+        # split between ranks and workers, every record is read once per epoch
+        self.records = get_tfrecord_stream(tfrecord_path)
 
     def __len__(self):
-        # iterator is infinite and does not have a length, hotfix
-        return cfg["datasets"]["train"]["amount_files"]
+        return len(self.records)
 
-    def __getitem__(self, index):
-        data = next(self.loader)
+    def __iter__(self):
+        for data in self.records:
+            yield self.process(data)
 
+    def process(self, data):
         if cfg["datasets"]["train"]["loading_backend"] == "OpenCV":
-            nparr = np.fromstring(np.array(data["data"]), np.uint8)
+            nparr = np.frombuffer(data["data"], np.uint8)
             sample = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         elif cfg["datasets"]["train"]["loading_backend"] == "PIL":
-            sample = Image.open(io.BytesIO(np.array(data["data"])))
+            sample = Image.open(io.BytesIO(data["data"]))
             sample = np.array(sample)
 
         # resize
@@ -708,28 +572,34 @@ class DS_inpaint_TF(Dataset):
                 random_pos2 : random_pos2 + self.HR_size,
             ]
 
-        # if edges are required
-        if cfg["network_G"]["netG"] in ("EdgeConnect", "PRVS", "CTSDG"):
+        # if edges are required, batch_edges computes them in training_step
+        if (
+            cfg["network_G"]["netG"] in ("EdgeConnect", "PRVS", "CTSDG")
+            and cfg["datasets"]["train"]["batch_edges"] is not True
+        ):
             grayscale = cv2.cvtColor(np.array(sample), cv2.COLOR_RGB2GRAY)
-            edges = cv2.Canny(grayscale, 100, 150)
+            edges = cv2.Canny(
+                grayscale,
+                cfg["datasets"]["train"]["canny_min"],
+                cfg["datasets"]["train"]["canny_max"],
+            )
             grayscale = torch.from_numpy(grayscale).unsqueeze(0) / 255
             edges = torch.from_numpy(edges).unsqueeze(0).type(torch.float)
 
+        mask_seed = -1
         if random.uniform(0, 1) < 0.5:
             # generating mask automatically with 50% chance
-            mask = random_mask(height=self.HR_size, width=self.HR_size)
-            mask = torch.from_numpy(mask)
+            if cfg["datasets"]["train"]["batch_masks"] is True:
+                # drawn from the seed for the whole batch in training_step
+                mask_seed = random.getrandbits(63)
+                mask = torch.ones(1, self.HR_size, self.HR_size)
+            else:
+                mask = random_mask(height=self.HR_size, width=self.HR_size)
+                mask = torch.from_numpy(mask)
 
         else:
-            # load random mask from folder
-            mask = cv2.imread(
-                random.choice([x for x in self.mask_files]), cv2.IMREAD_UNCHANGED
-            )
-            mask = cv2.resize(
-                mask, (self.HR_size, self.HR_size), interpolation=cv2.INTER_NEAREST
-            )
-            # since white = masked area, invert mask
-            mask = 255 - mask
+            # random mask from the mask bank, already inverted (1 = keep)
+            mask = self.masks[random.randrange(len(self.masks))]
 
             # flip mask randomly
             if 0.3 < random.uniform(0, 1) <= 0.66:
@@ -737,64 +607,67 @@ class DS_inpaint_TF(Dataset):
             elif 0.66 < random.uniform(0, 1) <= 1:
                 mask = np.flip(mask, axis=1)
 
-            mask = torch.from_numpy(mask.astype(np.float32)).unsqueeze(0) / 255
+            mask = torch.from_numpy(mask.astype(np.float32)).unsqueeze(0)
 
         sample = torch.from_numpy(sample).permute(2, 0, 1) / 255
 
-        # chance of the mask being inverted
-        if random.uniform(0, 1) < cfg["datasets"]["train"]["mask_invert_ratio"]:
+        # chance of the mask being inverted, batch masks get inverted in training_step
+        if (
+            mask_seed < 0
+            and random.uniform(0, 1) < cfg["datasets"]["train"]["mask_invert_ratio"]
+        ):
             mask = 1 - mask
 
         # apply mask
         masked = sample * mask
 
+        # edges and grayscale are computed in training_step
+        if cfg["datasets"]["train"]["batch_edges"] is True:
+            out = masked, mask, sample
+
         # EdgeConnect
-        if cfg["network_G"]["netG"] in ("EdgeConnect", "misf"):
-            return masked, mask, sample, edges, grayscale
+        elif cfg["network_G"]["netG"] in ("EdgeConnect", "misf"):
+            out = masked, mask, sample, edges, grayscale
 
         # PRVS
         elif cfg["network_G"]["netG"] == "PRVS" or cfg["network_G"]["netG"] == "CTSDG":
-            return masked, mask, sample, edges
+            out = masked, mask, sample, edges
 
         else:
-            return masked, mask, sample
+            out = masked, mask, sample
+
+        # seed of the generated mask, -1 for masks from the mask bank
+        if cfg["datasets"]["train"]["batch_masks"] is True:
+            out = out + (mask_seed,)
+        return out
 
 
-class DS_svg_TF(Dataset):
+class DS_svg_TF(IterableDataset):
     def __init__(self):
         tfrecord_path = cfg["datasets"]["train"]["tfrecord_path"]
 
         self.HR_size = cfg["datasets"]["train"]["HR_size"]
 
-        self.dataset = TFRecordDataset(tfrecord_path, None)
-        self.loader = iter(torch.utils.data.DataLoader(self.dataset, batch_size=1))
+        # split between ranks and workers, every record is read once per epoch
+        self.records = get_tfrecord_stream(tfrecord_path, return_index=True)
 
-    def __len__(self):
-        # iterator is infinite and does not have a length, hotfix
-        return cfg["datasets"]["train"]["amount_files"]
-
-    def __getitem__(self, index):
-        data = next(self.loader)
-
-        dpi = 300
-        output_width = 256
-        output_height = 256
+        self.cache = None
+        if cfg["datasets"]["train"]["svg_cache"] is True:
+            self.cache = get_render_cache(self.records)
 
-        png = svg2png(
-            bytestring=np.fromstring(np.array(data["data"]), np.uint8).tobytes(),
-            dpi=dpi,
-            output_width=output_width,
-            output_height=output_height,
-        )
+    def __len__(self):
+        return len(self.records)
 
-        # background fix
-        hr_image = Image.open(BytesIO(png)).convert("RGBA")
-        background = Image.new("RGBA", hr_image.size, (255, 255, 255))
-        hr_image = Image.alpha_composite(background, hr_image)
-        hr_image = hr_image.convert("RGB")
+    def __iter__(self):
+        for idx, data in self.records:
+            yield self.process(idx, data)
 
-        # resize
-        lr_image = hr_image.resize((64, 64), Image.ANTIALIAS)
+    def process(self, idx, data):
+        if self.cache is not None:
+            # rendered once, later epochs copy from the cache
+            hr_image, lr_image = self.cache(idx, data["data"])
+        else:
+            hr_image, lr_image = render_svg(data["data"])
 
         # to tensor
         lr_image = transforms.ToTensor()(lr_image)
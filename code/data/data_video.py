@@ -9,7 +9,10 @@ import random
 import cv2
 import torchvision.transforms.functional as TF
 import glob
+import warnings
 import yaml
+from .triplet_store import TripletStore
+from .video_windows import VideoWindows, find_videos, is_scene_cut
 
 with open("config.yaml", "r") as ymlfile:
     cfg = yaml.safe_load(ymlfile)
@@ -142,6 +145,91 @@ class VimeoTripletDirect(Dataset):
             )
 
 
+class VimeoTripletStore(Dataset):
+    """VimeoTriplet reading uint8 frames from a store written by
+    scripts/create_triplet_store.py.
+
+    The frames are already resized, a sample is a view into the memory mapped
+    chunks. They are returned as uint8 (3, h, w) tensors, training_step
+    converts the batch to float on the device.
+    """
+
+    def __init__(self, store_path):
+        self.samples = TripletStore(store_path)
+        if len(self.samples) == 0:
+            raise RuntimeError("Found 0 triplets in: " + store_path)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        frames = torch.from_numpy(self.samples[index]).permute(0, 3, 1, 2)
+        img1, img2, img3 = frames.unbind(0)
+        if random.random() >= 0.5:
+            img1, img3 = img3, img1
+
+        return img1, img3, img2
+
+
+# windows after a window with a scene cut which are tried instead
+SCENE_CUT_RETRIES = 16
+
+
+class VideoTriplet(Dataset):
+    """Interpolation triplets read straight from video files.
+
+    Windows of window frames are decoded GOP by GOP, see
+    data/video_windows.py. The model gets the first, middle and last frame of
+    a window, so longer windows give larger motion. Windows across a scene cut
+    are replaced by the next window without one. If all of the next
+    SCENE_CUT_RETRIES windows have a cut, the last one is used anyway with a
+    warning.
+    """
+
+    def __init__(self, data_root):
+        train_cfg = cfg["datasets"]["train"]
+        videos = find_videos(data_root)
+        if len(videos) == 0:
+            raise RuntimeError("Found 0 videos in: " + data_root)
+        self.windows = VideoWindows(
+            videos,
+            window=train_cfg["video_window"],
+            stride=train_cfg["video_stride"],
+            size=(448, 256),
+            cache_frames=train_cfg["video_cache_frames"],
+            index_dir=cfg["path"]["manifest_dir"],
+        )
+        self.scene_cut_psnr = train_cfg["scene_cut_psnr"]
+
+        self.transforms = transforms.Compose([transforms.ToTensor()])
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, index):
+        # the following windows are likely in the decoded GOPs already
+        for i in range(SCENE_CUT_RETRIES):
+            frames = self.windows[(index + i) % len(self.windows)]
+            if self.scene_cut_psnr is None or not is_scene_cut(
+                frames, self.scene_cut_psnr
+            ):
+                break
+        else:
+            # warned once per index and worker
+            warnings.warn(
+                f"Windows {index} to {index + SCENE_CUT_RETRIES - 1} all have a "
+                "scene cut, using the last one."
+            )
+
+        img1 = self.transforms(frames[0])
+        img2 = self.transforms(frames[len(frames) // 2])
+        img3 = self.transforms(frames[-1])
+        if random.random() >= 0.5:
+            img1, img3 = img3, img1
+
+        return img1, img3, img2
+
+
 class VimeoTriplet_val(Dataset):
     def __init__(self, data_root):
         upper_folders = glob.glob(data_root + "/*/")
@@ -161,6 +249,10 @@ class VimeoTriplet_val(Dataset):
     def __len__(self):
         return len(self.samples)
 
+    def image_sizes(self):
+        # frames get resized to 448x256, all triplets fit in one batch
+        return [(256, 448)] * len(self.samples)
+
     def __getitem__(self, index):
         imgpaths = [
             self.samples[index] + "/frame1.jpg",
@@ -1,5 +1,5 @@
 from torchvision import transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
 import pytorch_lightning as pl
 
 import yaml
@@ -46,6 +46,57 @@ class DataModule(pl.LightningDataModule):
         self.canny_min = canny_min
         self.canny_max = canny_max
 
+    def prepare_data(self):
+        # only called on the main process, builds or updates the dataset manifests
+        # so the other ranks and workers just load them in setup()
+        from .manifest import load_manifest
+        from .mask_bank import load_mask_bank
+        from .tfrecord_stream import TFRecordStream, expand_paths, load_index
+        from .render_cache import load_render_cache, warm_render_cache
+        from .video_windows import find_videos, load_video_index
+
+        mode = cfg["datasets"]["train"]["mode"]
+        manifest_dir = cfg["path"]["manifest_dir"]
+
+        if mode == "DS_lrhr":
+            load_manifest(self.dir_hr, lr_root=self.dir_lr, manifest_dir=manifest_dir)
+        elif mode == "DS_realesrgan":
+            load_manifest(self.dir_hr, manifest_dir=manifest_dir)
+        elif mode == "DS_inpaint":
+            load_manifest(self.dir_hr, manifest_dir=manifest_dir)
+            load_mask_bank(self.mask_dir, self.HR_size, manifest_dir=manifest_dir)
+        elif mode == "DS_inpaint_TF":
+            load_mask_bank(
+                cfg["datasets"]["train"]["masks"],
+                cfg["datasets"]["train"]["HR_size"],
+                extensions=(".png",),
+                manifest_dir=manifest_dir,
+            )
+
+        if mode in ("DS_inpaint_TF", "DS_svg_TF"):
+            for path in expand_paths(cfg["datasets"]["train"]["tfrecord_path"]):
+                load_index(path, manifest_dir)
+
+        if mode == "DS_svg_TF" and cfg["datasets"]["train"]["svg_cache"] is True:
+            stream = TFRecordStream(
+                cfg["datasets"]["train"]["tfrecord_path"], index_dir=manifest_dir
+            )
+            cache = load_render_cache(stream, manifest_dir=manifest_dir)
+            if cfg["datasets"]["train"]["svg_cache_warmup"] > 0:
+                warm_render_cache(
+                    cache, stream, cfg["datasets"]["train"]["svg_cache_warmup"]
+                )
+
+        if mode == "DS_video_file":
+            for path in find_videos(self.dir_hr):
+                load_video_index(path, manifest_dir)
+
+        if mode in ("DS_lrhr", "DS_lrhr_shard", "DS_svg_TF", "DS_realesrgan"):
+            load_manifest(self.val_hr, lr_root=self.val_lr, manifest_dir=manifest_dir)
+        elif mode in ("DS_inpaint", "DS_inpaint_TF"):
+            load_manifest(self.val_hr, manifest_dir=manifest_dir)
+            load_manifest(self.val_lr, manifest_dir=manifest_dir)
+
     def setup(self, stage=None):
         if cfg["datasets"]["train"]["mode"] == "DS_lrhr":
             from .data import DS_lrhr, DS_lrhr_val
@@ -56,6 +107,15 @@ class DataModule(pl.LightningDataModule):
             self.dataset_validation = DS_lrhr_val(self.val_lr, self.val_hr)
             self.dataset_test = DS_lrhr_val(self.val_lr, self.val_hr)
 
+        elif cfg["datasets"]["train"]["mode"] == "DS_lrhr_shard":
+            from .data import DS_lrhr_shard, DS_lrhr_val
+
+            self.dataset_train = DS_lrhr_shard(
+                cfg["datasets"]["train"]["shard_path"], self.HR_size, self.scale
+            )
+            self.dataset_validation = DS_lrhr_val(self.val_lr, self.val_hr)
+            self.dataset_test = DS_lrhr_val(self.val_lr, self.val_hr)
+
         elif cfg["datasets"]["train"]["mode"] == "DS_inpaint":
             # root, transform=None, size=256):
             from .data import DS_inpaint, DS_inpaint_val
@@ -85,6 +145,22 @@ class DataModule(pl.LightningDataModule):
             self.dataset_validation = VimeoTriplet_val(self.val_hr)
             self.dataset_test = VimeoTriplet_val(self.val_hr)
 
+        elif cfg["datasets"]["train"]["mode"] == "DS_video_store":
+            from .data_video import VimeoTripletStore, VimeoTriplet_val
+
+            self.dataset_train = VimeoTripletStore(
+                cfg["datasets"]["train"]["triplet_path"]
+            )
+            self.dataset_validation = VimeoTriplet_val(self.val_hr)
+            self.dataset_test = VimeoTriplet_val(self.val_hr)
+
+        elif cfg["datasets"]["train"]["mode"] == "DS_video_file":
+            from .data_video import VideoTriplet, VimeoTriplet_val
+
+            self.dataset_train = VideoTriplet(self.dir_hr)
+            self.dataset_validation = VimeoTriplet_val(self.val_hr)
+            self.dataset_test = VimeoTriplet_val(self.val_hr)
+
         elif cfg["datasets"]["train"]["mode"] == "DS_inpaint_TF":
             from .data import DS_inpaint_TF, DS_inpaint_val
 
@@ -112,12 +188,42 @@ class DataModule(pl.LightningDataModule):
         else:
             print("Mode not found.")
 
+    def current_step(self):
+        return self.trainer.global_step if self.trainer is not None else 0
+
     def train_dataloader(self):
+        from .curriculum import PatchCurriculum, CurriculumBatchSampler
+
+        curriculum = PatchCurriculum.from_config(cfg)
+        if curriculum is not None:
+            # batch and patch size follow global_step, the patch size is sent to
+            # the workers with the indices
+            return DataLoader(
+                self.dataset_train,
+                batch_sampler=CurriculumBatchSampler(
+                    SequentialSampler(self.dataset_train), curriculum, self.current_step
+                ),
+                num_workers=self.num_workers,
+            )
         return DataLoader(
             self.dataset_train, batch_size=self.batch_size, num_workers=self.num_workers
         )
 
     def val_dataloader(self):
+        from .size_buckets import SizeBucketBatchSampler
+
+        batch_size = cfg["datasets"]["val"]["batch_size"]
+        if batch_size > 1:
+            # validation images differ in size, equally sized ones are batched
+            return DataLoader(
+                self.dataset_validation,
+                batch_sampler=SizeBucketBatchSampler(
+                    SequentialSampler(self.dataset_validation),
+                    self.dataset_validation.image_sizes(),
+                    batch_size,
+                ),
+                num_workers=self.num_workers,
+            )
         return DataLoader(
             self.dataset_validation, batch_size=1, num_workers=self.num_workers
         )
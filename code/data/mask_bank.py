@@ -0,0 +1,154 @@
+"""
+Preloaded inpainting masks.
+
+Reading, decoding and resizing a mask file for every sample puts the mask
+folder into the per-sample I/O path. The bank decodes every mask once, resizes
+it to the training size, binarizes it and stores it bit-packed (np.packbits,
+one bit per pixel) in a single .npy file next to the manifests. Dataloader
+workers memory map that file, so all of them share the same pages and a
+sample only unpacks a few KB.
+
+Layout, stored in manifest_dir next to the manifest of the mask folder:
+    masks_<manifest>_<size>_<key>.npy   (count, height, ceil(width / 8)) uint8,
+                                        bit set where the pixel is kept (black
+                                        in the mask file)
+    masks_<manifest>_<size>_<key>.json  version, count, height, width, folder
+
+The key covers the mask manifest (names, sizes and mtimes) and the size, so a
+changed folder or HR_size builds a new bank.
+"""
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+from .manifest import MASK_EXTENSIONS, load_manifest, manifest_file
+
+MASK_BANK_VERSION = 1
+
+
+class MaskBank:
+    """Random access to a mask bank written by build_mask_bank.
+
+    Masks are returned as (height, width) uint8 arrays, 1 where the image is
+    kept and 0 where it is masked, the same values as the old
+    ``(255 - cv2.imread(mask)) / 255``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.splitext(path)[0] + ".json", "r") as f:
+            meta = json.load(f)
+        if meta["version"] != MASK_BANK_VERSION:
+            raise ValueError(f"Unsupported mask bank version {meta['version']}")
+        self.count = meta["count"]
+        self.height = meta["height"]
+        self.width = meta["width"]
+        self._bits = None
+        self._pid = None
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        # mappings are per process, workers map the file again
+        state = self.__dict__.copy()
+        state["_bits"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def bits(self):
+        if self._pid != os.getpid():
+            self._bits = np.load(self.path, mmap_mode="r")
+            self._pid = os.getpid()
+        return self._bits
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("mask bank index out of range")
+        return np.unpackbits(self.bits[idx], axis=-1, count=self.width)
+
+
+def read_mask(path, size):
+    """Decodes, resizes and binarizes a mask file, like the datasets did per
+    sample. Returns a (size, size) bool array, True where the image is kept."""
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Could not read mask {path}")
+    mask = cv2.resize(mask, (size, size), interpolation=cv2.INTER_NEAREST)
+    # white = masked area
+    return mask < 128
+
+
+def build_mask_bank(paths, path, size, root=""):
+    """Writes all masks into a bank file.
+
+    Args:
+        paths: mask file paths, e.g. a Manifest.
+        path (str): .npy output file, the .json meta data is written next to it.
+        size (int): masks are resized to (size, size).
+        root (str): source folder, only stored in the meta data.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    stem = os.path.splitext(path)[0]
+    tmp_path = f"{stem}.{os.getpid()}.tmp.npy"
+    shape = (len(paths), size, (size + 7) // 8)
+    bits = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=shape)
+    for i, mask_path in enumerate(paths):
+        bits[i] = np.packbits(read_mask(mask_path, size), axis=-1)
+    bits.flush()
+    del bits
+
+    meta = {
+        "version": MASK_BANK_VERSION,
+        "count": len(paths),
+        "height": size,
+        "width": size,
+        "root": root,
+    }
+    # the meta data goes first, the bank is only picked up once the npy exists
+    with open(f"{stem}.{os.getpid()}.tmp.json", "w") as f:
+        json.dump(meta, f)
+    os.replace(f"{stem}.{os.getpid()}.tmp.json", stem + ".json")
+    os.replace(tmp_path, path)
+
+
+def mask_bank_file(manifest, size, manifest_dir=None):
+    """Location of the bank for a mask manifest and size."""
+    key = hashlib.sha1()
+    key.update(f"{MASK_BANK_VERSION}|{manifest.root}|{size}|".encode("utf-8"))
+    key.update("|".join(manifest.dirs).encode("utf-8"))
+    key.update(manifest.files["size"].tobytes())
+    key.update(manifest.files["mtime"].tobytes())
+    key.update(manifest.names.tobytes())
+    folder, name = os.path.split(
+        manifest_file(manifest.root, manifest.extensions, manifest_dir)
+    )
+    stem = os.path.splitext(name)[0]
+    return os.path.join(folder, f"masks_{stem}_{size}_{key.hexdigest()[:16]}.npy")
+
+
+def load_mask_bank(root, size, extensions=MASK_EXTENSIONS, manifest_dir=None):
+    """Loads the mask bank of a folder, builds it if needed.
+
+    Args:
+        root (str): mask folder.
+        size (int): masks are resized to (size, size).
+        extensions (tuple): mask file extensions.
+        manifest_dir (str): where manifests and banks are stored, defaults to
+            ``~/.cache/traiNNer/manifests``.
+
+    Returns:
+        MaskBank
+    """
+    manifest = load_manifest(root, extensions=extensions, manifest_dir=manifest_dir)
+    path = mask_bank_file(manifest, size, manifest_dir)
+    if not os.path.isfile(path):
+        print(f"Building mask bank for {root} ({len(manifest)} masks).")
+        build_mask_bank(manifest, path, size, root=manifest.root)
+    return MaskBank(path)
@@ -31,6 +31,13 @@ import yaml
 import pytorch_lightning as pl
 import torch.nn.functional as F
 
+from .manifest import load_manifest
+from .curriculum import patch_index
+
+# images are cropped or padded to this size for the degradations, the HR_size
+# crop is taken from the degraded image
+CROP_PAD_SIZE = 400
+
 
 class RealESRGANDataset(pl.LightningDataModule):
     """Dataset used for Real-ESRGAN model:
@@ -53,22 +60,19 @@ class RealESRGANDataset(pl.LightningDataModule):
     def __init__(self, hr_path, hr_size=256, scale=4):
         super(RealESRGANDataset, self).__init__()
 
-        self.samples = []
-        for hr_path, _, fnames in sorted(os.walk(hr_path)):
-            for fname in sorted(fnames):
-                path = os.path.join(hr_path, fname)
-                if ".png" in path or ".jpg" in path or ".webp" in path:
-                    self.samples.append(path)
-
-        self.hr_size = hr_size
-        self.scale = scale
-
         with open("realesrgan_aug_config.yaml", "r") as ymlfile:
             opt = yaml.safe_load(ymlfile)
 
         with open("config.yaml", "r") as ymlfile:
             self.config = yaml.safe_load(ymlfile)
 
+        self.samples = load_manifest(
+            hr_path, manifest_dir=self.config["path"]["manifest_dir"]
+        )
+
+        self.hr_size = hr_size
+        self.scale = scale
+
         if self.config["datasets"]["train"]["loading_backend"] == "turboJPEG":
             from turbojpeg import TurboJPEG
 
@@ -109,6 +113,8 @@ class RealESRGANDataset(pl.LightningDataModule):
         self.pulse_tensor[10, 10] = 1
 
     def __getitem__(self, index):
+        # the patch size curriculum passes a smaller size with the index
+        index, hr_size = patch_index(index, self.hr_size)
         # -------------------------------- Load gt images -------------------------------- #
         # Shape: (h, w, c); channel order: BGR; image range: [0, 1], float32.
         img_gt = self.samples[index]
@@ -125,10 +131,10 @@ class RealESRGANDataset(pl.LightningDataModule):
         # -------------------- Do augmentation for training: flip, rotation -------------------- #
         img_gt = augment(img_gt, self.opt["use_hflip"], self.opt["use_rot"])
 
-        # crop or pad to 400
+        # crop or pad to 400, smaller curriculum patches keep the same margin
         # TODO: 400 is hard-coded. You may change it accordingly
         h, w = img_gt.shape[0:2]
-        crop_pad_size = 400
+        crop_pad_size = CROP_PAD_SIZE - self.hr_size + hr_size
         # pad
         if h < crop_pad_size or w < crop_pad_size:
             pad_h = max(0, crop_pad_size - h)
@@ -359,7 +365,8 @@ class RealESRGANDatasetApply(pl.LightningDataModule):
         self.lq = torch.clamp((out * 255.0).round(), 0, 255) / 255.0
 
         # random crop
-        gt_size = self.config["datasets"]["train"]["HR_size"]
+        # HR_size, or the curriculum patch size the dataset cropped for
+        gt_size = ori_h - CROP_PAD_SIZE + self.config["datasets"]["train"]["HR_size"]
         (self.gt, self.gt_usm), self.lq = paired_random_crop(
             [self.gt, self.gt_usm], self.lq, gt_size, self.config["scale"]
         )
@@ -0,0 +1,197 @@
+"""
+Rasterization cache for DS_svg_TF.
+
+Every sample of DS_svg_TF renders an svg with cairosvg, composites it on a
+white background and downscales it, which costs far more than the training
+step itself, while the vector sources never change. The cache stores the
+rendered HR and LR images of every record in memory mapped .npy files next to
+the manifests, so after the first epoch a sample is a copy out of the page
+cache.
+
+Layout, stored in manifest_dir:
+    svg_<key>_hr.npy      (records, size, size, 3) uint8
+    svg_<key>_lr.npy      (records, lr_size, lr_size, 3) uint8
+    svg_<key>_digest.npy  (records, 20) uint8, sha1 of the svg of a slot
+
+The key covers the tfrecord files (paths, sizes and mtimes), the output sizes
+and the dpi. A slot is used once its digest matches the sha1 of the record,
+the digest is written after the images, so a slot which was only partly
+written is rendered again. Workers only write the slots of their own records.
+"""
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from .tfrecord_stream import parse_example
+
+RENDER_CACHE_VERSION = 1
+
+
+def render_svg(svg, size=256, lr_size=64, dpi=300):
+    """Renders an svg on a white background.
+
+    Returns:
+        (hr, lr): (size, size, 3) and (lr_size, lr_size, 3) uint8 RGB arrays.
+    """
+    from cairosvg import svg2png
+
+    png = svg2png(bytestring=svg, dpi=dpi, output_width=size, output_height=size)
+
+    # background fix
+    hr_image = Image.open(BytesIO(png)).convert("RGBA")
+    background = Image.new("RGBA", hr_image.size, (255, 255, 255))
+    hr_image = Image.alpha_composite(background, hr_image)
+    hr_image = hr_image.convert("RGB")
+
+    # resize, ANTIALIAS is LANCZOS and was removed in Pillow 10
+    lr_image = hr_image.resize((lr_size, lr_size), Image.LANCZOS)
+    return np.array(hr_image), np.array(lr_image)
+
+
+class RenderCache:
+    """Memory mapped HR / LR images of every record of a TFRecordStream.
+
+    Args:
+        path (str): cache prefix, the files are ``<path>_hr.npy`` etc.
+        count (int): number of records.
+        size, lr_size (int): output sizes.
+        dpi (int): svg render resolution.
+    """
+
+    def __init__(self, path, count, size=256, lr_size=64, dpi=300):
+        self.path = path
+        self.count = count
+        self.size = size
+        self.lr_size = lr_size
+        self.dpi = dpi
+        self._arrays = None
+        self._pid = None
+
+        shapes = {
+            "hr": (count, size, size, 3),
+            "lr": (count, lr_size, lr_size, 3),
+            "digest": (count, 20),
+        }
+        for name, shape in shapes.items():
+            file = f"{path}_{name}.npy"
+            if os.path.isfile(file):
+                continue
+            # zero filled and sparse until slots get written
+            os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+            tmp_path = f"{path}_{name}.{os.getpid()}.tmp.npy"
+            array = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=np.uint8, shape=shape
+            )
+            del array
+            os.replace(tmp_path, file)
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        # mappings are per process, workers map the files again
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._pid != os.getpid():
+            self._arrays = {
+                name: np.load(f"{self.path}_{name}.npy", mmap_mode="r+")
+                for name in ("hr", "lr", "digest")
+            }
+            self._pid = os.getpid()
+        return self._arrays
+
+    def __call__(self, idx, svg):
+        """HR and LR images of record idx, rendered on a miss.
+
+        Args:
+            idx (int): record index in the stream.
+            svg (bytes): svg of the record.
+
+        Returns:
+            (hr, lr): uint8 RGB arrays, copies of the cache.
+        """
+        arrays = self.arrays
+        digest = np.frombuffer(hashlib.sha1(svg).digest(), np.uint8)
+        if np.array_equal(arrays["digest"][idx], digest):
+            return np.array(arrays["hr"][idx]), np.array(arrays["lr"][idx])
+
+        hr, lr = render_svg(svg, self.size, self.lr_size, self.dpi)
+        arrays["hr"][idx] = hr
+        arrays["lr"][idx] = lr
+        # marks the slot as done, after the images
+        arrays["digest"][idx] = digest
+        return hr, lr
+
+    def missing(self):
+        """Indices of the slots which were not rendered yet."""
+        return np.flatnonzero(~self.arrays["digest"].any(1))
+
+
+def render_cache_file(paths, size, lr_size, dpi, manifest_dir=None):
+    """Location of the cache of tfrecord files and render settings."""
+    if not manifest_dir:
+        manifest_dir = os.path.join(
+            os.path.expanduser("~"), ".cache", "traiNNer", "manifests"
+        )
+    key = hashlib.sha1()
+    key.update(f"{RENDER_CACHE_VERSION}|{size}|{lr_size}|{dpi}".encode("utf-8"))
+    for path in paths:
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        key.update(f"|{path}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8"))
+    return os.path.join(manifest_dir, f"svg_{key.hexdigest()[:16]}")
+
+
+def load_render_cache(stream, size=256, lr_size=64, dpi=300, manifest_dir=None):
+    """Opens the cache of a TFRecordStream, creates the files if needed.
+
+    Args:
+        stream (TFRecordStream): records to cache.
+        size, lr_size (int): output sizes.
+        dpi (int): svg render resolution.
+        manifest_dir (str): where the cache is stored, defaults to
+            ``~/.cache/traiNNer/manifests``.
+
+    Returns:
+        RenderCache
+    """
+    path = render_cache_file(stream.paths, size, lr_size, dpi, manifest_dir)
+    return RenderCache(path, stream.num_records, size, lr_size, dpi)
+
+
+def _warm(args):
+    cache, stream, indices = args
+    for idx, record in stream.read_records(indices):
+        cache(idx, parse_example(record)["data"])
+    return len(indices)
+
+
+def warm_render_cache(cache, stream, processes=4, chunk_size=256):
+    """Renders all missing slots of the cache with a process pool.
+
+    Args:
+        cache (RenderCache): cache of the stream.
+        stream (TFRecordStream): records of the cache.
+        processes (int): number of render processes.
+        chunk_size (int): records per task.
+    """
+    missing = cache.missing()
+    if len(missing) == 0:
+        return
+    print(f"Rendering {len(missing)} svgs with {processes} processes.")
+    chunks = [
+        (cache, stream, missing[i : i + chunk_size])
+        for i in range(0, len(missing), chunk_size)
+    ]
+    with ProcessPoolExecutor(processes) as pool:
+        for _ in pool.map(_warm, chunks):
+            pass
@@ -0,0 +1,244 @@
+"""
+Packed LR/HR shards.
+
+Opening and decoding two small files per sample lets file IOPS dominate on
+network storage. ShardWriter packs aligned LR/HR pairs into a few large shard
+files plus an offset index, ShardReader maps them with np.memmap and returns
+views into the mapping, so reading a raw sample does not copy anything.
+
+Layout of a shard folder:
+    meta.json        encoding, number of samples and shard files
+    index.npy        one INDEX_DTYPE record per pair
+    names.npy        utf-8 blob with the original file names
+    name_offsets.npy offsets into names.npy
+    shard_00000.bin  concatenated image data
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+SHARD_VERSION = 1
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("shard", "<i4"),
+        ("hr_offset", "<i8"),
+        ("hr_nbytes", "<i8"),
+        ("hr_shape", "<i4", (3,)),
+        ("lr_offset", "<i8"),
+        ("lr_nbytes", "<i8"),
+        ("lr_shape", "<i4", (3,)),
+    ]
+)
+
+# records start at multiples of this, keeps raw images page friendly
+ALIGNMENT = 64
+
+
+class ShardWriter:
+    """Writes LR/HR pairs into shard files.
+
+    Args:
+        out_dir (str): output folder.
+        encoding (str): ``raw`` stores RGB uint8 arrays which can be read
+            without any decoding, ``encoded`` stores the encoded image files
+            (png, jpg, webp) as they are, which is smaller but needs decoding.
+        shard_size (int): a new shard file is started after this many bytes.
+    """
+
+    def __init__(self, out_dir, encoding="raw", shard_size=1 << 30):
+        if encoding not in ("raw", "encoded"):
+            raise ValueError(f"Unknown shard encoding: {encoding}")
+        self.out_dir = out_dir
+        self.encoding = encoding
+        self.shard_size = shard_size
+
+        os.makedirs(out_dir, exist_ok=True)
+        self.records = []
+        self.names = []
+        self.shard = -1
+        self.file = None
+        self.offset = 0
+        self._next_shard()
+
+    def _next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.shard += 1
+        self.file = open(
+            os.path.join(self.out_dir, f"shard_{self.shard:05d}.bin"), "wb"
+        )
+        self.offset = 0
+
+    def _write(self, data):
+        padding = -self.offset % ALIGNMENT
+        if padding:
+            self.file.write(b"\0" * padding)
+            self.offset += padding
+        offset = self.offset
+        self.file.write(data)
+        self.offset += len(data)
+        return offset, len(data)
+
+    def _prepare(self, image):
+        if image is None:
+            return b"", (0, 0, 0)
+        if self.encoding == "encoded":
+            # encoded bytes, shape is filled in from the header when reading
+            return bytes(image), (0, 0, 0)
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.ndim == 2:
+            image = image[:, :, None]
+        return image.tobytes(), image.shape
+
+    def add(self, hr, lr=None, name=""):
+        """Adds one pair.
+
+        Args:
+            hr: RGB uint8 array (raw) or encoded file bytes (encoded).
+            lr: same as hr, can be None if OTF downscaling is used.
+            name (str): original file name, used for DFDNet landmarks.
+        """
+        hr_data, hr_shape = self._prepare(hr)
+        lr_data, lr_shape = self._prepare(lr)
+        if self.offset > 0 and self.offset + len(hr_data) + len(lr_data) > (
+            self.shard_size
+        ):
+            self._next_shard()
+
+        hr_offset, hr_nbytes = self._write(hr_data)
+        lr_offset, lr_nbytes = self._write(lr_data)
+        self.records.append(
+            (self.shard, hr_offset, hr_nbytes, hr_shape, lr_offset, lr_nbytes, lr_shape)
+        )
+        self.names.append(name.encode("utf-8"))
+
+    def close(self):
+        self.file.close()
+        index = np.array(self.records, dtype=INDEX_DTYPE)
+        np.save(os.path.join(self.out_dir, "index.npy"), index)
+        np.save(
+            os.path.join(self.out_dir, "names.npy"),
+            np.frombuffer(b"".join(self.names), dtype=np.uint8),
+        )
+        np.save(
+            os.path.join(self.out_dir, "name_offsets.npy"),
+            np.concatenate([[0], np.cumsum([len(n) for n in self.names])]).astype(
+                np.int64
+            ),
+        )
+        with open(os.path.join(self.out_dir, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": SHARD_VERSION,
+                    "encoding": self.encoding,
+                    "count": len(self.records),
+                    "shards": self.shard + 1,
+                },
+                f,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader:
+    """Random access to a shard folder written by ShardWriter.
+
+    The index and names are memory mapped too, so memory use stays constant
+    no matter how many pairs the shards hold. They and the shard files get
+    mapped lazily in every dataloader worker instead of being pickled.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != SHARD_VERSION:
+            raise ValueError(f"Unsupported shard version {meta['version']}")
+        self.encoding = meta["encoding"]
+        self.num_shards = meta["shards"]
+
+        self._arrays = None
+        self._maps = {}
+        self._pid = None
+        self._len = len(self.index)
+
+    def __len__(self):
+        return self._len
+
+    def __getstate__(self):
+        # mappings are per process, workers map the index, names and shards again
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        state["_maps"] = {}
+        state["_pid"] = None
+        return state
+
+    def _process(self):
+        if self._pid != os.getpid():
+            self._arrays = None
+            self._maps = {}
+            self._pid = os.getpid()
+
+    def _load(self):
+        self._process()
+        if self._arrays is None:
+            self._arrays = tuple(
+                np.load(os.path.join(self.shard_dir, f"{name}.npy"), mmap_mode="r")
+                for name in ("index", "names", "name_offsets")
+            )
+        return self._arrays
+
+    @property
+    def index(self):
+        return self._load()[0]
+
+    @property
+    def names(self):
+        return self._load()[1]
+
+    @property
+    def name_offsets(self):
+        return self._load()[2]
+
+    def _map(self, shard):
+        self._process()
+        if shard not in self._maps:
+            path = os.path.join(self.shard_dir, f"shard_{shard:05d}.bin")
+            if os.path.getsize(path) == 0:
+                self._maps[shard] = np.zeros(0, dtype=np.uint8)
+            else:
+                # copy-on-write, the views are writable without touching the file
+                self._maps[shard] = np.memmap(path, dtype=np.uint8, mode="c")
+        return self._maps[shard]
+
+    def _image(self, data, offset, nbytes, shape):
+        if nbytes == 0:
+            return None
+        view = data[offset : offset + nbytes]
+        if self.encoding == "raw":
+            return view.reshape(shape)
+        image = cv2.imdecode(view, cv2.IMREAD_COLOR)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def name(self, idx):
+        start, end = self.name_offsets[idx], self.name_offsets[idx + 1]
+        return self.names[start:end].tobytes().decode("utf-8")
+
+    def __getitem__(self, idx):
+        """Returns (hr, lr), lr is None if the pair was written without lr."""
+        record = self.index[idx]
+        data = self._map(int(record["shard"]))
+        hr = self._image(
+            data, record["hr_offset"], record["hr_nbytes"], tuple(record["hr_shape"])
+        )
+        lr = self._image(
+            data, record["lr_offset"], record["lr_nbytes"], tuple(record["lr_shape"])
+        )
+        return hr, lr
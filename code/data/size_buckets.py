@@ -0,0 +1,59 @@
+"""
+Batches of equally sized validation images.
+
+Validation images can have any size, so val_dataloader used batch_size=1 and
+ran one small forward pass per image. SizeBucketBatchSampler groups the
+indices by image size, every batch only holds images of one size and can be
+collated and run through the network at once. The sizes come from the
+dataset (image_sizes()), the manifests already store them, so no image gets
+opened to build the batches.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from torch.utils.data import BatchSampler
+
+
+class SizeBucketBatchSampler(BatchSampler):
+    """Batches of indices whose images have the same size.
+
+    Buckets are kept in the order their first index is drawn from the
+    sampler, inside a bucket the sampler order is kept. With DDP, Lightning
+    replaces the sampler with a DistributedSampler and every rank buckets its
+    own indices.
+
+    Args:
+        sampler: index sampler, e.g. SequentialSampler.
+        sizes: (n, 2) height and width of every dataset index, indices with a
+            negative (unknown) size get a batch of their own.
+        batch_size (int): most images per batch.
+        drop_last (bool): drop incomplete batches.
+    """
+
+    def __init__(self, sampler, sizes, batch_size, drop_last=False):
+        self.sampler = sampler
+        self.sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def buckets(self):
+        buckets = OrderedDict()
+        for index in self.sampler:
+            height, width = self.sizes[index]
+            # unknown sizes can not be batched with anything
+            key = (height, width) if height >= 0 and width >= 0 else ("?", index)
+            buckets.setdefault(key, []).append(index)
+        return buckets.values()
+
+    def __iter__(self):
+        for bucket in self.buckets():
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start : start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    break
+                yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets())
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets())
@@ -0,0 +1,268 @@
+"""
+Batched free-form stroke masks for the inpainting datasets.
+
+random_mask() in data.py draws every stroke vertex by vertex with cv2.line in
+the dataloader workers. Here the stroke parameters of a mask are drawn at once
+from a per-sample seed and the thick line segments of a whole batch are
+rasterized together with torch ops, on the device of the model. A thick line
+segment is a capsule (a rectangle with round caps, like cv2.line with a
+thickness > 1), which is convex, so it covers one interval of every row. The
+intervals of all segments are accumulated in a difference array and a cumsum
+along the rows gives the coverage.
+
+With batch_masks enabled, the datasets only return a seed for generated masks
+and training_step calls StrokeMasks on the batch.
+"""
+import numpy as np
+import torch
+
+
+class StrokeMasks:
+    """Draws random stroke masks with the parameters of random_mask().
+
+    Args:
+        height (int): mask height.
+        width (int): mask width.
+        min_stroke, max_stroke (int): number of strokes per mask.
+        min_vertex, max_vertex (int): number of vertices per stroke.
+        min_brush_width_divisor, max_brush_width_divisor (int): brush widths are
+            drawn from [height // min_divisor, height // max_divisor].
+        compat (bool): match the statistics of random_mask(), including its
+            quirks: angles in (1, 2 pi], vertices truncated to integers and row / column
+            swapped for non square masks. With False, angles cover [0, 2 pi)
+            and vertices keep sub-pixel positions.
+    """
+
+    def __init__(
+        self,
+        height=256,
+        width=256,
+        min_stroke=1,
+        max_stroke=10,
+        min_vertex=1,
+        max_vertex=15,
+        min_brush_width_divisor=12,
+        max_brush_width_divisor=5,
+        compat=True,
+    ):
+        self.height = height
+        self.width = width
+        self.min_stroke = min_stroke
+        self.max_stroke = max_stroke
+        self.min_vertex = min_vertex
+        self.max_vertex = max_vertex
+        self.min_brush_width_divisor = min_brush_width_divisor
+        self.max_brush_width_divisor = max_brush_width_divisor
+        self.min_brush_width = height // min_brush_width_divisor
+        self.max_brush_width = height // max_brush_width_divisor
+        self.average_length = np.sqrt(height * height + width * width) / 8
+        self.compat = compat
+        self._resized = {}
+
+    def resized(self, height, width):
+        """StrokeMasks with the same parameters for another mask size, e.g. the
+        patch size of the curriculum."""
+        if (height, width) == (self.height, self.width):
+            return self
+        if (height, width) not in self._resized:
+            self._resized[(height, width)] = StrokeMasks(
+                height,
+                width,
+                self.min_stroke,
+                self.max_stroke,
+                self.min_vertex,
+                self.max_vertex,
+                self.min_brush_width_divisor,
+                self.max_brush_width_divisor,
+                self.compat,
+            )
+        return self._resized[(height, width)]
+
+    def strokes(self, seed):
+        """Line segments of one mask.
+
+        Returns:
+            np.ndarray: (n, 5) float32, row / column of the start and end
+            point and the brush width of every segment.
+        """
+        rng = np.random.default_rng(seed)
+        num_stroke = rng.integers(self.min_stroke, self.max_stroke + 1)
+        num_vertex = rng.integers(self.min_vertex, self.max_vertex + 1, num_stroke)
+        shape = (num_stroke, self.max_vertex)
+        if self.compat:
+            # random_mask() uses x as the row and y as the column of cv2.line
+            start_row = rng.integers(self.width, size=num_stroke).astype(np.float64)
+            start_col = rng.integers(self.height, size=num_stroke).astype(np.float64)
+            # np.random.uniform(2 pi) is uniform(low=2 pi, high=1.0)
+            angle = 2 * np.pi - (2 * np.pi - 1) * rng.random(shape)
+        else:
+            start_row = rng.uniform(0, self.height, num_stroke)
+            start_col = rng.uniform(0, self.width, num_stroke)
+            angle = rng.uniform(0, 2 * np.pi, shape)
+        length = np.clip(
+            rng.normal(self.average_length, self.average_length // 2, shape),
+            0,
+            2 * self.average_length,
+        )
+        brush_width = rng.integers(
+            self.min_brush_width, self.max_brush_width + 1, shape
+        )
+        flips = rng.random(2) < 0.5
+
+        # vertices of all strokes, one step at a time
+        rows = np.empty((num_stroke, self.max_vertex + 1))
+        cols = np.empty((num_stroke, self.max_vertex + 1))
+        rows[:, 0], cols[:, 0] = start_row, start_col
+        for i in range(self.max_vertex):
+            rows[:, i + 1] = rows[:, i] + length[:, i] * np.sin(angle[:, i])
+            cols[:, i + 1] = cols[:, i] + length[:, i] * np.cos(angle[:, i])
+            if self.compat:
+                rows[:, i + 1] = np.trunc(rows[:, i + 1])
+                cols[:, i + 1] = np.trunc(cols[:, i + 1])
+
+        # random_mask() flips the finished mask, mirroring the vertices is
+        # the same for pixel centers
+        if flips[0]:
+            cols = self.width - 1 - cols
+        if flips[1]:
+            rows = self.height - 1 - rows
+
+        used = np.arange(self.max_vertex) < num_vertex[:, None]
+        segments = np.stack(
+            [rows[:, :-1], cols[:, :-1], rows[:, 1:], cols[:, 1:], brush_width], -1
+        )
+        return segments[used].astype(np.float32)
+
+    def __call__(self, seeds, device="cpu"):
+        """
+        Args:
+            seeds: one integer seed per mask.
+            device: device of the masks.
+
+        Returns:
+            Tensor: (n, 1, height, width) float masks, 0 = masked area, like
+            random_mask().
+        """
+        strokes = [self.strokes(int(seed)) for seed in seeds]
+        counts = torch.tensor([len(segments) for segments in strokes], device=device)
+        segments = torch.from_numpy(np.concatenate(strokes)).to(device)
+        index = torch.repeat_interleave(
+            torch.arange(len(strokes), device=device), counts
+        )
+
+        covered = rasterize_segments(
+            segments, index, len(strokes), self.height, self.width
+        )
+        return (~covered).float().unsqueeze(1)
+
+    def fill(self, mask, seeds, invert_ratio=0.0):
+        """Replaces the masks with a seed by generated ones.
+
+        Args:
+            mask (Tensor): (b, 1, h, w) masks of the batch.
+            seeds (Tensor): (b,) mask seeds from the dataset, -1 keeps the mask.
+            invert_ratio (float): chance of a generated mask being inverted,
+                mask_invert_ratio of the datasets.
+
+        Returns:
+            Tensor: (b, 1, h, w) masks.
+        """
+        generated = seeds >= 0
+        if not generated.any():
+            return mask
+        generator = self.resized(*mask.shape[-2:])
+        masks = generator(seeds[generated].tolist(), device=mask.device)
+        masks = masks.to(mask.dtype)
+        invert = torch.rand(len(masks), device=mask.device) < invert_ratio
+        masks = torch.where(invert[:, None, None, None], 1 - masks, masks)
+        mask = mask.clone()
+        mask[generated] = masks
+        return mask
+
+
+def _solve(coef, lo, hi):
+    """Interval of u with lo <= coef * u <= hi.
+
+    coef == 0 is replaced by a tiny value, which gives a huge interval if
+    lo <= 0 <= hi and one far outside the mask otherwise. Only rows through
+    an end point can be off, and those are covered by the round caps.
+    """
+    coef = torch.where(coef == 0, torch.full_like(coef, 1e-12), coef)
+    a, b = lo / coef, hi / coef
+    return torch.minimum(a, b), torch.maximum(a, b)
+
+
+def rasterize_segments(segments, index, n, height, width):
+    """Rasterizes thick line segments into n boolean masks.
+
+    Args:
+        segments (Tensor): (s, 5) row / column of the start and end point and
+            the width of every segment, in pixel coordinates.
+        index (Tensor): (s,) mask index of every segment.
+        n (int): number of masks.
+        height, width (int): mask size.
+
+    Returns:
+        Tensor: (n, height, width) bool, True where a segment covers the pixel
+        center.
+    """
+    device = segments.device
+    diff = torch.zeros(n * height * (width + 1), device=device)
+    # same radius as the round caps of cv2.line, (thickness + 1) >> 1
+    radius = (segments[:, 4] + 1) / 2
+    top = (torch.minimum(segments[:, 0], segments[:, 2]) - radius).ceil()
+    bottom = (torch.maximum(segments[:, 0], segments[:, 2]) + radius).floor()
+    top = top.clamp(min=0).long()
+    counts = (bottom.clamp(max=height - 1).long() - top + 1).clamp(min=0)
+
+    # one element per (segment, row) the segment can touch
+    seg = torch.repeat_interleave(torch.arange(len(segments), device=device), counts)
+    if len(seg) > 0:
+        starts = torch.cumsum(counts, 0) - counts
+        row = top[seg] + torch.arange(len(seg), device=device) - starts[seg]
+        y = row.to(segments.dtype)
+        r0, c0, r1, c1, _ = segments[seg].unbind(1)
+        radius = radius[seg]
+        inf = float("inf")
+
+        # round caps, disks around both end points
+        def disk(r, c):
+            h2 = radius**2 - (y - r) ** 2
+            h = h2.clamp(min=0).sqrt_()
+            outside = h2 < 0
+            return (c - h).masked_fill_(outside, inf), (c + h).masked_fill_(
+                outside, -inf
+            )
+
+        left, right = disk(r0, c0)
+        left1, right1 = disk(r1, c1)
+        torch.minimum(left, left1, out=left)
+        torch.maximum(right, right1, out=right)
+
+        # body, 0 <= (p - a).d <= |d|^2 and |(p - a) x d| <= radius * |d|
+        # with u = column - c0 and v = row - r0
+        dr, dc = r1 - r0, c1 - c0
+        length2 = dr**2 + dc**2
+        length = length2.sqrt()
+        v = y - r0
+        a_left, a_right = _solve(dc, -v * dr, length2 - v * dr)
+        b_left, b_right = _solve(dr, v * dc - radius * length, v * dc + radius * length)
+        body_left = torch.maximum(a_left, b_left) + c0
+        body_right = torch.minimum(a_right, b_right) + c0
+        empty = (body_left > body_right) | (length2 == 0)
+
+        # a capsule is convex, the parts of a row join to one interval
+        torch.minimum(left, body_left.masked_fill_(empty, inf), out=left)
+        torch.maximum(right, body_right.masked_fill_(empty, -inf), out=right)
+        left = left.ceil_().clamp_(0, width)
+        right = right.floor_().clamp_(-1, width - 1)
+        valid = left <= right
+
+        base = (index[seg][valid] * height + row[valid]) * (width + 1)
+        ones = torch.ones_like(base, dtype=diff.dtype)
+        diff.index_add_(0, base + left[valid].long(), ones)
+        diff.index_add_(0, base + right[valid].long() + 1, -ones)
+
+    coverage = diff.view(n, height, width + 1).cumsum_(-1)[..., :width]
+    # counts are small integers, exact in float32
+    return coverage > 0.5
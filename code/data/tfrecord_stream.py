@@ -0,0 +1,351 @@
+"""
+Streaming reader for TFRecord files.
+
+Every file gets a record index (offset and size of every record) which is
+built once and stored next to the manifests, an index written by
+``tfrecord.tools.tfrecord2idx`` (``<file>.index``) is used as it is. The
+records are split between DDP ranks and dataloader workers, read block by
+block with one read call per block, shuffled through a bounded buffer and
+parsed on the fly, so every record is read once per epoch and more workers
+read more records at the same time.
+
+Record layout of a TFRecord file:
+    uint64 length, uint32 masked crc32 of length, data, uint32 masked crc32
+of data, the data is a serialized tf.train.Example. The crcs are not checked.
+"""
+import glob
+import hashlib
+import os
+import random
+import struct
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+# length and crc before, crc after the data
+HEADER_SIZE = 12
+FOOTER_SIZE = 4
+
+
+def build_index(path):
+    """Scans a TFRecord file.
+
+    Returns:
+        np.ndarray: (n, 2) int64, start and size of every record, like the
+        tfrecord2idx index.
+    """
+    records = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < size:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                raise ValueError(f"Truncated record at {offset} in {path}")
+            length = struct.unpack("<Q", header[:8])[0]
+            record_size = HEADER_SIZE + length + FOOTER_SIZE
+            records.append((offset, record_size))
+            offset += record_size
+            f.seek(offset)
+    return np.array(records, dtype=np.int64).reshape(-1, 2)
+
+
+def index_file(path, index_dir=None):
+    """Location of the cached index of a TFRecord file, keyed by path, size
+    and mtime so a changed file gets a new index."""
+    if not index_dir:
+        index_dir = os.path.join(
+            os.path.expanduser("~"), ".cache", "traiNNer", "manifests"
+        )
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = hashlib.sha1(
+        f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8")
+    ).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(index_dir, f"tfrecord_{name}_{key}.npy")
+
+
+def load_index(path, index_dir=None):
+    """Loads the record index of a TFRecord file, builds it if needed."""
+    if os.path.isfile(path + ".index"):
+        index = np.loadtxt(path + ".index", dtype=np.int64, ndmin=2)
+        return index.reshape(-1, 2)
+
+    cache = index_file(path, index_dir)
+    if os.path.isfile(cache):
+        try:
+            return np.load(cache)
+        except (OSError, ValueError) as e:
+            print(f"Rebuilding broken index {cache}: {e}")
+
+    print(f"Building record index for {path}, this only happens once.")
+    index = build_index(path)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp_path = cache + f".{os.getpid()}.tmp.npy"
+        np.save(tmp_path, index)
+        os.replace(tmp_path, cache)
+    except OSError as e:
+        print(f"Could not save index {cache}: {e}")
+    return index
+
+
+def expand_paths(paths):
+    """TFRecord files of a file, folder or glob pattern, or a list of them."""
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                sorted(
+                    os.path.join(path, name)
+                    for name in os.listdir(path)
+                    if name.endswith((".tfrecords", ".tfrecord"))
+                )
+            )
+        elif any(c in path for c in "*?["):
+            files.extend(sorted(glob.glob(path)))
+        else:
+            files.append(path)
+    return files
+
+
+######################
+# tf.train.Example
+######################
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """(field number, wire type, value) of every field of a protobuf message."""
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 1:
+            value, pos = buf[pos : pos + 8], pos + 8
+        elif wire == 2:
+            length, pos = _varint(buf, pos)
+            value, pos = buf[pos : pos + length], pos + length
+        elif wire == 5:
+            value, pos = buf[pos : pos + 4], pos + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire}")
+        yield field, wire, value
+
+
+def _feature(buf):
+    # Feature is a oneof of BytesList (1), FloatList (2) and Int64List (3)
+    for kind, _, values in _fields(buf):
+        if kind == 1:
+            data = [bytes(value) for field, _, value in _fields(values) if field == 1]
+            return data[0] if len(data) == 1 else data
+        if kind == 2:
+            data = [
+                np.frombuffer(value, dtype="<f4")
+                for field, _, value in _fields(values)
+                if field == 1
+            ]
+            return np.concatenate(data) if data else np.zeros(0, np.float32)
+        if kind == 3:
+            data = []
+            for field, wire, value in _fields(values):
+                if field != 1:
+                    continue
+                if wire == 0:
+                    data.append(value)
+                    continue
+                pos = 0
+                while pos < len(value):
+                    item, pos = _varint(value, pos)
+                    data.append(item)
+            # negative values are 64 bit two's complement
+            data = [item - (1 << 64) if item >= 1 << 63 else item for item in data]
+            return np.array(data, dtype=np.int64)
+    return None
+
+
+def parse_example(record):
+    """Features of a serialized tf.train.Example.
+
+    Returns:
+        dict: feature name -> bytes (a list for more than one value), int64 or
+        float32 array.
+    """
+    features = {}
+    record = memoryview(record)
+    for field, _, message in _fields(record):
+        if field != 1:  # Example.features
+            continue
+        for field, _, entry in _fields(message):
+            if field != 1:  # Features.feature map entries
+                continue
+            key, value = "", b""
+            for field, _, data in _fields(entry):
+                if field == 1:
+                    key = bytes(data).decode("utf-8")
+                elif field == 2:
+                    value = data
+            features[key] = _feature(value)
+    return features
+
+
+######################
+# Dataset
+######################
+
+
+class TFRecordStream(IterableDataset):
+    """Streams the parsed tf.train.Example records of TFRecord files.
+
+    Every DDP rank gets an equal contiguous part of all records (the last
+    ``total % world_size`` records are dropped, like DistributedSampler with
+    drop_last), which is split into blocks of block_size records for the
+    dataloader workers. Workers read their blocks in random order and shuffle
+    the records through a buffer of shuffle_buffer records.
+
+    Args:
+        paths: TFRecord file, folder, glob pattern or a list of them.
+        index_dir (str): where the record indices are stored, defaults to
+            ``~/.cache/traiNNer/manifests``.
+        shuffle_buffer (int): records kept in memory per worker for
+            shuffling, 0 to read them in file order.
+        block_size (int): records which are read at once.
+        return_index (bool): yield (record index, features) pairs, the index
+            is the position of the record in all files.
+    """
+
+    def __init__(
+        self,
+        paths,
+        index_dir=None,
+        shuffle_buffer=256,
+        block_size=64,
+        return_index=False,
+    ):
+        self.paths = expand_paths(paths)
+        if len(self.paths) == 0:
+            raise RuntimeError(f"Found no tfrecord files in {paths}")
+        self.shuffle_buffer = shuffle_buffer
+        self.block_size = block_size
+        self.return_index = return_index
+
+        indices = [load_index(path, index_dir) for path in self.paths]
+        self.files = np.concatenate(
+            [np.full(len(index), i, dtype=np.int32) for i, index in enumerate(indices)]
+        )
+        index = np.concatenate(indices)
+        self.offsets = index[:, 0]
+        self.sizes = index[:, 1]
+
+        self._handles = {}
+        self._pid = None
+
+    def __getstate__(self):
+        # file handles are per process
+        state = self.__dict__.copy()
+        state["_handles"] = {}
+        state["_pid"] = None
+        return state
+
+    @staticmethod
+    def shard():
+        """(rank, world_size, worker id, number of workers)"""
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker = get_worker_info()
+        if worker is None:
+            return rank, world_size, 0, 1
+        return rank, world_size, worker.id, worker.num_workers
+
+    @property
+    def num_records(self):
+        # records of all files and ranks
+        return len(self.offsets)
+
+    def __len__(self):
+        # records of this rank
+        return len(self.offsets) // self.shard()[1]
+
+    def _file(self, i):
+        if self._pid != os.getpid():
+            self._handles = {}
+            self._pid = os.getpid()
+        if i not in self._handles:
+            self._handles[i] = open(self.paths[i], "rb")
+        return self._handles[i]
+
+    def read_block(self, start, end):
+        """(index, raw Example bytes) of the records start to end (exclusive)."""
+        while start < end:
+            # records of the same file are read with one call
+            file = self.files[start]
+            stop = start + np.searchsorted(self.files[start:end], file, side="right")
+            first = self.offsets[start]
+            f = self._file(int(file))
+            f.seek(first)
+            data = memoryview(
+                f.read(self.offsets[stop - 1] + self.sizes[stop - 1] - first)
+            )
+            for i in range(start, stop):
+                pos = self.offsets[i] - first + HEADER_SIZE
+                # a copy, a slice would keep the whole block alive in the
+                # shuffle buffer
+                yield i, bytes(
+                    data[pos : pos + self.sizes[i] - HEADER_SIZE - FOOTER_SIZE]
+                )
+            start = stop
+
+    def read_records(self, indices):
+        """(index, raw Example bytes) of the given records, in that order."""
+        for i in indices:
+            yield from self.read_block(int(i), int(i) + 1)
+
+    def records(self):
+        """(index, raw Example bytes) of this rank and worker, shuffled."""
+        rank, world_size, worker, num_workers = self.shard()
+        per_rank = len(self.offsets) // world_size
+        first = rank * per_rank
+        blocks = list(range(first, first + per_rank, self.block_size))
+        blocks = blocks[worker::num_workers]
+        if self.shuffle_buffer > 0:
+            # python random is seeded differently in every worker and epoch
+            random.shuffle(blocks)
+
+        buffer = []
+        for start in blocks:
+            end = min(start + self.block_size, first + per_rank)
+            for record in self.read_block(start, end):
+                if self.shuffle_buffer <= 0:
+                    yield record
+                    continue
+                buffer.append(record)
+                if len(buffer) >= self.shuffle_buffer:
+                    i = random.randrange(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+        random.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        for i, record in self.records():
+            if self.return_index:
+                yield i, parse_example(record)
+            else:
+                yield parse_example(record)
@@ -0,0 +1,240 @@
+"""
+Packed uint8 frame triplets for the interpolation dataloaders.
+
+VimeoTriplet decodes three full size jpgs and resizes them for every sample,
+the npy files of scripts/create_npy.py keep float32 frames at 1280x720 and
+can only be read through DALI. TripletWriter resizes the frames once to the
+training resolution and stores them as uint8 in fixed size chunk files,
+TripletStore memory maps the chunks and returns views, so a sample needs
+neither decoding nor resizing nor a copy.
+
+Layout of a store folder:
+    meta.json          version, number of triplets, frame size, chunk size
+    index.npy          (count, 2) int64, chunk and slot of every triplet
+    names.npy          utf-8 blob with the source names
+    name_offsets.npy   offsets into names.npy
+    chunk_00000.npy    (triplets, 3, height, width, 3) uint8 RGB, frame1 to
+                       frame3 in order
+
+merge_triplet_stores combines stores into one without copying frames, its
+meta.json lists the chunk files of the parts in chunk_files.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+TRIPLET_STORE_VERSION = 1
+
+
+class TripletWriter:
+    """Writes frame triplets into a store folder.
+
+    Args:
+        out_dir (str): output folder.
+        height, width (int): frames are resized to this size with INTER_AREA.
+        chunk_size (int): triplets per chunk file, 1024 triplets at 448x256
+            are about 1 GB.
+    """
+
+    def __init__(self, out_dir, height=256, width=448, chunk_size=1024):
+        self.out_dir = out_dir
+        self.height = height
+        self.width = width
+        self.chunk_size = chunk_size
+
+        os.makedirs(out_dir, exist_ok=True)
+        self.records = []
+        self.names = []
+        self.chunk = -1
+        self.slot = chunk_size
+        self.data = None
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.out_dir, f"chunk_{chunk:05d}.npy")
+
+    def _next_chunk(self):
+        self._close_chunk()
+        self.chunk += 1
+        self.slot = 0
+        self.data = np.lib.format.open_memmap(
+            self._chunk_path(self.chunk),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(self.chunk_size, 3, self.height, self.width, 3),
+        )
+
+    def _close_chunk(self):
+        if self.data is None:
+            return
+        self.data.flush()
+        if self.slot < self.chunk_size:
+            # last chunk, only keep the written triplets
+            path = self._chunk_path(self.chunk)
+            np.save(path + ".tmp.npy", self.data[: self.slot])
+            del self.data
+            os.replace(path + ".tmp.npy", path)
+        self.data = None
+
+    def add(self, frames, name=""):
+        """Adds one triplet.
+
+        Args:
+            frames: frame1, frame2 and frame3 as RGB uint8 arrays, any size.
+            name (str): source name, e.g. the triplet folder.
+        """
+        if self.slot >= self.chunk_size:
+            self._next_chunk()
+        for i, frame in enumerate(frames):
+            if frame.shape[:2] != (self.height, self.width):
+                frame = cv2.resize(
+                    frame, (self.width, self.height), interpolation=cv2.INTER_AREA
+                )
+            self.data[self.slot, i] = frame
+        self.records.append((self.chunk, self.slot))
+        self.names.append(name.encode("utf-8"))
+        self.slot += 1
+
+    def close(self):
+        self._close_chunk()
+        index = np.array(self.records, dtype=np.int64).reshape(-1, 2)
+        np.save(os.path.join(self.out_dir, "index.npy"), index)
+        np.save(
+            os.path.join(self.out_dir, "names.npy"),
+            np.frombuffer(b"".join(self.names), dtype=np.uint8),
+        )
+        np.save(
+            os.path.join(self.out_dir, "name_offsets.npy"),
+            np.concatenate([[0], np.cumsum([len(n) for n in self.names])]).astype(
+                np.int64
+            ),
+        )
+        with open(os.path.join(self.out_dir, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": TRIPLET_STORE_VERSION,
+                    "count": len(self.records),
+                    "height": self.height,
+                    "width": self.width,
+                    "chunk_size": self.chunk_size,
+                    "chunks": self.chunk + 1,
+                },
+                f,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TripletStore:
+    """Random access to a store folder written by TripletWriter.
+
+    Chunks get mapped lazily in every dataloader worker. Triplets are
+    returned as (3, height, width, 3) uint8 views into the mapping.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != TRIPLET_STORE_VERSION:
+            raise ValueError(f"Unsupported triplet store version {meta['version']}")
+        self.height = meta["height"]
+        self.width = meta["width"]
+        self.num_chunks = meta["chunks"]
+        # merged stores reference the chunks of their parts
+        self.chunk_files = meta.get(
+            "chunk_files", [f"chunk_{i:05d}.npy" for i in range(self.num_chunks)]
+        )
+
+        self.index = np.load(os.path.join(store_dir, "index.npy"), mmap_mode="r")
+        self.names = np.load(os.path.join(store_dir, "names.npy"), mmap_mode="r")
+        self.name_offsets = np.load(
+            os.path.join(store_dir, "name_offsets.npy"), mmap_mode="r"
+        )
+        self._maps = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # mappings are per process, workers map the chunks again
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        state["_pid"] = None
+        return state
+
+    def _map(self, chunk):
+        if self._pid != os.getpid():
+            self._maps = {}
+            self._pid = os.getpid()
+        if chunk not in self._maps:
+            path = os.path.join(self.store_dir, self.chunk_files[chunk])
+            # copy-on-write, the views are writable without touching the file
+            self._maps[chunk] = np.load(path, mmap_mode="c")
+        return self._maps[chunk]
+
+    def name(self, idx):
+        start, end = self.name_offsets[idx], self.name_offsets[idx + 1]
+        return self.names[start:end].tobytes().decode("utf-8")
+
+    def __getitem__(self, idx):
+        chunk, slot = self.index[idx]
+        return self._map(int(chunk))[slot]
+
+
+def merge_triplet_stores(part_dirs, out_dir):
+    """Writes a store in out_dir which indexes the chunks of other stores.
+
+    The parts stay where they are, so they should live inside out_dir (their
+    paths are stored relative to it) and have the same frame size.
+    """
+    index, names, chunk_files = [], [], []
+    height = width = None
+    for part_dir in part_dirs:
+        part = TripletStore(part_dir)
+        if height is None:
+            height, width = part.height, part.width
+        elif (part.height, part.width) != (height, width):
+            raise ValueError(f"Frame size of {part_dir} does not match")
+        if len(part) == 0:
+            continue
+        part_index = np.array(part.index)
+        part_index[:, 0] += len(chunk_files)
+        index.append(part_index)
+        prefix = os.path.basename(os.path.normpath(part_dir))
+        names.extend(
+            f"{prefix}/{part.name(i)}".encode("utf-8") for i in range(len(part))
+        )
+        relative = os.path.relpath(part_dir, out_dir)
+        chunk_files.extend(os.path.join(relative, f) for f in part.chunk_files)
+
+    os.makedirs(out_dir, exist_ok=True)
+    index = np.concatenate(index) if index else np.zeros((0, 2), dtype=np.int64)
+    np.save(os.path.join(out_dir, "index.npy"), index)
+    np.save(
+        os.path.join(out_dir, "names.npy"),
+        np.frombuffer(b"".join(names), dtype=np.uint8),
+    )
+    np.save(
+        os.path.join(out_dir, "name_offsets.npy"),
+        np.concatenate([[0], np.cumsum([len(n) for n in names])]).astype(np.int64),
+    )
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": TRIPLET_STORE_VERSION,
+                "count": len(index),
+                "height": height,
+                "width": width,
+                "chunk_size": None,
+                "chunks": len(chunk_files),
+                "chunk_files": chunk_files,
+            },
+            f,
+        )
@@ -0,0 +1,239 @@
+"""
+Frame windows read straight from video files.
+
+Building an interpolation dataset used to take scenedetect, an ffmpeg export
+of every frame to jpg and a PSNR pass over the exported files. VideoWindows
+indexes the packets of every video once (presentation timestamps and
+keyframes, no decoding) and decodes frames on demand: a window seeks to the
+keyframe in front of its first frame and decodes that whole GOP, which is
+kept in a per-worker LRU cache, so neighbouring windows reuse the decoded
+frames. Windows which cross a scene cut can be detected with is_scene_cut.
+
+Needs PyAV (pip install av). The index of a video is stored in manifest_dir:
+    video_<name>_<key>.npz   pts of all frames and of the keyframes, the key
+                             covers path, size and mtime of the video
+"""
+import glob
+import hashlib
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+VIDEO_EXTENSIONS = (".mkv", ".webm", ".mp4", ".mov", ".avi")
+
+
+def build_video_index(path):
+    """Demuxes the first video stream without decoding it.
+
+    Returns:
+        (pts, keyframes): sorted int64 presentation timestamps of all frames
+        and of the keyframes.
+    """
+    import av
+
+    pts, keyframes = [], []
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        for packet in container.demux(stream):
+            # the flush packet at the end has no timestamp
+            if packet.pts is None:
+                continue
+            pts.append(packet.pts)
+            if packet.is_keyframe:
+                keyframes.append(packet.pts)
+    pts = np.sort(np.array(pts, dtype=np.int64))
+    keyframes = np.unique(np.array(keyframes, dtype=np.int64))
+    # frames in front of the first keyframe get decoded from the start
+    if len(pts) > 0 and (len(keyframes) == 0 or keyframes[0] > pts[0]):
+        keyframes = np.insert(keyframes, 0, pts[0])
+    return pts, keyframes
+
+
+def video_index_file(path, index_dir=None):
+    """Location of the cached index of a video, keyed by path, size and mtime."""
+    if not index_dir:
+        index_dir = os.path.join(
+            os.path.expanduser("~"), ".cache", "traiNNer", "manifests"
+        )
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = hashlib.sha1(
+        f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8")
+    ).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(index_dir, f"video_{name}_{key}.npz")
+
+
+def load_video_index(path, index_dir=None):
+    """Loads the packet index of a video, builds it if needed."""
+    cache = video_index_file(path, index_dir)
+    if os.path.isfile(cache):
+        try:
+            with np.load(cache) as index:
+                return index["pts"], index["keyframes"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Rebuilding broken index {cache}: {e}")
+
+    pts, keyframes = build_video_index(path)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp_path = cache + f".{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, pts=pts, keyframes=keyframes)
+        os.replace(tmp_path, cache)
+    except OSError as e:
+        print(f"Could not save index {cache}: {e}")
+    return pts, keyframes
+
+
+def find_videos(root):
+    """Video files in a folder and its subfolders, or a single video file."""
+    if os.path.isfile(root):
+        return [root]
+    files = glob.glob(os.path.join(root, "**", "*"), recursive=True)
+    return sorted(f for f in files if f.lower().endswith(VIDEO_EXTENSIONS))
+
+
+def psnr(img1, img2, max_value=255):
+    mse = np.mean((img1.astype(np.float32) - img2.astype(np.float32)) ** 2)
+    if mse == 0:
+        return 100
+    return 20 * np.log10(max_value / np.sqrt(mse))
+
+
+def is_scene_cut(frames, threshold=10):
+    """True if two neighbouring frames have a PSNR <= threshold, the check of
+    scripts/triplet_dataset.py."""
+    return any(
+        psnr(frames[i], frames[i + 1]) <= threshold for i in range(len(frames) - 1)
+    )
+
+
+class VideoWindows:
+    """Random access to windows of consecutive frames of video files.
+
+    Args:
+        paths (list): video files.
+        window (int): frames per window.
+        stride (int): frames between the first frames of two windows.
+        size (tuple): (width, height) the frames are resized to with
+            INTER_AREA, None keeps the video size.
+        cache_frames (int): decoded frames kept per process, whole GOPs are
+            dropped in least recently used order.
+        index_dir (str): where the packet indices are stored, defaults to
+            ``~/.cache/traiNNer/manifests``.
+    """
+
+    def __init__(
+        self,
+        paths,
+        window=3,
+        stride=1,
+        size=(448, 256),
+        cache_frames=512,
+        index_dir=None,
+    ):
+        self.paths = list(paths)
+        self.window = window
+        self.stride = stride
+        self.size = tuple(size) if size else None
+        self.cache_frames = cache_frames
+
+        self.pts, self.keyframes, windows = [], [], []
+        for video, path in enumerate(self.paths):
+            pts, keyframes = load_video_index(path, index_dir)
+            self.pts.append(pts)
+            self.keyframes.append(keyframes)
+            starts = np.arange(0, len(pts) - window + 1, stride, dtype=np.int64)
+            windows.append(np.stack([np.full_like(starts, video), starts], 1))
+        # (video, first frame) of every window, in file order
+        self.windows = np.concatenate(windows) if windows else np.zeros((0, 2))
+
+        self._gops = OrderedDict()
+        self._cached = 0
+        self._containers = OrderedDict()
+        self._pid = None
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getstate__(self):
+        # decoders and decoded frames are per process
+        state = self.__dict__.copy()
+        state["_gops"] = OrderedDict()
+        state["_cached"] = 0
+        state["_containers"] = OrderedDict()
+        state["_pid"] = None
+        return state
+
+    def _container(self, video):
+        import av
+
+        if video in self._containers:
+            self._containers.move_to_end(video)
+        else:
+            container = av.open(self.paths[video])
+            container.streams.video[0].thread_type = "AUTO"
+            self._containers[video] = container
+            # a few open files are enough, windows are read video by video
+            while len(self._containers) > 4:
+                self._containers.popitem(last=False)[1].close()
+        return self._containers[video]
+
+    def _decode_gop(self, video, gop):
+        """Decodes all frames from keyframe gop up to the next keyframe."""
+        container = self._container(video)
+        stream = container.streams.video[0]
+        keyframes = self.keyframes[video]
+        start = keyframes[gop]
+        end = keyframes[gop + 1] if gop + 1 < len(keyframes) else None
+        container.seek(int(start), stream=stream, backward=True, any_frame=False)
+
+        pts, frames = [], []
+        for frame in container.decode(stream):
+            if frame.pts is None or frame.pts < start:
+                continue
+            if end is not None and frame.pts >= end:
+                break
+            image = frame.to_ndarray(format="rgb24")
+            if self.size is not None and image.shape[1::-1] != self.size:
+                image = cv2.resize(image, self.size, interpolation=cv2.INTER_AREA)
+            pts.append(frame.pts)
+            frames.append(image)
+        if len(frames) == 0:
+            raise RuntimeError(f"Could not decode {self.paths[video]} at pts {start}")
+        return np.array(pts, dtype=np.int64), frames
+
+    def _gop(self, video, gop):
+        if self._pid != os.getpid():
+            # forked worker, the decoders of the parent can not be shared
+            self._gops = OrderedDict()
+            self._cached = 0
+            self._containers = OrderedDict()
+            self._pid = os.getpid()
+        key = (video, gop)
+        if key in self._gops:
+            self._gops.move_to_end(key)
+            return self._gops[key]
+        decoded = self._decode_gop(video, gop)
+        self._gops[key] = decoded
+        self._cached += len(decoded[1])
+        while self._cached > self.cache_frames and len(self._gops) > 1:
+            _, (_, frames) = self._gops.popitem(last=False)
+            self._cached -= len(frames)
+        return decoded
+
+    def frame(self, video, i):
+        """Frame i (presentation order) of a video, RGB uint8."""
+        pts = self.pts[video][i]
+        gop = np.searchsorted(self.keyframes[video], pts, side="right") - 1
+        gop_pts, frames = self._gop(video, int(gop))
+        # the decoder can drop broken frames, take the closest one in front
+        j = max(np.searchsorted(gop_pts, pts, side="right") - 1, 0)
+        return frames[j]
+
+    def __getitem__(self, idx):
+        """The frames of window idx, a list of RGB uint8 arrays."""
+        video, start = self.windows[idx]
+        return [self.frame(int(video), int(start) + i) for i in range(self.window)]
@@ -0,0 +1,111 @@
+"""
+Background writer for the validation outputs.
+
+validation_step used to convert, encode and write every output with
+save_image on the training process. ImageWriter converts a batch to uint8 on
+its device, copies it into pinned host memory without blocking and encodes
+and writes the images in a thread pool (cv2 releases the GIL while encoding).
+At most queue_size batches are pending, write() blocks when the queue is
+full. flush() waits for all pending images.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import torch
+
+
+class ImageWriter:
+    """Writes batches of images in background threads.
+
+    Args:
+        threads (int): encoding threads, 0 writes the images in write().
+        queue_size (int): batches that can be pending before write() blocks.
+        extension (str): "png", "webp" or "jpg".
+        level (int): png compression level 0-9, quality 0-100 for jpg and webp.
+    """
+
+    def __init__(self, threads=2, queue_size=16, extension="png", level=1):
+        self.threads = threads
+        self.extension = extension.lower().lstrip(".")
+        if self.extension == "png":
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, level]
+        elif self.extension == "webp":
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, level]
+        elif self.extension in ("jpg", "jpeg"):
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, level]
+        else:
+            raise ValueError(f"{extension} is not a supported image format.")
+
+        self._slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self._pool = None
+        self._pending = []
+        self._dirs = set()
+
+    @classmethod
+    def from_config(cls, cfg):
+        val_cfg = cfg["datasets"]["val"]
+        return cls(
+            threads=val_cfg["image_threads"],
+            extension=val_cfg["image_format"],
+            level=val_cfg["image_level"],
+        )
+
+    def write(self, images, paths):
+        """Queues a batch of images.
+
+        Args:
+            images (Tensor): (b, c, h, w) RGB or grayscale images in range
+                [0, 1], on any device.
+            paths (list): one output file per image, folders are created.
+        """
+        # rounding of torchvision.utils.save_image
+        images = images.detach().mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+        images = images.permute(0, 2, 3, 1)
+        event = None
+        if images.is_cuda:
+            host = torch.empty(images.shape, dtype=torch.uint8, pin_memory=True)
+            host.copy_(images, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            images = host
+        else:
+            images = images.contiguous()
+
+        if self.threads <= 0:
+            self._write(images, list(paths), event)
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.threads)
+        self._slots.acquire()
+        future = self._pool.submit(self._write, images, list(paths), event)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+
+    def _write(self, images, paths, event):
+        if event is not None:
+            event.synchronize()
+        # every folder once per batch instead of an exists check per file
+        for folder in {os.path.dirname(path) for path in paths} - self._dirs:
+            os.makedirs(folder, exist_ok=True)
+            self._dirs.add(folder)
+        images = images.numpy()
+        for image, path in zip(images, paths):
+            if image.shape[-1] == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            if not cv2.imwrite(path, image, self.params):
+                raise OSError(f"Could not write {path}")
+
+    def flush(self):
+        """Waits until all queued images are written, raises the first error."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
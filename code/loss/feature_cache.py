@@ -0,0 +1,98 @@
+"""
+Per-step cache of the backbone features of the feature losses.
+
+StyleLoss, Contextual_Loss, PNetLin (perceptual), ResNetPL (hrf_perceptual),
+TIMM_FeatureLoss and the ViT losses each ran their backbone over the output
+and the HR image. FeatureCache runs every backbone once per input image and
+step, losses with the same backbone key share the features. The HR image is
+only a target, its features are computed without autograd and optionally
+with autocast. AllLoss clears the cache before and after every step.
+"""
+import torch
+
+
+def feature_dtype(features):
+    """dtype of the first floating point tensor of nested features."""
+    if isinstance(features, torch.Tensor):
+        return features.dtype if features.is_floating_point() else None
+    if isinstance(features, dict):
+        features = list(features.values())
+    if isinstance(features, (list, tuple)):
+        for value in features:
+            dtype = feature_dtype(value)
+            if dtype is not None:
+                return dtype
+    return None
+
+
+def cast_features(features, dtype):
+    """Casts the floating point tensors of nested features to dtype."""
+    if isinstance(features, torch.Tensor):
+        return features.to(dtype) if features.is_floating_point() else features
+    if isinstance(features, dict):
+        return type(features)(
+            (key, cast_features(value, dtype)) for key, value in features.items()
+        )
+    if isinstance(features, tuple) and hasattr(features, "_fields"):
+        return type(features)(*(cast_features(value, dtype) for value in features))
+    if isinstance(features, (list, tuple)):
+        return type(features)(cast_features(value, dtype) for value in features)
+    return features
+
+
+class FeatureCache:
+    """Features of the images of one step, keyed by backbone and image.
+
+    Args:
+        autocast (bool): compute the target features with autocast, fp16 on
+            cuda and bf16 on cpu. They are cast back to the dtype of the
+            output features of the same key, so losses get the features of
+            their output before the ones of their target.
+    """
+
+    def __init__(self, autocast=False):
+        self.autocast = autocast
+        # (key, id(images), target, grad mode): (images, features)
+        self._features = {}
+        # key: dtype of the output features
+        self._dtypes = {}
+
+    def __call__(self, key, fn, images, target=False):
+        """fn(images), computed once per step for a key and an image.
+
+        Args:
+            key: hashable name of the backbone and its preprocessing, losses
+                with equal keys share their features.
+            fn: computes the features of images.
+            images (Tensor): the image tensor the loss got, the features are
+                reused for the same tensor object.
+            target (bool): features of a target without gradients.
+        """
+        # output features computed under no_grad have no graph to train
+        # through, target features never have one
+        grad = torch.is_grad_enabled() and not target
+        cache_key = (key, id(images), target, grad)
+        entry = self._features.get(cache_key)
+        # the id of a freed tensor can be reused
+        if entry is not None and entry[0] is images:
+            return entry[1]
+
+        if target:
+            device_type = images.device.type
+            with torch.no_grad(), torch.autocast(
+                device_type,
+                dtype=torch.float16 if device_type == "cuda" else torch.bfloat16,
+                enabled=self.autocast,
+            ):
+                features = fn(images)
+            if self.autocast:
+                features = cast_features(features, self._dtypes.get(key, images.dtype))
+        else:
+            features = fn(images)
+            self._dtypes[key] = feature_dtype(features) or images.dtype
+        self._features[cache_key] = (images, features)
+        return features
+
+    def clear(self):
+        self._features = {}
+        self._dtypes = {}
@@ -775,6 +775,14 @@ class Contextual_Loss(nn.Module):
         else:  # if calc_type == 'regular':
             self.calculate_loss = self.calculate_CX_Loss
 
+        self.feature_cache = None
+
+    def features(self, images, target=False):
+        fn = self.model if self.use_vgg else self.model.forward_features
+        if self.feature_cache is None:
+            return fn(images)
+        return self.feature_cache((self.model, self.use_vgg), fn, images, target)
+
     def forward(self, images, gt):
         device = images.device
 
@@ -785,13 +793,13 @@ class Contextual_Loss(nn.Module):
         # features
         loss = 0
         if self.use_vgg:
-            vgg_images = self.model(images)
+            vgg_images = self.features(images)
             vgg_images = {k: v.clone().to(device) for k, v in vgg_images.items()}
-            vgg_gt = self.model(gt)
+            vgg_gt = self.features(gt, target=True)
             vgg_gt = {k: v.to(device) for k, v in vgg_gt.items()}
         elif self.use_timm:
-            vgg_images = self.model.forward_features(images)
-            vgg_gt = self.model.forward_features(gt)
+            vgg_images = self.features(images)
+            vgg_gt = self.features(gt, target=True)
 
         # calc locss
         if self.use_vgg:
@@ -1161,9 +1169,15 @@ class StyleLoss(nn.Module):
 
         self.add_module("vgg", VGG16())
         self.criterion = nn.L1Loss()
+        self.feature_cache = None
+
+    def features(self, images, target=False):
+        if self.feature_cache is None:
+            return self.vgg(images)
+        return self.feature_cache(self.vgg, self.vgg, images, target)
 
     def forward(self, x, y):
-        x_vgg, y_vgg = self.vgg(x), self.vgg(y)
+        x_vgg, y_vgg = self.features(x), self.features(y, target=True)
 
         style_loss = 0.0
         for x_feat, y_feat in zip(x_vgg, y_vgg):
@@ -2297,39 +2311,49 @@ class LaplacianLoss(nn.Module):
 import torchvision
 
 
+VIT_MODEL = "google/vit-base-patch16-224"
+
+
+def load_vit_model():
+    return ViTModel.from_pretrained(VIT_MODEL, output_hidden_states=True)
+
+
+def vit_features(vit_model, images, device):
+    """Last hidden state of the ViT for images resized to 224x224."""
+    if images.shape[-1] != 224 or images.shape[-2] != 224:
+        images = torchvision.transforms.functional.resize(images, (224, 224))
+    return vit_model(images.to(device)).hidden_states[-1]
+
+
 class VIT_FeatureLoss(nn.Module):
-    def __init__(self, device="cuda"):
+    def __init__(self, device="cuda", vit_model=None):
         super(VIT_FeatureLoss, self).__init__()
         self.device = device
-        self.vit_model = ViTModel.from_pretrained(
-            "google/vit-base-patch16-224", output_hidden_states=True
-        )
+        # pass vit_model to share it with VIT_MMD_FeatureLoss
+        self.vit_model = vit_model if vit_model is not None else load_vit_model()
         # self.vit_model = ViTModel.from_pretrained(
         #    "google/vit-large-patch16-224", output_hidden_states=True
         # )
         self.criterion = nn.MSELoss()
+        self.feature_cache = None
 
-    def forward(self, real_images, generated_images):
-        if real_images.shape[-1] != 224 or real_images.shape[-2] != 224:
-            real_images = torchvision.transforms.functional.resize(
-                real_images, (224, 224)
-            )
-        if generated_images.shape[-1] != 224 or generated_images.shape[-2] != 224:
-            generated_images = torchvision.transforms.functional.resize(
-                generated_images, (224, 224)
-            )
+    def features(self, images, target=False):
+        def fn(images):
+            return vit_features(self.vit_model, images, self.device)
 
+        if self.feature_cache is None:
+            return fn(images)
+        # both ViT losses use the same model and share the features
+        return self.feature_cache(("vit", VIT_MODEL), fn, images, target)
+
+    def forward(self, real_images, generated_images):
         # Extract features from real images
         loss = 0
         with torch.no_grad():
-            real_features = (
-                self.vit_model(real_images.to(self.device)).hidden_states[-1].detach()
-            )
+            real_features = self.features(real_images).detach()
 
             # Extract features from generated images
-            generated_features = self.vit_model(
-                generated_images.to(self.device)
-            ).hidden_states[-1]
+            generated_features = self.features(generated_images, target=True)
 
             # Compute feature loss
             loss = self.criterion(real_features, generated_features)
@@ -2342,36 +2366,30 @@ class VIT_FeatureLoss(nn.Module):
 
 
 class VIT_MMD_FeatureLoss(nn.Module):
-    def __init__(self, device="cuda", sigma=1):
+    def __init__(self, device="cuda", sigma=1, vit_model=None):
         super(VIT_MMD_FeatureLoss, self).__init__()
         self.device = device
-        self.vit_model = ViTModel.from_pretrained(
-            "google/vit-base-patch16-224", output_hidden_states=True
-        )
+        self.vit_model = vit_model if vit_model is not None else load_vit_model()
         self.criterion = nn.MSELoss()
         self.sigma = sigma
+        self.feature_cache = None
 
-    def forward(self, real_images, generated_images):
-        if real_images.shape[-1] != 224 or real_images.shape[-2] != 224:
-            real_images = torchvision.transforms.functional.resize(
-                real_images, (224, 224)
-            )
-        if generated_images.shape[-1] != 224 or generated_images.shape[-2] != 224:
-            generated_images = torchvision.transforms.functional.resize(
-                generated_images, (224, 224)
-            )
+    def features(self, images, target=False):
+        def fn(images):
+            return vit_features(self.vit_model, images, self.device)
+
+        if self.feature_cache is None:
+            return fn(images)
+        return self.feature_cache(("vit", VIT_MODEL), fn, images, target)
 
+    def forward(self, real_images, generated_images):
         # Extract features from real images
         loss = 0
         with torch.no_grad():
-            real_features = (
-                self.vit_model(real_images.to(self.device)).hidden_states[-1].detach()
-            )
+            real_features = self.features(real_images).detach()
 
             # Extract features from generated images
-            generated_features = self.vit_model(
-                generated_images.to(self.device)
-            ).hidden_states[-1]
+            generated_features = self.features(generated_images, target=True)
 
             # Compute feature loss
             mse_loss = self.criterion(real_features, generated_features)
@@ -2446,34 +2464,32 @@ class TIMM_FeatureLoss(nn.Module):
         elif criterion == "kullback":
             self.criterion = nn.KLDivLoss()
 
-    def forward(self, real_images, generated_images):
-        if self.fp16:
-            real_images = real_images.half()
-            generated_images = generated_images.half()
-
-        if self.normalize:
-            real_images = (real_images - self.mean) / self.std
-            generated_images = (generated_images - self.mean) / self.std
+        self.feature_cache = None
+
+    def features(self, images, target=False):
+        def fn(images):
+            if self.fp16:
+                images = images.half()
+            if self.normalize:
+                images = (images - self.mean) / self.std
+            if (
+                images.shape[-1] != self.resolution
+                or images.shape[-2] != self.resolution
+            ):
+                images = torchvision.transforms.functional.resize(
+                    images, (self.resolution, self.resolution)
+                )
+            return self.model(images)
 
-        if (
-            real_images.shape[-1] != self.resolution
-            or real_images.shape[-2] != self.resolution
-        ):
-            real_images = torchvision.transforms.functional.resize(
-                real_images, (self.resolution, self.resolution)
-            )
-        if (
-            generated_images.shape[-1] != self.resolution
-            or generated_images.shape[-2] != self.resolution
-        ):
-            generated_images = torchvision.transforms.functional.resize(
-                generated_images, (self.resolution, self.resolution)
-            )
+        if self.feature_cache is None:
+            return fn(images)
+        return self.feature_cache(self.model, fn, images, target)
 
+    def forward(self, real_images, generated_images):
         loss = 0
         with torch.no_grad():
-            real_features = self.model(real_images)
-            generated_features = self.model(generated_images)
+            real_features = self.features(real_images)
+            generated_features = self.features(generated_images, target=True)
 
             if self.last_feature:
                 loss = self.criterion(real_features[-1], generated_features[-1])
@@ -1,316 +1,579 @@
+"""
+Losses of the generator and the discriminator.
+
+Most losses are only used with a weight > 0 in config.yaml, but some of them
+load pretrained networks (LPIPS, ViT, timm, Inception, DISTS, PieAPP), which
+takes time and memory at startup. The optional losses are registered in
+LOSS_REGISTRY with their weight key and AllLoss only builds (and imports) the
+ones with a weight > 0.
+"""
+import importlib
+import os
+import time
+
 import pytorch_lightning as pl
-from loss.loss import (
-    FocalFrequencyLoss,
-    feature_matching_loss,
-    FrobeniusNormLoss,
-    LapLoss,
-    HFENLoss,
-    TVLoss,
-    GradientLoss,
-    ElasticLoss,
-    RelativeL1,
-    L1CosineSim,
-    ClipL1,
-    MultiscalePixelLoss,
-    FFTloss,
-    OFLoss,
-    YUVColorLoss,
-    XYZColorLoss,
-    GPLoss,
-    CPLoss,
-    SPLoss,
-    Contextual_Loss,
-    StyleLoss,
-    ConsistencyLoss,
-    CannyLoss,
-    KullbackHistogramLoss,
-    SalientRegionLoss,
-    glcmLoss,
-    GradientDomainLoss,
-    SobelLoss,
-    ColorHarmonyLoss,
-    VIT_FeatureLoss,
-    VIT_MMD_FeatureLoss,
-    TIMM_FeatureLoss,
-    LaplacianLoss,
-    SobelLossV2,
-    textured_loss,
-)
-from piq import (
-    SSIMLoss,
-    MultiScaleSSIMLoss,
-    VIFLoss,
-    FSIMLoss,
-    GMSDLoss,
-    MultiScaleGMSDLoss,
-    VSILoss,
-    HaarPSILoss,
-    MDSILoss,
-    BRISQUELoss,
-    PieAPP,
-    DISTS,
-    IS,
-    FID,
-    KID,
-    PR,
-)
 import torch
 import torch.nn as nn
-import os
 from torch.autograd import Variable
 
+# weight key: (attribute, config keys, builder)
+LOSS_REGISTRY = {}
 
-class AllLoss(pl.LightningModule):
-    def __init__(self, cfg):
-        super().__init__()
-        self.save_hyperparameters()
-        self.automatic_optimization = False
 
-        # loss functions
-        self.l1 = nn.L1Loss()
+def register_loss(weight, name, keys=()):
+    """Registers builder(train_cfg, shared) of the loss stored as
+    AllLoss.<name>. shared holds the backbones which losses share, it is the
+    same dict for all builders of an AllLoss.
 
-        if cfg["train"]["loss_f"] == "L1Loss":
-            loss_f = torch.nn.L1Loss()
-        elif cfg["train"]["loss_f"] == "L1CosineSim":
-            loss_f = L1CosineSim(
-                loss_lambda=cfg["train"]["loss_lambda"],
-                reduction=cfg["train"]["reduction_L1CosineSim"],
-            )
+    Args:
+        weight (str): train key of the weight, the loss is only built if it
+            is > 0.
+        name (str): attribute of the loss in AllLoss.
+        keys (tuple): other train keys the builder reads.
+    """
 
-        self.HFENLoss = HFENLoss(
-            loss_f=loss_f,
-            kernel=cfg["train"]["kernel"],
-            kernel_size=cfg["train"]["kernel_size"],
-            sigma=cfg["train"]["sigma"],
-            norm=cfg["train"]["norm"],
-        )
-        self.ElasticLoss = ElasticLoss(
-            a=cfg["train"]["a"], reduction=cfg["train"]["reduction_elastic"]
-        )
-        self.RelativeL1 = RelativeL1(
-            eps=cfg["train"]["l1_eps"], reduction=cfg["train"]["reduction_relative"]
-        )
-        self.L1CosineSim = L1CosineSim(
-            loss_lambda=cfg["train"]["loss_lambda"],
-            reduction=cfg["train"]["reduction_L1CosineSim"],
-        )
-        self.ClipL1 = ClipL1(
-            clip_min=cfg["train"]["clip_min"], clip_max=cfg["train"]["clip_max"]
-        )
+    def decorator(builder):
+        LOSS_REGISTRY[weight] = (name, tuple(keys), builder)
+        return builder
 
-        if cfg["train"]["loss_f_fft"] == "L1Loss":
-            loss_f_fft = torch.nn.L1Loss
-        elif cfg["train"]["loss_f_fft"] == "L1CosineSim":
-            loss_f_fft = L1CosineSim(
-                loss_lambda=cfg["train"]["loss_lambda"],
-                reduction=cfg["train"]["reduction_L1CosineSim"],
-            )
+    return decorator
 
-        self.FFTloss = FFTloss(
-            loss_f=loss_f_fft, reduction=cfg["train"]["reduction_fft"]
-        )
-        self.OFLoss = OFLoss()
-        self.GPLoss = GPLoss(
-            trace=cfg["train"]["gp_trace"], spl_denorm=cfg["train"]["gp_spl_denorm"]
-        )
-        self.CPLoss = CPLoss(
-            rgb=cfg["train"]["rgb"],
-            yuv=cfg["train"]["yuv"],
-            yuvgrad=cfg["train"]["yuvgrad"],
-            trace=cfg["train"]["cp_trace"],
-            spl_denorm=cfg["train"]["cp_spl_denorm"],
-            yuv_denorm=cfg["train"]["yuv_denorm"],
-        )
-        self.StyleLoss = StyleLoss()
-        self.TVLoss = TVLoss(tv_type=cfg["train"]["tv_type"], p=cfg["train"]["p"])
-        self.Contextual_Loss = Contextual_Loss(
-            cfg["train"]["layers_weights"],
-            crop_quarter=cfg["train"]["crop_quarter"],
-            max_1d_size=cfg["train"]["max_1d_size"],
-            distance_type=cfg["train"]["distance_type"],
-            b=cfg["train"]["b"],
-            band_width=cfg["train"]["band_width"],
-            use_vgg=cfg["train"]["use_vgg"],
-            net=cfg["train"]["net_contextual"],
-            calc_type=cfg["train"]["calc_type"],
-            use_timm=cfg["train"]["use_timm"],
-            timm_model=cfg["train"]["timm_model"],
-        )
-        self.textured_loss = textured_loss()
 
-        self.MSELoss = torch.nn.MSELoss()
-        self.L1Loss = nn.L1Loss()
-        self.BCELogits = torch.nn.BCEWithLogitsLoss()
-        self.BCE = torch.nn.BCELoss()
-        self.FFLoss = FocalFrequencyLoss()
-
-        # perceptual loss
-        from arch.networks_basic import PNetLin
-
-        self.perceptual_loss = PNetLin(
-            pnet_rand=cfg["train"]["pnet_rand"],
-            pnet_tune=cfg["train"]["pnet_tune"],
-            pnet_type=cfg["train"]["pnet_type"],
-            use_dropout=cfg["train"]["use_dropout"],
-            spatial=cfg["train"]["spatial"],
-            version=cfg["train"]["version"],
-            lpips=cfg["train"]["lpips"],
+def register_class(weight, name, module, class_name, **kwargs):
+    """Registers a loss which is built without config keys."""
+
+    def builder(train_cfg, shared):
+        return getattr(importlib.import_module(module), class_name)(**kwargs)
+
+    register_loss(weight, name)(builder)
+
+
+@register_loss(
+    "HFEN_weight",
+    "HFENLoss",
+    keys=("loss_f", "loss_lambda", "kernel", "kernel_size", "sigma", "norm"),
+)
+def build_hfen(train_cfg, shared):
+    from loss.loss import HFENLoss, L1CosineSim
+
+    if train_cfg["loss_f"] == "L1Loss":
+        loss_f = torch.nn.L1Loss()
+    elif train_cfg["loss_f"] == "L1CosineSim":
+        loss_f = L1CosineSim(
+            loss_lambda=train_cfg["loss_lambda"],
+            reduction=train_cfg["reduction_L1CosineSim"],
         )
-        model_path = os.path.abspath(
-            f'loss/lpips_weights/v0.1/{cfg["train"]["pnet_type"]}.pth'
+
+    return HFENLoss(
+        loss_f=loss_f,
+        kernel=train_cfg["kernel"],
+        kernel_size=train_cfg["kernel_size"],
+        sigma=train_cfg["sigma"],
+        norm=train_cfg["norm"],
+    )
+
+
+@register_loss("Elastic_weight", "ElasticLoss", keys=("a", "reduction_elastic"))
+def build_elastic(train_cfg, shared):
+    from loss.loss import ElasticLoss
+
+    return ElasticLoss(a=train_cfg["a"], reduction=train_cfg["reduction_elastic"])
+
+
+@register_loss(
+    "Relative_l1_weight", "RelativeL1", keys=("l1_eps", "reduction_relative")
+)
+def build_relative_l1(train_cfg, shared):
+    from loss.loss import RelativeL1
+
+    return RelativeL1(
+        eps=train_cfg["l1_eps"], reduction=train_cfg["reduction_relative"]
+    )
+
+
+@register_loss(
+    "L1CosineSim_weight",
+    "L1CosineSim",
+    keys=("loss_lambda", "reduction_L1CosineSim"),
+)
+def build_l1_cosine_sim(train_cfg, shared):
+    from loss.loss import L1CosineSim
+
+    return L1CosineSim(
+        loss_lambda=train_cfg["loss_lambda"],
+        reduction=train_cfg["reduction_L1CosineSim"],
+    )
+
+
+@register_loss("ClipL1_weight", "ClipL1", keys=("clip_min", "clip_max"))
+def build_clip_l1(train_cfg, shared):
+    from loss.loss import ClipL1
+
+    return ClipL1(clip_min=train_cfg["clip_min"], clip_max=train_cfg["clip_max"])
+
+
+@register_loss(
+    "FFTLoss_weight", "FFTloss", keys=("loss_f_fft", "loss_lambda", "reduction_fft")
+)
+def build_fft(train_cfg, shared):
+    from loss.loss import FFTloss, L1CosineSim
+
+    if train_cfg["loss_f_fft"] == "L1Loss":
+        loss_f_fft = torch.nn.L1Loss
+    elif train_cfg["loss_f_fft"] == "L1CosineSim":
+        loss_f_fft = L1CosineSim(
+            loss_lambda=train_cfg["loss_lambda"],
+            reduction=train_cfg["reduction_L1CosineSim"],
         )
-        print(f"Loading model from: {model_path}")
-        self.perceptual_loss.load_state_dict(
-            torch.load(model_path, map_location=torch.device(self.device)), strict=False
+
+    return FFTloss(loss_f=loss_f_fft, reduction=train_cfg["reduction_fft"])
+
+
+@register_loss("GPLoss_weight", "GPLoss", keys=("gp_trace", "gp_spl_denorm"))
+def build_gp(train_cfg, shared):
+    from loss.loss import GPLoss
+
+    return GPLoss(trace=train_cfg["gp_trace"], spl_denorm=train_cfg["gp_spl_denorm"])
+
+
+@register_loss(
+    "CPLoss_weight",
+    "CPLoss",
+    keys=("rgb", "yuv", "yuvgrad", "cp_trace", "cp_spl_denorm", "yuv_denorm"),
+)
+def build_cp(train_cfg, shared):
+    from loss.loss import CPLoss
+
+    return CPLoss(
+        rgb=train_cfg["rgb"],
+        yuv=train_cfg["yuv"],
+        yuvgrad=train_cfg["yuvgrad"],
+        trace=train_cfg["cp_trace"],
+        spl_denorm=train_cfg["cp_spl_denorm"],
+        yuv_denorm=train_cfg["yuv_denorm"],
+    )
+
+
+@register_loss("TVLoss_weight", "TVLoss", keys=("tv_type", "p"))
+def build_tv(train_cfg, shared):
+    from loss.loss import TVLoss
+
+    return TVLoss(tv_type=train_cfg["tv_type"], p=train_cfg["p"])
+
+
+@register_loss(
+    "Contextual_weight",
+    "Contextual_Loss",
+    keys=(
+        "layers_weights",
+        "crop_quarter",
+        "max_1d_size",
+        "distance_type",
+        "b",
+        "band_width",
+        "use_vgg",
+        "net_contextual",
+        "calc_type",
+        "use_timm",
+        "timm_model",
+    ),
+)
+def build_contextual(train_cfg, shared):
+    from loss.loss import Contextual_Loss
+
+    return Contextual_Loss(
+        train_cfg["layers_weights"],
+        crop_quarter=train_cfg["crop_quarter"],
+        max_1d_size=train_cfg["max_1d_size"],
+        distance_type=train_cfg["distance_type"],
+        b=train_cfg["b"],
+        band_width=train_cfg["band_width"],
+        use_vgg=train_cfg["use_vgg"],
+        net=train_cfg["net_contextual"],
+        calc_type=train_cfg["calc_type"],
+        use_timm=train_cfg["use_timm"],
+        timm_model=train_cfg["timm_model"],
+    )
+
+
+@register_loss(
+    "perceptual_weight",
+    "perceptual_loss",
+    keys=(
+        "pnet_rand",
+        "pnet_tune",
+        "pnet_type",
+        "use_dropout",
+        "spatial",
+        "version",
+        "lpips",
+        "force_fp16_perceptual",
+        "perceptual_tensorrt",
+    ),
+)
+def build_perceptual(train_cfg, shared):
+    from arch.networks_basic import PNetLin
+
+    perceptual_loss = PNetLin(
+        pnet_rand=train_cfg["pnet_rand"],
+        pnet_tune=train_cfg["pnet_tune"],
+        pnet_type=train_cfg["pnet_type"],
+        use_dropout=train_cfg["use_dropout"],
+        spatial=train_cfg["spatial"],
+        version=train_cfg["version"],
+        lpips=train_cfg["lpips"],
+    )
+    model_path = os.path.abspath(
+        f'loss/lpips_weights/v0.1/{train_cfg["pnet_type"]}.pth'
+    )
+    print(f"Loading model from: {model_path}")
+    perceptual_loss.load_state_dict(
+        torch.load(model_path, map_location=torch.device("cpu")), strict=False
+    )
+    for param in perceptual_loss.parameters():
+        param.requires_grad = False
+
+    if (
+        train_cfg["force_fp16_perceptual"] is True
+        and train_cfg["perceptual_tensorrt"] is False
+    ):
+        print("Converting perceptual model to FP16")
+        perceptual_loss = perceptual_loss.half()
+
+    if (
+        train_cfg["force_fp16_perceptual"] is True
+        and train_cfg["perceptual_tensorrt"] is True
+    ):
+        print("Converting perceptual model to TensorRT (FP16)")
+        import torch_tensorrt
+
+        example_data = torch.rand(1, 3, 256, 448).half().cuda()
+        perceptual_loss = perceptual_loss.half().cuda()
+        perceptual_loss = torch.jit.trace(perceptual_loss, [example_data, example_data])
+        perceptual_loss = torch_tensorrt.compile(
+            perceptual_loss,
+            inputs=[
+                torch_tensorrt.Input(
+                    min_shape=(1, 3, 64, 64),
+                    opt_shape=(1, 3, 256, 448),
+                    max_shape=(1, 3, 720, 1280),
+                    dtype=torch.half,
+                ),
+                torch_tensorrt.Input(
+                    min_shape=(1, 3, 64, 64),
+                    opt_shape=(1, 3, 256, 448),
+                    max_shape=(1, 3, 720, 1280),
+                    dtype=torch.half,
+                ),
+            ],
+            enabled_precisions={torch.half},
+            truncate_long_and_double=True,
         )
-        for param in self.perceptual_loss.parameters():
-            param.requires_grad = False
+        del example_data
 
-        if (
-            cfg["train"]["force_fp16_perceptual"] is True
-            and cfg["train"]["perceptual_tensorrt"] is False
-        ):
-            print("Converting perceptual model to FP16")
-            self.perceptual_loss = self.perceptual_loss.half()
+    elif (
+        train_cfg["force_fp16_perceptual"] is False
+        and train_cfg["perceptual_tensorrt"] is True
+    ):
+        print("Converting perceptual model to TensorRT")
+        import torch_tensorrt
+
+        example_data = torch.rand(1, 3, 256, 448)
+        perceptual_loss = torch.jit.trace(perceptual_loss, [example_data, example_data])
+        perceptual_loss = torch_tensorrt.compile(
+            perceptual_loss,
+            inputs=[
+                torch_tensorrt.Input(
+                    min_shape=(1, 3, 64, 64),
+                    opt_shape=(1, 3, 256, 448),
+                    max_shape=(1, 3, 720, 1280),
+                    dtype=torch.float32,
+                ),
+                torch_tensorrt.Input(
+                    min_shape=(1, 3, 64, 64),
+                    opt_shape=(1, 3, 256, 448),
+                    max_shape=(1, 3, 720, 1280),
+                    dtype=torch.float32,
+                ),
+            ],
+            enabled_precisions={torch.float},
+            truncate_long_and_double=True,
+        )
+        del example_data
+
+    return perceptual_loss
+
+
+@register_loss(
+    "Canny_weight",
+    "CannyLoss",
+    keys=(
+        "canny_threshold",
+        "canny_blurred_img_weight",
+        "canny_grad_mag_weight",
+        "canny_thin_edges_weight",
+        "canny_thresholded_weight",
+        "canny_early_threshold",
+    ),
+)
+def build_canny(train_cfg, shared):
+    from loss.loss import CannyLoss
+
+    return CannyLoss(
+        threshold=train_cfg["canny_threshold"],
+        blurred_img_weight=train_cfg["canny_blurred_img_weight"],
+        grad_mag_weight=train_cfg["canny_grad_mag_weight"],
+        grad_orientation_weight=train_cfg["canny_grad_mag_weight"],
+        thin_edges_weight=train_cfg["canny_thin_edges_weight"],
+        thresholded_weight=train_cfg["canny_thresholded_weight"],
+        early_threshold=train_cfg["canny_early_threshold"],
+    )
+
+
+@register_loss(
+    "TIMM_FeatureLoss_weight",
+    "TIMM_FeatureLoss",
+    keys=(
+        "TIMM_FeatureLoss_arch",
+        "TIMM_FeatureLoss_resolution",
+        "TIMM_FeatureLoss_fp16",
+        "TIMM_FeatureLoss_criterion",
+        "TIMM_FeatureLoss_normalize",
+        "TIMM_FeatureLoss_last_feature",
+    ),
+)
+def build_timm_feature(train_cfg, shared):
+    from loss.loss import TIMM_FeatureLoss
+
+    return TIMM_FeatureLoss(
+        model_arch=train_cfg["TIMM_FeatureLoss_arch"],
+        resolution=train_cfg["TIMM_FeatureLoss_resolution"],
+        fp16=train_cfg["TIMM_FeatureLoss_fp16"],
+        criterion=train_cfg["TIMM_FeatureLoss_criterion"],
+        normalize=train_cfg["TIMM_FeatureLoss_normalize"],
+        last_feature=train_cfg["TIMM_FeatureLoss_last_feature"],
+    )
+
+
+@register_loss("hrf_perceptual_weight", "hrf_perceptual_loss", keys=("force_fp16_hrf",))
+def build_hrf_perceptual(train_cfg, shared):
+    from arch.hrf_perceptual import ResNetPL
+
+    hrf_perceptual_loss = ResNetPL()
+    for param in hrf_perceptual_loss.parameters():
+        param.requires_grad = False
+
+    if train_cfg["force_fp16_hrf"] is True:
+        hrf_perceptual_loss = hrf_perceptual_loss.half()
+    return hrf_perceptual_loss
+
+
+def shared_vit_model(shared):
+    """One ViT for both ViT losses."""
+    from loss.loss import load_vit_model
+
+    if "vit_model" not in shared:
+        shared["vit_model"] = load_vit_model()
+    return shared["vit_model"]
+
+
+@register_loss("VIT_FeatureLoss_weight", "VIT_FeatureLoss")
+def build_vit_feature(train_cfg, shared):
+    from loss.loss import VIT_FeatureLoss
+
+    return VIT_FeatureLoss(vit_model=shared_vit_model(shared))
+
+
+@register_loss("VIT_MMD_FeatureLoss_weight", "VIT_MMD_FeatureLoss")
+def build_vit_mmd_feature(train_cfg, shared):
+    from loss.loss import VIT_MMD_FeatureLoss
+
+    return VIT_MMD_FeatureLoss(vit_model=shared_vit_model(shared))
+
+
+# losses without config keys
+for weight, name, module, class_name, kwargs in (
+    ("OFLoss_weight", "OFLoss", "loss.loss", "OFLoss", {}),
+    ("StyleLoss_weight", "StyleLoss", "loss.loss", "StyleLoss", {}),
+    ("textured_loss_weight", "textured_loss", "loss.loss", "textured_loss", {}),
+    ("MSE_weight", "MSELoss", "torch.nn", "MSELoss", {}),
+    ("BCE_weight", "BCELogits", "torch.nn", "BCEWithLogitsLoss", {}),
+    ("FFLoss_weight", "FFLoss", "loss.loss", "FocalFrequencyLoss", {}),
+    (
+        "KullbackHistogramLoss_weight",
+        "KullbackHistogramLoss",
+        "loss.loss",
+        "KullbackHistogramLoss",
+        {},
+    ),
+    (
+        "SalientRegionLoss_weight",
+        "SalientRegionLoss",
+        "loss.loss",
+        "SalientRegionLoss",
+        {},
+    ),
+    ("glcmLoss_weight", "glcmLoss", "loss.loss", "glcmLoss", {}),
+    (
+        "GradientDomainLoss_weight",
+        "GradientDomainLoss",
+        "loss.loss",
+        "GradientDomainLoss",
+        {},
+    ),
+    ("SobelLoss_weight", "SobelLoss", "loss.loss", "SobelLoss", {}),
+    (
+        "ColorHarmonyLoss_weight",
+        "ColorHarmonyLoss",
+        "loss.loss",
+        "ColorHarmonyLoss",
+        {},
+    ),
+    ("LaplacianLoss_weight", "LaplacianLoss", "loss.loss", "LaplacianLoss", {}),
+    ("SobelLossV2_weight", "SobelLossV2", "loss.loss", "SobelLossV2", {}),
+    ("YUVColorLoss_weight", "YUVColorLoss", "loss.loss", "YUVColorLoss", {}),
+    ("XYZColorLoss_weight", "XYZColorLoss", "loss.loss", "XYZColorLoss", {}),
+    (
+        "FrobeniusNormLoss_weight",
+        "FrobeniusNormLoss",
+        "loss.loss",
+        "FrobeniusNormLoss",
+        {},
+    ),
+    ("GradientLoss_weight", "GradientLoss", "loss.loss", "GradientLoss", {}),
+    (
+        "MultiscalePixelLoss_weight",
+        "MultiscalePixelLoss",
+        "loss.loss",
+        "MultiscalePixelLoss",
+        {},
+    ),
+    ("SPLoss_weight", "SPLoss", "loss.loss", "SPLoss", {}),
+    ("Huber_weight", "HuberLoss", "torch.nn", "HuberLoss", {}),
+    ("SmoothL1_weight", "SmoothL1Loss", "torch.nn", "SmoothL1Loss", {}),
+    ("Lap_weight", "LapLoss", "loss.loss", "LapLoss", {}),
+    # piq loss
+    ("SSIMLoss_weight", "SSIMLoss", "piq", "SSIMLoss", {}),
+    (
+        "MultiScaleSSIMLoss_weight",
+        "MultiScaleSSIMLoss",
+        "piq",
+        "MultiScaleSSIMLoss",
+        {},
+    ),
+    ("VIFLoss_weight", "VIFLoss", "piq", "VIFLoss", {}),
+    ("FSIMLoss_weight", "FSIMLoss", "piq", "FSIMLoss", {}),
+    ("GMSDLoss_weight", "GMSDLoss", "piq", "GMSDLoss", {}),
+    (
+        "MultiScaleGMSDLoss_weight",
+        "MultiScaleGMSDLoss",
+        "piq",
+        "MultiScaleGMSDLoss",
+        {},
+    ),
+    ("VSILoss_weight", "VSILoss", "piq", "VSILoss", {}),
+    ("HaarPSILoss_weight", "HaarPSILoss", "piq", "HaarPSILoss", {}),
+    ("MDSILoss_weight", "MDSILoss", "piq", "MDSILoss", {}),
+    ("BRISQUELoss_weight", "BRISQUELoss", "piq", "BRISQUELoss", {}),
+    ("PieAPP_weight", "PieAPP", "piq", "PieAPP", {"enable_grad": True}),
+    ("DISTS_weight", "DISTS", "piq", "DISTS", {}),
+    ("IS_weight", "IS", "piq", "IS", {}),
+    ("FID_weight", "FID", "piq", "FID", {}),
+    ("KID_weight", "KID", "piq", "KID", {}),
+    ("PR_weight", "PR", "piq", "PR", {}),
+):
+    register_class(weight, name, module, class_name, **kwargs)
+
+
+def weights_bytes(losses):
+    """Memory of the parameters and buffers of losses, shared backbones are
+    counted once."""
+    tensors = {}
+    for loss in losses:
+        if isinstance(loss, nn.Module):
+            for t in list(loss.parameters()) + list(loss.buffers()):
+                tensors[id(t)] = t
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+def build_losses(train_cfg, weights, strict=True):
+    """Builds the registered losses of the weight keys.
+
+    Args:
+        train_cfg (dict): train section of config.yaml.
+        weights (list): weight keys of LOSS_REGISTRY.
+        strict (bool): raise if a loss can not be built, otherwise it is
+            left out.
+
+    Returns:
+        dict: attribute: loss, float: seconds it took
+    """
+    start = time.perf_counter()
+    losses, shared = {}, {}
+    for weight in weights:
+        name, keys, builder = LOSS_REGISTRY[weight]
+        try:
+            missing = [key for key in keys if key not in train_cfg]
+            if missing:
+                raise ValueError(f"{weight} > 0 needs the train keys {missing}.")
+            losses[name] = builder(train_cfg, shared)
+        except Exception as e:
+            if strict:
+                raise
+            print(f"Could not build {name}: {e}")
+    return losses, time.perf_counter() - start
 
-        if (
-            cfg["train"]["force_fp16_perceptual"] is True
-            and cfg["train"]["perceptual_tensorrt"] is True
-        ):
-            print("Converting perceptual model to TensorRT (FP16)")
-            import torch_tensorrt
 
-            example_data = torch.rand(1, 3, 256, 448).half().cuda()
-            self.perceptual_loss = self.perceptual_loss.half().cuda()
-            self.perceptual_loss = torch.jit.trace(
-                self.perceptual_loss, [example_data, example_data]
-            )
-            self.perceptual_loss = torch_tensorrt.compile(
-                self.perceptual_loss,
-                inputs=[
-                    torch_tensorrt.Input(
-                        min_shape=(1, 3, 64, 64),
-                        opt_shape=(1, 3, 256, 448),
-                        max_shape=(1, 3, 720, 1280),
-                        dtype=torch.half,
-                    ),
-                    torch_tensorrt.Input(
-                        min_shape=(1, 3, 64, 64),
-                        opt_shape=(1, 3, 256, 448),
-                        max_shape=(1, 3, 720, 1280),
-                        dtype=torch.half,
-                    ),
-                ],
-                enabled_precisions={torch.half},
-                truncate_long_and_double=True,
-            )
-            del example_data
+class AllLoss(pl.LightningModule):
+    def __init__(self, cfg):
+        super().__init__()
+        self.save_hyperparameters()
+        self.automatic_optimization = False
 
-        elif (
-            cfg["train"]["force_fp16_perceptual"] is False
-            and cfg["train"]["perceptual_tensorrt"] is True
-        ):
-            print("Converting perceptual model to TensorRT")
-            import torch_tensorrt
+        # loss functions which are also used without a weight
+        self.l1 = nn.L1Loss()
+        self.L1Loss = nn.L1Loss()
+        self.BCE = torch.nn.BCELoss()
 
-            example_data = torch.rand(1, 3, 256, 448)
-            self.perceptual_loss = torch.jit.trace(
-                self.perceptual_loss, [example_data, example_data]
+        if cfg["train"]["loss_build_baseline"] is True:
+            # startup of building every loss, like before the registry
+            losses, seconds = build_losses(
+                cfg["train"], list(LOSS_REGISTRY), strict=False
             )
-            self.perceptual_loss = torch_tensorrt.compile(
-                self.perceptual_loss,
-                inputs=[
-                    torch_tensorrt.Input(
-                        min_shape=(1, 3, 64, 64),
-                        opt_shape=(1, 3, 256, 448),
-                        max_shape=(1, 3, 720, 1280),
-                        dtype=torch.float32,
-                    ),
-                    torch_tensorrt.Input(
-                        min_shape=(1, 3, 64, 64),
-                        opt_shape=(1, 3, 256, 448),
-                        max_shape=(1, 3, 720, 1280),
-                        dtype=torch.float32,
-                    ),
-                ],
-                enabled_precisions={torch.float},
-                truncate_long_and_double=True,
+            print(
+                f"Building all {len(LOSS_REGISTRY)} losses took {seconds:.2f}s, "
+                f"{weights_bytes(losses.values()) / 2**20:.1f} MiB of weights "
+                f"({len(LOSS_REGISTRY) - len(losses)} failed)"
             )
-            del example_data
-
-        self.ConsistencyLoss = ConsistencyLoss()
-
-        self.CannyLoss = CannyLoss(
-            threshold=cfg["train"]["canny_threshold"],
-            blurred_img_weight=cfg["train"]["canny_blurred_img_weight"],
-            grad_mag_weight=cfg["train"]["canny_grad_mag_weight"],
-            grad_orientation_weight=cfg["train"]["canny_grad_mag_weight"],
-            thin_edges_weight=cfg["train"]["canny_thin_edges_weight"],
-            thresholded_weight=cfg["train"]["canny_thresholded_weight"],
-            early_threshold=cfg["train"]["canny_early_threshold"],
+            del losses
+
+        # only build the registered losses with a weight > 0
+        losses, seconds = build_losses(
+            cfg["train"], [w for w in LOSS_REGISTRY if cfg["train"][w] > 0]
         )
+        for name, loss in losses.items():
+            setattr(self, name, loss)
+        self.active_losses = list(losses)
+        print(
+            f"Built {len(losses)} of {len(LOSS_REGISTRY)} losses in {seconds:.2f}s, "
+            f"{weights_bytes(losses.values()) / 2**20:.1f} MiB of weights: "
+            f"{', '.join(losses)}"
+        )
+
+        # the feature losses run every backbone once per step and image
+        from loss.feature_cache import FeatureCache
 
-        self.KullbackHistogramLoss = KullbackHistogramLoss()
-        self.SalientRegionLoss = SalientRegionLoss()
-        self.glcmLoss = glcmLoss()
-        self.GradientDomainLoss = GradientDomainLoss()
-        self.SobelLoss = SobelLoss()
-        self.ColorHarmonyLoss = ColorHarmonyLoss()
-        self.VIT_FeatureLoss = VIT_FeatureLoss()
-        self.VIT_MMD_FeatureLoss = VIT_MMD_FeatureLoss()
-        self.TIMM_FeatureLoss = TIMM_FeatureLoss(
-            model_arch=cfg["train"]["TIMM_FeatureLoss_arch"],
-            resolution=cfg["train"]["TIMM_FeatureLoss_resolution"],
-            fp16=cfg["train"]["TIMM_FeatureLoss_fp16"],
-            criterion=cfg["train"]["TIMM_FeatureLoss_criterion"],
-            normalize=cfg["train"]["TIMM_FeatureLoss_normalize"],
-            last_feature=cfg["train"]["TIMM_FeatureLoss_last_feature"],
+        self.feature_cache = FeatureCache(
+            autocast=cfg["train"]["feature_cache_autocast"]
         )
+        for name in self.active_losses:
+            if hasattr(getattr(self, name), "feature_cache"):
+                getattr(self, name).feature_cache = self.feature_cache
+
+        if cfg["network_G"]["netG"] == "CSA":
+            from loss.loss import ConsistencyLoss
 
-        self.LaplacianLoss = LaplacianLoss()
-        self.SobelLossV2 = SobelLossV2()
-
-        from arch.hrf_perceptual import ResNetPL
-
-        self.hrf_perceptual_loss = ResNetPL()
-        for param in self.hrf_perceptual_loss.parameters():
-            param.requires_grad = False
-
-        if cfg["train"]["force_fp16_hrf"] is True:
-            self.hrf_perceptual_loss = self.hrf_perceptual_loss.half()
-
-        self.YUVColorLoss = YUVColorLoss()
-        self.XYZColorLoss = XYZColorLoss()
-
-        self.FrobeniusNormLoss = FrobeniusNormLoss()
-        self.GradientLoss = GradientLoss()
-        self.MultiscalePixelLoss = MultiscalePixelLoss()
-        self.SPLoss = SPLoss()
-
-        # pytorch loss
-        self.HuberLoss = nn.HuberLoss()
-        self.SmoothL1Loss = nn.SmoothL1Loss()
-        self.SoftMarginLoss = nn.SoftMarginLoss()
-
-        self.LapLoss = LapLoss()
-
-        # piq loss
-        self.SSIMLoss = SSIMLoss()
-        self.MultiScaleSSIMLoss = MultiScaleSSIMLoss()
-        self.VIFLoss = VIFLoss()
-        self.FSIMLoss = FSIMLoss()
-        self.GMSDLoss = GMSDLoss()
-        self.MultiScaleGMSDLoss = MultiScaleGMSDLoss()
-        self.VSILoss = VSILoss()
-        self.HaarPSILoss = HaarPSILoss()
-        self.MDSILoss = MDSILoss()
-        self.BRISQUELoss = BRISQUELoss()
-        self.PieAPP = PieAPP(enable_grad=True)
-        self.DISTS = DISTS()
-        self.IS = IS()
-        self.FID = FID()
-        self.KID = KID()
-        self.PR = PR()
+            self.ConsistencyLoss = ConsistencyLoss()
 
         if cfg["network_G"]["netG"] == "rife":
             from loss.loss import SOBEL
@@ -372,6 +635,7 @@ class AllLoss(pl.LightningModule):
             g_opt, d_opt = self.optimizers()
 
         # train generator
+        self.feature_cache.clear()
         total_loss = 0
         if self.cfg["train"]["L1Loss_weight"] > 0:
             L1Loss_forward = self.cfg["train"]["L1Loss_weight"] * self.L1Loss(
@@ -1187,6 +1451,8 @@ class AllLoss(pl.LightningModule):
                     and self.cfg["network_D"]["FFCN_feature_weight"] > 0
                 ):
                     FFCN_class_orig, FFCN_feature_orig = netD(hr_image)
+                    from loss.loss import feature_matching_loss
+
                     # dont give mask if it's not available
                     if self.cfg["network_G"]["netG"] in (
                         "CDFI",
@@ -1214,6 +1480,8 @@ class AllLoss(pl.LightningModule):
                             global_step,
                         )
 
+        self.feature_cache.clear()
+
         # optimizer
         self.toggle_optimizer(g_opt)
         g_opt.zero_grad()
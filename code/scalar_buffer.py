@@ -0,0 +1,96 @@
+"""
+Buffered scalar logging for the losses.
+
+AllLoss logged every enabled loss with writer.add_scalar on every step, each
+call copies a tensor to the host (a device sync) and writes a tensorboardX
+event. ScalarBuffer has the same add_scalar interface, but accumulates the
+detached values on their device and reduces them over a window of steps.
+When a window is done, the reductions of all tags are copied to the host at
+once and written to the SummaryWriter.
+"""
+import torch
+from pytorch_lightning.utilities import rank_zero_only
+
+
+class ScalarBuffer:
+    """Drop-in for SummaryWriter.add_scalar which logs window reductions.
+
+    Args:
+        writer: tensorboardX SummaryWriter, None logs nothing.
+        window (int): steps which are reduced into one logged value, 1 logs
+            every step like add_scalar.
+        reductions (list): any of "mean", "min" and "max". The mean is logged
+            with the tag itself, min and max with "_min" and "_max" appended.
+        rank_zero_only (bool): log nothing on the other DDP ranks.
+    """
+
+    def __init__(self, writer, window=50, reductions=("mean",), rank_zero_only=True):
+        self.writer = writer
+        self.window = max(int(window), 1)
+        self.reductions = tuple(reductions)
+        self.rank_zero_only = rank_zero_only
+
+        self._step = None
+        # tag: [sum, min, max, count], sums and extrema stay on the device
+        self._values = {}
+
+    @classmethod
+    def from_config(cls, cfg, writer):
+        return cls(
+            writer,
+            window=cfg["log_window"],
+            reductions=cfg["log_reductions"],
+            rank_zero_only=cfg["log_rank_zero_only"],
+        )
+
+    def add_scalar(self, tag, value, global_step):
+        if self.writer is None:
+            return
+        if self.rank_zero_only and rank_zero_only.rank != 0:
+            return
+        if self._step is not None and (
+            global_step // self.window != self._step // self.window
+        ):
+            self.flush()
+        self._step = global_step
+
+        if isinstance(value, torch.Tensor):
+            value = value.detach().float().reshape(())
+        else:
+            value = torch.tensor(float(value))
+        if tag not in self._values:
+            self._values[tag] = [value, value, value, 1]
+            return
+        total, low, high, count = self._values[tag]
+        self._values[tag] = [
+            total + value,
+            torch.minimum(low, value),
+            torch.maximum(high, value),
+            count + 1,
+        ]
+
+    def flush(self):
+        """Writes the reductions of the current window."""
+        if not self._values:
+            return
+        tags, reduced = [], []
+        for tag, (total, low, high, count) in self._values.items():
+            if "mean" in self.reductions:
+                tags.append(tag)
+                reduced.append(total / count)
+            if "min" in self.reductions:
+                tags.append(tag + "_min")
+                reduced.append(low)
+            if "max" in self.reductions:
+                tags.append(tag + "_max")
+                reduced.append(high)
+        self._values = {}
+
+        # one transfer per device
+        values = {}
+        for device in {value.device for value in reduced}:
+            index = [i for i, value in enumerate(reduced) if value.device == device]
+            host = torch.stack([reduced[i] for i in index]).tolist()
+            values.update(zip(index, host))
+        for i, tag in enumerate(tags):
+            self.writer.add_scalar(tag, values[i], self._step)
@@ -0,0 +1,105 @@
+# Compares the batched torch camera noise pipeline with the per image NumPy one.
+# Run from the code folder: python scripts/benchmark_camera.py
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.augmentation import camera
+from data.augmentation import camera_torch
+from data.augmentation import extra_functional as EF
+
+sizes = [64, 128, 256]
+batch_size = 16
+demosaic_fns = ["bilinear", "malvar", "menon", "pixelshuffle"]
+device = "cuda" if torch.cuda.is_available() else "cpu"
+tolerance = 1e-5
+
+
+def make_images(size, rng):
+    # smooth random images, values in [0, 1]
+    low = rng.random((batch_size, 8, 8, 3))
+    images = [cv2.resize(l, (size, size), interpolation=cv2.INTER_CUBIC) for l in low]
+    return np.clip(np.stack(images), 0, 1).astype(np.float32)
+
+
+def to_tensor(images):
+    return torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2)
+
+
+def to_numpy(images):
+    return images.permute(0, 2, 3, 1).cpu().double().numpy()
+
+
+def check(images, dmscfn):
+    """Max difference of unprocess + process with the same random camera,
+    without the (random) noise."""
+    np.random.seed(0)
+    ref = []
+    for image in images:
+        raw, metadata = camera.unprocess(image)
+        out = camera.process(
+            raw[None],
+            np.array([metadata["red_gain"]]),
+            np.array([metadata["blue_gain"]]),
+            metadata["cam2rgb"][None],
+            dmscfn=dmscfn,
+        )
+        ref.append(out.reshape(image.shape))
+        # same draws as camera_torch.random_metadata()
+        camera.random_noise_levels()
+
+    np.random.seed(0)
+    metadata = {"rgb2cam": [], "rgb_gain": [], "red_gain": [], "blue_gain": []}
+    for _ in images:
+        batch_metadata = camera_torch.random_metadata(1)
+        for key in metadata:
+            metadata[key].append(batch_metadata[key][0])
+    metadata = {key: np.array(value) for key, value in metadata.items()}
+    metadata["cam2rgb"] = np.linalg.inv(metadata["rgb2cam"])
+
+    raw = camera_torch.unprocess(to_tensor(images).to(device), metadata)
+    out = camera_torch.process(
+        raw,
+        metadata["red_gain"],
+        metadata["blue_gain"],
+        metadata["cam2rgb"],
+        dmscfn=dmscfn,
+    )
+    return np.abs(np.stack(ref) - to_numpy(out)).max()
+
+
+def timed(fn):
+    fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+rng = np.random.default_rng(0)
+for size in sizes:
+    images = make_images(size, rng)
+    uint8_images = (images * 255).round().astype(np.uint8)
+    batch = to_tensor(images).to(device)
+    for dmscfn in demosaic_fns:
+        error = check(images, dmscfn)
+        assert error < tolerance, f"{dmscfn} {size}px differs by {error}"
+
+        numpy_time = timed(
+            lambda: [EF.camera_noise(image, dmscfn=dmscfn) for image in uint8_images]
+        )
+        torch_time = timed(lambda: camera_torch.camera_noise(batch, dmscfn=dmscfn))
+        print(
+            f"{dmscfn:<12} {size:>4}px  max diff {error:.1e}  "
+            f"numpy {numpy_time * 1000:8.1f} ms  "
+            f"torch ({device}) {torch_time * 1000:7.1f} ms "
+            f"({numpy_time / torch_time:5.1f}x) per batch of {batch_size}"
+        )
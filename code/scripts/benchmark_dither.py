@@ -0,0 +1,98 @@
+# Compares the vectorized Floyd-Steinberg dithering with the old pixel by pixel loop.
+# Run from the code folder: python scripts/benchmark_dither.py
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.augmentation import extra_functional as EF
+
+sizes = [64, 128, 256]
+batch_size = 16
+repeats = 3
+
+
+def minmax(v):
+    v = min(v, 255)
+    v = max(v, 0)
+    return v
+
+
+def loop_dither_fs(img):
+    # the previous noise_dither_fs, every channel handled the same way
+    size = img.shape
+    re_fs = img.copy()
+    for i in range(0, size[0] - 1):
+        for j in range(1, size[1] - 1):
+            for c in range(size[2]):
+                old_pixel = re_fs[i, j, c]
+                new_pixel = np.round(old_pixel / 255.0) * 255.0
+                re_fs[i, j, c] = new_pixel
+                quant_error = old_pixel - new_pixel
+                re_fs[i, j + 1, c] = minmax(
+                    re_fs[i, j + 1, c] + (7 / 16.0) * quant_error
+                )
+                re_fs[i + 1, j - 1, c] = minmax(
+                    re_fs[i + 1, j - 1, c] + (3 / 16.0) * quant_error
+                )
+                re_fs[i + 1, j, c] = minmax(
+                    re_fs[i + 1, j, c] + (5 / 16.0) * quant_error
+                )
+                re_fs[i + 1, j + 1, c] = minmax(
+                    re_fs[i + 1, j + 1, c] + (1 / 16.0) * quant_error
+                )
+    return re_fs
+
+
+def loop_dither_fs_bw(img):
+    # the previous noise_dither_fs_bw
+    re_fs = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    size = re_fs.shape
+    for i in range(0, size[0] - 1):
+        for j in range(1, size[1] - 1):
+            old_pixel = re_fs[i, j]
+            new_pixel = np.round(old_pixel / 255.0) * 255.0
+            re_fs[i, j] = new_pixel
+            quant_error = old_pixel - new_pixel
+            re_fs[i, j + 1] = minmax(re_fs[i, j + 1] + (7 / 16.0) * quant_error)
+            re_fs[i + 1, j - 1] = minmax(re_fs[i + 1, j - 1] + (3 / 16.0) * quant_error)
+            re_fs[i + 1, j] = minmax(re_fs[i + 1, j] + (5 / 16.0) * quant_error)
+            re_fs[i + 1, j + 1] = minmax(re_fs[i + 1, j + 1] + (1 / 16.0) * quant_error)
+    return re_fs
+
+
+def timed(fn, *args):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+rng = np.random.default_rng(0)
+for size in sizes:
+    # smooth images, flat noise hides mistakes in the error diffusion
+    images = rng.integers(0, 256, (batch_size, size, size, 3), dtype=np.uint8)
+    images = np.stack([cv2.GaussianBlur(image, (9, 9), 3) for image in images])
+
+    for name, loop_fn, fn in (
+        ("color", loop_dither_fs, EF.noise_dither_fs),
+        ("bw", loop_dither_fs_bw, EF.noise_dither_fs_bw),
+    ):
+        ref, loop_time = timed(loop_fn, images[0])
+        out, vec_time = timed(fn, images[0])
+        assert np.array_equal(ref, out), f"{name} {size}px differs from the loop"
+
+        batch, batch_time = timed(fn, images)
+        for i in (0, batch_size - 1):
+            assert np.array_equal(batch[i], fn(images[i])), f"{name} batch differs"
+
+        print(
+            f"{name:<5} {size:>4}px  loop {loop_time * 1000:9.1f} ms  "
+            f"vectorized {vec_time * 1000:7.1f} ms ({loop_time / vec_time:6.1f}x)  "
+            f"batch of {batch_size} {batch_time * 1000:7.1f} ms"
+        )
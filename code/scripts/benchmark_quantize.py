@@ -0,0 +1,120 @@
+# Compares the quantization engine (subsampled fitting, palette cache, vectorized
+# lookup) with the previous full-image k-means / SOM quantization.
+# Run from the code folder: python scripts/benchmark_quantize.py
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.augmentation import extra_functional as EF
+from data.augmentation.minisom import MiniSom
+from data.augmentation.quantize import ColorQuantizer
+
+sizes = [128, 256]
+n_images = 8
+km_colors = 32  # RandomQuantize
+mbk_colors = 128  # KMeansQuantize, aug_config default
+som_colors = 8  # RandomQuantizeSOM
+sample_size = 4096
+cache_size = 64
+# RandomQuantizeSOM defaults
+som_kwargs = dict(sigma=1.0, learning_rate=0.2, neighborhood_function="bubble")
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return 10 * np.log10(255.0**2 / max(mse, 1e-10))
+
+
+def som_quantize(img, n):
+    # the previous RandomQuantizeSOM.apply, pixel by pixel assignment
+    som = MiniSom(x=2, y=n // 2, input_len=3, **som_kwargs)
+    pixels = np.reshape(img, (img.shape[0] * img.shape[1], 3))
+    som.random_weights_init(pixels)
+    som.train_random(pixels, 500, verbose=False)
+    qnt = som.quantization(pixels)
+    clustered = np.zeros(img.shape)
+    for i, q in enumerate(qnt):
+        clustered[np.unravel_index(i, (img.shape[0], img.shape[1]))] = q
+    return np.clip(clustered, 0, 255).astype(img.dtype)
+
+
+def make_images(size, rng):
+    # smooth random color fields with some texture, closer to photos than
+    # flat noise (which has no palette to find)
+    images = []
+    for _ in range(n_images):
+        low = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        img = cv2.resize(low, (size, size), interpolation=cv2.INTER_CUBIC)
+        noise = rng.normal(0, 6, img.shape)
+        images.append(np.clip(img + noise, 0, 255).astype(np.uint8))
+    return images
+
+
+def run(fn, images):
+    start = time.perf_counter()
+    outs = [fn(img) for img in images]
+    elapsed = (time.perf_counter() - start) / len(images)
+    quality = np.mean([psnr(img, out) for img, out in zip(images, outs)])
+    return elapsed, quality
+
+
+rng = np.random.default_rng(0)
+np.random.seed(0)
+for size in sizes:
+    images = make_images(size, rng)
+    # every image twice, the second pass can be served by the palette cache
+    repeated = images + images
+
+    cases = [
+        (
+            f"km_quantize k={km_colors}",
+            lambda img: EF.km_quantize(img, km_colors),
+            ColorQuantizer(km_colors, "kmeans", sample_size=sample_size),
+            ColorQuantizer(
+                km_colors, "kmeans", sample_size=sample_size, cache_size=cache_size
+            ),
+        ),
+        (
+            f"kmeans_quantize k={mbk_colors}",
+            lambda img: EF.kmeans_quantize(img, mbk_colors),
+            ColorQuantizer(mbk_colors, "minibatch", "lab", sample_size=sample_size),
+            ColorQuantizer(
+                mbk_colors,
+                "minibatch",
+                "lab",
+                sample_size=sample_size,
+                cache_size=cache_size,
+            ),
+        ),
+        (
+            f"som k={som_colors}",
+            lambda img: som_quantize(img, som_colors),
+            ColorQuantizer(
+                som_colors, "som", sample_size=sample_size, som_kwargs=som_kwargs
+            ),
+            ColorQuantizer(
+                som_colors,
+                "som",
+                sample_size=sample_size,
+                cache_size=cache_size,
+                som_kwargs=som_kwargs,
+            ),
+        ),
+    ]
+
+    print(f"{size}x{size}, {n_images} images (time per image, mean PSNR)")
+    for name, ref_fn, engine, cached in cases:
+        ref_time, ref_psnr = run(ref_fn, images)
+        eng_time, eng_psnr = run(engine, images)
+        cached_time, cached_psnr = run(cached, repeated)
+        print(
+            f"  {name:<22} reference {ref_time * 1000:8.1f} ms {ref_psnr:5.2f} dB  "
+            f"engine {eng_time * 1000:7.1f} ms {eng_psnr:5.2f} dB "
+            f"({ref_time / eng_time:5.1f}x)  "
+            f"cached {cached_time * 1000:7.1f} ms {cached_psnr:5.2f} dB "
+            f"({cached.cache.hits} hits)"
+        )
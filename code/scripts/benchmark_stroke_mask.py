@@ -0,0 +1,49 @@
+# Compares the batched stroke masks with random_mask(), coverage statistics and time.
+# Run from the code folder: python scripts/benchmark_stroke_mask.py
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.data import random_mask
+from data.stroke_mask import StrokeMasks
+
+size = 256
+n_masks = 1024
+batch_size = 32
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def coverage(masks):
+    # share of masked pixels per mask
+    return 1 - masks.reshape(len(masks), -1).mean(1)
+
+
+np.random.seed(0)
+start = time.perf_counter()
+reference = np.stack([random_mask(height=size, width=size) for _ in range(n_masks)])
+ref_time = time.perf_counter() - start
+ref_cov = coverage(reference)
+print(
+    f"random_mask          {ref_time / n_masks * 1000:6.2f} ms/mask  "
+    f"coverage {ref_cov.mean():.3f} +- {ref_cov.std():.3f}"
+)
+
+for compat in (True, False):
+    generator = StrokeMasks(size, size, compat=compat)
+    generator(range(batch_size), device=device)
+    masks = []
+    start = time.perf_counter()
+    for i in range(0, n_masks, batch_size):
+        masks.append(generator(range(i, i + batch_size), device=device))
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    cov = coverage(torch.cat(masks).cpu().numpy())
+    print(
+        f"StrokeMasks compat={compat!s:<5} {elapsed / n_masks * 1000:6.2f} ms/mask  "
+        f"coverage {cov.mean():.3f} +- {cov.std():.3f} ({device})"
+    )
@@ -0,0 +1,44 @@
+# Packs lr/hr pairs into shards for the DS_lrhr_shard dataloader.
+# Run from the code folder: python scripts/create_shards.py
+import os
+import sys
+
+import cv2
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.manifest import load_manifest
+from data.shards import ShardWriter
+
+hr_root = "/home/user/Schreibtisch/Colab-traiNNer/train/data"
+# leave empty to only pack hr images, needs apply_otf_downscale
+lr_root = "/home/user/Schreibtisch/Colab-traiNNer/train/data_lr"
+dest_dir = "/home/user/Schreibtisch/Colab-traiNNer/train/shards"
+# raw: uncompressed rgb arrays, no decoding while training (bigger)
+# encoded: original png/jpg/webp bytes, decoded while training (smaller)
+encoding = "raw"
+shard_size = 1 << 30  # bytes per shard file
+
+
+def read(path):
+    if encoding == "encoded":
+        with open(path, "rb") as f:
+            return f.read()
+    image = cv2.imread(path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+samples = load_manifest(hr_root, lr_root=lr_root or None)
+if lr_root:
+    missing = len(samples) - int(samples.lr.sum())
+    if missing > 0:
+        print(f"Skipping {missing} hr images without lr image.")
+    samples = samples.subset(samples.lr)
+
+with ShardWriter(dest_dir, encoding=encoding, shard_size=shard_size) as writer:
+    for hr_path in tqdm(samples):
+        name = os.path.basename(hr_path)
+        lr_image = read(os.path.join(lr_root, name)) if lr_root else None
+        writer.add(read(hr_path), lr_image, name=name)
+
+print(f"Wrote {len(samples)} pairs to {dest_dir}.")
@@ -0,0 +1,53 @@
+# Packs vimeo triplets into a uint8 triplet store for the DS_video_store dataloader.
+# Reads triplet folders (frame1.jpg, frame2.jpg, frame3.jpg) or the .npy files of
+# scripts/create_npy.py.
+# Run from the code folder: python scripts/create_triplet_store.py
+import glob
+import os
+import sys
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.triplet_store import TripletWriter
+
+# folder with one subfolder per triplet, or with the .npy files of create_npy.py
+data_root = "/home/user/Schreibtisch/Colab-traiNNer/train/vimeo"
+dest_dir = "/home/user/Schreibtisch/Colab-traiNNer/train/triplets"
+# training resolution, VimeoTriplet resizes to 448x256
+width = 448
+height = 256
+chunk_size = 1024  # triplets per chunk file
+
+
+def read_folder(folder):
+    frames = []
+    for name in ("frame1.jpg", "frame2.jpg", "frame3.jpg"):
+        image = cv2.imread(os.path.join(folder, name))
+        frames.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return frames
+
+
+def read_npy(path):
+    # float32 (3, 3, h, w) in range [0, 1], stored as frame1, frame3, frame2
+    combined = np.load(path)
+    combined = np.round(combined * 255).clip(0, 255).astype(np.uint8)
+    combined = combined.transpose(0, 2, 3, 1)
+    return [combined[0], combined[2], combined[1]]
+
+
+npy_files = sorted(glob.glob(os.path.join(data_root, "**", "*.npy"), recursive=True))
+if npy_files:
+    samples, read = npy_files, read_npy
+else:
+    samples = sorted(glob.glob(os.path.join(data_root, "*", "")))
+    read = read_folder
+
+with TripletWriter(dest_dir, height, width, chunk_size=chunk_size) as writer:
+    for sample in tqdm(samples):
+        name = os.path.relpath(sample, data_root)
+        writer.add(read(sample), name=name)
+
+print(f"Wrote {len(samples)} triplets to {dest_dir}.")
@@ -1,152 +1,252 @@
-# @markdown Folder path with all the videos
-global outputPath
-from PIL import Image
-from tqdm import tqdm
-
-# @markdown Path to generate the Dataset
-outputPath = "/x/"  # @param{type:"string"}
-temp = "/x/"
-rootdir = "/x/"
-
-# @markdown The bigger the value, the more alike the frames need to be to be considered a triplet.
-psnr = 10  # @param{type:"number"}
-# @markdown resize to 448x256
-resize = True  # @param{type:"boolean"}
-import random
-
-# Original dataset information:
-# Vimeo-90K triplets dataset contains 91701 triplets extracted from 15k video clips.
-# Each triplet is a short RGB video sequence that consists of 3 frames with fixed resolution 448x256
-chance = 0.1  # @param{type:"slider", min:0.01, max:1, step:0.01}
-
-
-def calculate_psnr(img1, img2, max_value=255):
-    """ "Calculating peak signal-to-noise ratio (PSNR) between two images."""
-    i1 = PIL.Image.open(img1).convert("RGB")
-    i2 = PIL.Image.open(img2).convert("RGB")
-
-    mse = np.mean(
-        (np.array(i1, dtype=np.float32) - np.array(i2, dtype=np.float32)) ** 2
-    )
-    if mse == 0:
-        return 100
-    return 20 * np.log10(max_value / (np.sqrt(mse)))
-
-
-def IsDiffScenes(img1, img2, diff=psnr):
-    return calculate_psnr(img1, img2) <= diff
-
-
-import os
-import shutil
-from shutil import copyfile
-import time
-import PIL
-import numpy as np
-import glob
-
-if not os.path.isdir(outputPath):
-    os.makedirs(outputPath)
-
-if not os.path.isdir(os.path.join(outputPath, "sequences")):
-    os.makedirs(os.path.join(outputPath, "sequences"))
-
-counter = 1
-
-files = glob.glob(rootdir + "/**/*.mkv", recursive=True)
-files_webm = glob.glob(rootdir + "/**/*.webm", recursive=True)
-files_mp4 = glob.glob(rootdir + "/**/*.mp4", recursive=True)
-files.extend(files_webm)
-files.extend(files_mp4)
-
-for video in tqdm(files):
-    try:
-        shutil.rmtree(temp)
-        os.mkdir(temp)
-    except:
-        print("xd")
-    path = video
-
-    rescale = ""
-    if resize:
-        rescale = "scale=1280:720,"
-    os.system(
-        f'ffmpeg -hide_banner -loglevel error -i "{path}" -vf "{rescale}mpdecimate=hi=128*12:lo=320*1.00:max=16" -vsync 0 -qscale:v 1 -pix_fmt rgb24  "{temp}%10d.jpg"'
-    )
-
-    root = os.path.join(outputPath, "sequences", str(counter).zfill(3))
-    if not os.path.isdir(root):
-        os.makedirs(root)
-
-    triIndex = 1
-    images = sorted(os.listdir(temp))
-    for i in range(1, len(images)):
-        if random.random() > chance:
-            im1 = temp + images[i - 2]
-            im2 = temp + images[i - 1]
-            im3 = temp + images[i]
-            if (
-                IsDiffScenes(im1, im2, psnr) == False
-                and IsDiffScenes(im2, im3, psnr) == False
-            ):
-                # print("Triplet Found")
-                triPath = os.path.join(root, str(triIndex).zfill(5))
-                if not os.path.isdir(triPath):
-                    os.makedirs(triPath)
-                copyfile(im1, os.path.join(triPath, "im1.jpg"))
-                copyfile(im2, os.path.join(triPath, "im2.jpg"))
-                copyfile(im3, os.path.join(triPath, "im3.jpg"))
-                triIndex += 1
-
-    counter += 1
-
-testingPercentage = 0.1  # @param{type:"slider", min:0.1, max:0.9, step:0.1}
-database = outputPath
-import random
-
-if os.path.isfile(os.path.join(database, "tri_testlist.txt")):
-    os.remove(os.path.join(database, "tri_testlist.txt"))
-if os.path.isfile(os.path.join(database, "tri_trainlist.txt")):
-    os.remove(os.path.join(database, "tri_trainlist.txt"))
-
-from glob import glob
-
-folders = glob(os.path.join(databas, "sequences/*/"))
-
-paths = []
-
-for i in range(0, len(folders)):
-    triplets = glob(folders[i] + "/*/")
-    for ii in range(0, len(triplets)):
-        innerF = os.path.basename((os.path.dirname(triplets[ii])))
-        outF = os.path.basename((os.path.dirname(folders[i])))
-        paths.append(outF + "/" + innerF)
-
-
-def partitionRankings(rawRatings, testPercent):
-    howManyNumbers = int(round(testPercent * len(rawRatings)))
-    shuffled = rawRatings[:]
-    random.shuffle(shuffled)
-    return shuffled[howManyNumbers:], shuffled[:howManyNumbers]
-
-
-training, test = partitionRankings(paths, testingPercentage)
-
-
-trainTxt = os.path.join(database, "tri_trainlist.txt")
-trainFile = open(trainTxt, "w")
-
-testTxt = os.path.join(database, "tri_testlist.txt")
-
-testFile = open(testTxt, "w")
-
-for txt in training:
-    trainFile.write(txt + "\n")
-trainFile.close()
-
-for txt in test:
-    testFile.write(txt + "\n")
-testFile.close()
-
-print(training)
-print(test)
+# Builds an interpolation dataset from videos: every video is decoded once with PyAV
+# (pip install av), near duplicate frames are dropped like ffmpeg's mpdecimate and
+# triplets without a scene cut are written into a uint8 triplet store for the
+# DS_video_store dataloader. Videos are processed in parallel, a finished video is
+# skipped when the script runs again.
+# Run from the code folder: python scripts/triplet_dataset.py
+import glob
+import hashlib
+import os
+import random
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.triplet_store import TripletWriter, merge_triplet_stores
+from data.video_windows import find_videos
+
+# Folder path with all the videos
+rootdir = "/x/"
+# triplet store for DS_video_store (triplet_path), every video gets a part in
+# dest_dir/parts which are merged at the end
+dest_dir = "/x/triplets/"
+# validation triplets are written as frame1.jpg - frame3.jpg folders for
+# VimeoTriplet_val (val dataroot_HR), empty to keep all triplets for training
+val_dir = "/x/val/"
+testingPercentage = 0.1
+
+# The bigger the value, the more alike the frames need to be to be considered a triplet.
+psnr = 10
+# frames are resized to 448x256 like VimeoTriplet, 1280x720 was the old default
+width = 448
+height = 256
+# Original dataset information:
+# Vimeo-90K triplets dataset contains 91701 triplets extracted from 15k video clips.
+# Each triplet is a short RGB video sequence that consists of 3 frames with fixed resolution 448x256
+# chance of skipping a triplet
+chance = 0.1
+# drop near duplicate frames like ffmpeg -vf mpdecimate=hi=128*12:lo=320:max=16 did before
+decimate = True
+decimate_hi = 128 * 12  # a frame is kept if an 8x8 block differs more than this
+decimate_lo = 320  # or if more than decimate_frac of the blocks differ more than this
+decimate_frac = 0.33
+decimate_max = 16  # most frames dropped in a row
+processes = 4
+chunk_frames = 64  # frames compared at once
+
+
+def decoded_frames(path):
+    """Decodes a video, yields RGB uint8 frames at the output size."""
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        reference, dropped = None, 0
+        for frame in container.decode(stream):
+            image = frame.to_ndarray(format="rgb24")
+            if image.shape[:2] != (height, width):
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            if (
+                decimate
+                and reference is not None
+                and dropped < decimate_max
+                and is_duplicate(image, reference)
+            ):
+                dropped += 1
+                continue
+            reference, dropped = image, 0
+            yield image
+
+
+def is_duplicate(frame, reference):
+    """The check of mpdecimate, sums of absolute differences of 8x8 blocks
+    against the last kept frame."""
+    h, w = frame.shape[0] // 8 * 8, frame.shape[1] // 8 * 8
+    diff = cv2.absdiff(frame[:h, :w], reference[:h, :w])
+    sad = diff.reshape(h // 8, 8, w // 8, 8, -1).sum((1, 3), dtype=np.int32)
+    if (sad > decimate_hi).any():
+        return False
+    return (sad > decimate_lo).mean() <= decimate_frac
+
+
+def frame_chunks(path):
+    """Decoded frames in (chunk_frames, h, w, 3) arrays."""
+    chunk = []
+    for frame in decoded_frames(path):
+        chunk.append(frame)
+        if len(chunk) == chunk_frames:
+            yield np.stack(chunk)
+            chunk = []
+    if chunk:
+        yield np.stack(chunk)
+
+
+def rolling_psnr(previous, frames):
+    """PSNR of every frame to the one in front of it, vectorized over a chunk.
+
+    Args:
+        previous: last frame of the previous chunk or None.
+        frames: (n, h, w, 3) uint8 chunk.
+
+    Returns:
+        np.ndarray: (n,) float, inf for the first frame of a video.
+    """
+    if previous is not None:
+        reference = np.concatenate([previous[None], frames[:-1]])
+    else:
+        reference = np.concatenate([frames[:1], frames[:-1]])
+    diff = frames.astype(np.float32) - reference.astype(np.float32)
+    mse = np.mean(diff * diff, axis=(1, 2, 3))
+    with np.errstate(divide="ignore"):
+        values = 20 * np.log10(255 / np.sqrt(mse))
+    if previous is None:
+        values[0] = np.inf
+    # identical frames, calculate_psnr returned 100
+    return np.where(mse == 0, 100.0, values)
+
+
+def process_video(job):
+    """Writes the triplets of one video into its part, returns statistics."""
+    video, part_dir, seed = job
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    name = os.path.splitext(os.path.basename(video))[0]
+
+    # a part without meta.json is unfinished, start it over
+    shutil.rmtree(part_dir, ignore_errors=True)
+    tmp_dir = part_dir.rstrip("/\\") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    frames_done = triplets = val_triplets = 0
+    # last three frames and the psnr of each to the frame in front of it
+    window, window_psnr = [], []
+    try:
+        with TripletWriter(tmp_dir, height, width) as writer:
+            for chunk in frame_chunks(video):
+                values = rolling_psnr(window[-1] if window else None, chunk)
+                for frame, value in zip(chunk, values):
+                    frames_done += 1
+                    window = (window + [frame])[-3:]
+                    window_psnr = (window_psnr + [value])[-3:]
+                    if len(window) < 3 or rng.random() <= chance:
+                        continue
+                    # both frame pairs have to be from the same scene
+                    if window_psnr[1] <= psnr or window_psnr[2] <= psnr:
+                        continue
+                    triplet_name = f"{name}_{frames_done:08d}"
+                    if val_dir and rng.random() < testingPercentage:
+                        write_val(triplet_name, window)
+                        val_triplets += 1
+                    else:
+                        writer.add(window, name=triplet_name)
+                        triplets += 1
+    except BaseException:
+        # a failed video leaves nothing behind and is tried again next run
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    os.replace(tmp_dir, part_dir)
+    return video, frames_done, triplets, val_triplets, time.perf_counter() - start
+
+
+def write_val(name, frames):
+    folder = os.path.join(val_dir, name)
+    os.makedirs(folder, exist_ok=True)
+    for i, frame in enumerate(frames):
+        cv2.imwrite(
+            os.path.join(folder, f"frame{i + 1}.jpg"),
+            cv2.cvtColor(frame, cv2.COLOR_RGB2BGR),
+            [cv2.IMWRITE_JPEG_QUALITY, 100],
+        )
+
+
+def part_key(video):
+    """Stable part name of a video, the hash of its path relative to rootdir,
+    so adding or removing videos does not rename the other parts."""
+    relative = os.path.relpath(video, rootdir).replace("\\", "/")
+    digest = hashlib.sha1(relative.encode("utf-8")).hexdigest()[:16]
+    return f"{digest}_{os.path.splitext(os.path.basename(video))[0]}", digest
+
+
+def is_finished(part_dir):
+    return os.path.isfile(os.path.join(part_dir, "meta.json"))
+
+
+def main():
+    videos = find_videos(rootdir)
+    parts_dir = os.path.join(dest_dir, "parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    # unfinished parts of an interrupted run
+    for tmp_dir in glob.glob(os.path.join(parts_dir, "*.tmp")):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    parts, seeds = [], []
+    for video in videos:
+        name, digest = part_key(video)
+        parts.append(os.path.join(parts_dir, name))
+        seeds.append(int(digest, 16))
+    # finished parts have meta.json, resume with the rest
+    jobs = [
+        (video, part, seed)
+        for video, part, seed in zip(videos, parts, seeds)
+        if not is_finished(part)
+    ]
+    print(f"{len(videos) - len(jobs)} of {len(videos)} videos are done already.")
+
+    start = time.perf_counter()
+    total_frames = total_triplets = total_val = 0
+    failed = []
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {pool.submit(process_video, job): job[0] for job in jobs}
+        progress = tqdm(as_completed(futures), total=len(futures))
+        for future in progress:
+            try:
+                video, frames, triplets, val_triplets, seconds = future.result()
+            except Exception as e:
+                # the part stays unfinished and is tried again on the next run
+                print(f"Skipping {futures[future]}: {e}")
+                failed.append(futures[future])
+                continue
+            total_frames += frames
+            total_triplets += triplets
+            total_val += val_triplets
+            progress.set_postfix(
+                fps=f"{total_frames / (time.perf_counter() - start):.0f}",
+                triplets=total_triplets,
+            )
+    elapsed = time.perf_counter() - start
+    if jobs:
+        print(
+            f"Decoded {total_frames} frames in {elapsed:.1f}s "
+            f"({total_frames / max(elapsed, 1e-9):.0f} fps), "
+            f"{total_triplets} triplets, {total_val} validation triplets."
+        )
+
+    # parts of videos which are no longer in rootdir are not merged either
+    finished = [part for part in parts if is_finished(part)]
+    merge_triplet_stores(finished, dest_dir)
+    print(f"Wrote the triplet store of {len(finished)} videos to {dest_dir}.")
+    if failed:
+        print(f"Skipped {len(failed)} videos, they are tried again on the next run:")
+        for video in sorted(failed):
+            print(f"  {video}")
+
+
+if __name__ == "__main__":
+    main()